@@ -0,0 +1,156 @@
+# admission.py
+# Estimates each job's peak memory and only lets jobs start while their estimates fit a RAM budget
+import os
+import threading
+import time
+from typing import Optional
+
+from pipeline import MAX_DURATION
+from scheduler import DEFAULT_DURATION
+from settings import separation_params
+
+# Working memory a job adds to its worker process, per second of audio,
+# until jobs have been measured: the decoded mix (0.35 MB/s as float32
+# stereo), Demucs' 4-stem output and the bag's running sum (1.4 MB/s each),
+# the mono stems and their copies, and the spectral gate's STFTs
+DEFAULT_MB_PER_SECOND = {"memory": 6.0, "streamed": 6.0}
+JOB_OVERHEAD_MB = 150
+# Streamed tracks (longer than MAX_DURATION) only hold about this much audio
+# at a time: a 60-second window, its crossfades and the STFT blocks behind it
+STREAMED_RESIDENT_SECONDS = 90
+# Estimates are padded by this much, and calibrated from measured peaks
+# with this moving-average weight
+SAFETY_FACTOR = 1.2
+CALIBRATION_WEIGHT = 0.3
+
+
+def total_memory_mb() -> Optional[float]:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 2
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import psutil
+        return psutil.virtual_memory().total / 1024 ** 2
+    except ImportError:
+        return None
+
+
+# RAM that running jobs may reserve between them, on top of what the API and
+# the idle workers (with their models loaded) hold. Defaults to 60% of
+# physical memory; 0 turns admission control off.
+_total = total_memory_mb()
+MEMORY_BUDGET_MB = float(os.environ.get("MEMORY_BUDGET_MB", round(0.6 * _total) if _total else 0))
+
+
+def measured_peak_mb(records: list) -> Optional[float]:
+    """Largest growth of a worker process's RSS while it ran one of the job's stages."""
+    growth = [
+        record["peak_rss_mb"] - record["start_rss_mb"]
+        for record in records
+        if record.get("kind") == "worker" and record.get("start_rss_mb") is not None
+    ]
+    return max(growth) if growth else None
+
+
+class MemoryEstimator:
+    """Peak working memory of a job from its duration, per model and kind of run.
+
+    A job costs JOB_OVERHEAD_MB plus a rate per second of audio it holds at
+    once: the whole track when it is separated in memory, one streaming
+    window when it is longer. The rate starts from a default and is a
+    moving average of what finished jobs actually used.
+    """
+
+    def __init__(self, defaults: dict = DEFAULT_MB_PER_SECOND, weight: float = CALIBRATION_WEIGHT):
+        self.defaults = dict(defaults)
+        self.rates = {}  # (model, kind) -> MB per second
+        self.samples = {}
+        self.weight = weight
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def shape(job: dict) -> tuple:
+        """((model, kind), seconds of audio held at once) for a job."""
+        duration = job.get("duration") or DEFAULT_DURATION
+        kind = "memory" if duration <= MAX_DURATION else "streamed"
+        seconds = duration if kind == "memory" else STREAMED_RESIDENT_SECONDS
+        return (separation_params()["model"], kind), seconds
+
+    def estimate(self, job: dict) -> float:
+        if job.get("mode", "stem") == "youtube":
+            return 0.0  # Downloads and transcodes only, nothing decoded
+        key, seconds = self.shape(job)
+        with self.lock:
+            rate = self.rates.get(key, self.defaults[key[1]])
+        return round(SAFETY_FACTOR * (JOB_OVERHEAD_MB + rate * seconds), 1)
+
+    def update(self, job: dict, peak_mb: float):
+        if job.get("mode", "stem") == "youtube" or peak_mb is None:
+            return
+        key, seconds = self.shape(job)
+        rate = max(peak_mb - JOB_OVERHEAD_MB, 0) / seconds
+        with self.lock:
+            old = self.rates.get(key)
+            self.rates[key] = rate if old is None else (1 - self.weight) * old + self.weight * rate
+            self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stats(self) -> list:
+        with self.lock:
+            return [
+                {"model": model, "kind": kind, "mb_per_second": round(rate, 3), "jobs_measured": self.samples[(model, kind)]}
+                for (model, kind), rate in sorted(self.rates.items())
+            ]
+
+
+class AdmissionController:
+    """Memory reservations of the jobs the scheduler has started.
+
+    A job is admitted when its estimate fits what is left of the budget, or
+    when nothing else is running (so a job bigger than the budget still
+    runs, alone). Its reservation lasts until it finishes; then the
+    measured peak calibrates the estimator. Either way the estimate is
+    kept in the job's `memory_estimate_mb`.
+    """
+
+    def __init__(self, estimator: MemoryEstimator, budget_mb: float = MEMORY_BUDGET_MB):
+        self.estimator = estimator
+        self.budget_mb = budget_mb
+        self.reservations = {}  # job_id -> reservation
+        self.lock = threading.Lock()
+
+    def reserved_mb(self) -> float:
+        with self.lock:
+            return sum(reservation["mb"] for reservation in self.reservations.values())
+
+    def try_reserve(self, job: dict) -> bool:
+        job["memory_estimate_mb"] = mb = self.estimator.estimate(job)
+        with self.lock:
+            reserved = sum(reservation["mb"] for reservation in self.reservations.values())
+            if self.budget_mb > 0 and self.reservations and reserved + mb > self.budget_mb:
+                return False
+            self.reservations[job["job_id"]] = {"job_id": job["job_id"], "name": job.get("name"), "mb": mb, "since": time.time()}
+        return True
+
+    def release(self, job: dict):
+        with self.lock:
+            self.reservations.pop(job["job_id"], None)
+
+    def observe(self, job: dict, records: list):
+        """Feed a finished job's measured peak back into the estimator."""
+        peak = measured_peak_mb(records)
+        if peak is not None:
+            job["memory_peak_mb"] = round(peak, 1)
+            self.estimator.update(job, peak)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            reservations = sorted(self.reservations.values(), key=lambda reservation: reservation["since"])
+            reserved = sum(reservation["mb"] for reservation in reservations)
+        return {
+            "budget_mb": self.budget_mb or None,
+            "reserved_mb": round(reserved, 1),
+            "available_mb": round(self.budget_mb - reserved, 1) if self.budget_mb else None,
+            "reservations": [dict(reservation) for reservation in reservations],
+            "calibration": self.estimator.stats(),
+        }
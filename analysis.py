@@ -0,0 +1,94 @@
+# analysis.py
+# Shares STFTs between melody gating, BPM and key detection for one job
+import threading
+
+import numpy as np
+import librosa
+
+N_FFT = 2048
+HOP_LENGTH = 512
+
+KEY_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# Key profiles for major and minor keys (Krumhansl-Schmuckler)
+MAJOR_PROFILE = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+MINOR_PROFILE = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+def _zscore(x: np.ndarray) -> np.ndarray:
+    x = x - x.mean(axis=-1, keepdims=True)
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+# All 24 keys, ordered C major, C minor, C# major, ... Rotating the profile
+# to the tonic is equivalent to rotating the chroma the other way.
+KEY_LABELS = [f"{name} {mode}" for name in KEY_NAMES for mode in ("major", "minor")]
+KEY_PROFILES = _zscore(np.stack([
+    np.roll(profile, i) for i in range(12) for profile in (MAJOR_PROFILE, MINOR_PROFILE)
+]))
+
+
+def key_from_chroma(chroma_mean: np.ndarray) -> str:
+    """Best-correlated key for a 12-bin mean chroma vector.
+
+    Scores all 24 rotated profiles with one matrix product of z-scored
+    vectors, which is the Pearson correlation np.corrcoef would give.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = KEY_PROFILES @ _zscore(np.asarray(chroma_mean, dtype=float))
+    if np.all(np.isnan(scores)):
+        return 'C major'
+    return KEY_LABELS[int(np.nanargmax(scores))]
+
+
+class StemAnalysis:
+    """Per-job cache of stem spectrograms.
+
+    Each stem's STFT magnitude is computed once, on first use, and reused by
+    gating (melody), onset strength (drums) and chroma (melody). Only
+    magnitudes are kept, as float32, to bound memory; call `release` once
+    analysis is done. Safe to use from several threads.
+    """
+
+    def __init__(self, stems: dict, sr: int):
+        self.stems = stems
+        self.sr = sr
+        self._magnitudes = {}
+        self._locks = {tag: threading.Lock() for tag in stems}
+
+    def magnitude(self, tag: str) -> np.ndarray:
+        with self._locks[tag]:
+            if tag not in self._magnitudes:
+                spectrum = librosa.stft(self.stems[tag], n_fft=N_FFT, hop_length=HOP_LENGTH)
+                self._magnitudes[tag] = np.abs(spectrum).astype(np.float32)
+            return self._magnitudes[tag]
+
+    def gate(self, tag: str, ref_tags, threshold: float) -> np.ndarray:
+        """spectral_gate of one stem against the sum of others, reusing its STFT."""
+        stem_mag = self.magnitude(tag)
+        ref = sum(self.stems[ref] for ref in ref_tags)
+        ref_mag = np.abs(librosa.stft(ref, n_fft=N_FFT, hop_length=HOP_LENGTH))
+        mask = stem_mag > threshold * ref_mag
+        del ref, ref_mag
+        return librosa.istft(stem_mag * mask, n_fft=N_FFT, hop_length=HOP_LENGTH)
+
+    def bpm(self, tag: str = "drums") -> float:
+        try:
+            mel = librosa.feature.melspectrogram(S=self.magnitude(tag) ** 2, sr=self.sr)
+            onset_env = librosa.onset.onset_strength(S=librosa.power_to_db(mel), sr=self.sr)
+            tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=self.sr)
+            return float(np.atleast_1d(tempo)[0])
+        except Exception as e:
+            print(f"BPM detection failed: {e}")
+            return 128.0
+
+    def key(self, tag: str = "melody") -> str:
+        try:
+            chroma = librosa.feature.chroma_stft(S=self.magnitude(tag) ** 2, sr=self.sr)
+            return key_from_chroma(np.mean(chroma, axis=1))
+        except Exception as e:
+            print(f"Key detection failed: {e}")
+            return "Unknown"
+
+    def release(self):
+        self._magnitudes.clear()
@@ -0,0 +1,139 @@
+# audio_io.py
+# Streams audio in and out of ffmpeg as float32 blocks
+import shutil
+import subprocess
+
+import numpy as np
+from mutagen.flac import FLAC
+from mutagen.oggopus import OggOpus
+
+
+def ffmpeg_binary() -> str:
+    return shutil.which("ffmpeg") or "ffmpeg"
+
+
+class FFmpegReader:
+    """Decodes any file ffmpeg understands into (channels, frames) float32 blocks.
+
+    Only one block is held in memory at a time, so tracks of any length can
+    be read with flat memory use. `start` and `duration` (seconds) decode
+    only part of the file.
+    """
+
+    def __init__(self, path: str, samplerate: int, channels: int, start: float = None, duration: float = None):
+        self.path = str(path)
+        self.channels = channels
+        window = (["-ss", str(start)] if start else []) + (["-t", str(duration)] if duration else [])
+        self.proc = subprocess.Popen(
+            [
+                ffmpeg_binary(), "-v", "error", "-nostdin",
+                *window, "-i", self.path, "-map", "0:a:0",
+                "-f", "f32le", "-ac", str(channels), "-ar", str(samplerate),
+                "pipe:1",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def read(self, frames: int) -> np.ndarray:
+        """Read up to `frames` frames; fewer means the end of the file."""
+        wanted = frames * self.channels * 4
+        chunks = []
+        while wanted > 0:
+            data = self.proc.stdout.read(wanted)
+            if not data:
+                break
+            chunks.append(data)
+            wanted -= len(data)
+        data = b"".join(chunks)
+        data = data[:len(data) - len(data) % (self.channels * 4)]
+        return np.frombuffer(data, dtype=np.float32).reshape(-1, self.channels).T.copy()
+
+    def close(self):
+        self.proc.stdout.close()
+        error = self.proc.stderr.read().decode(errors="replace").strip()
+        self.proc.stderr.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {self.path}: {error}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None:
+            self.proc.kill()
+        self.close()
+
+
+class FFmpegWriter:
+    """Encodes float32 blocks to a compressed file (e.g. MP3) as they arrive."""
+
+    def __init__(self, path: str, samplerate: int, channels: int = 1, bitrate: str = "192k"):
+        self.path = str(path)
+        self.channels = channels
+        self.proc = subprocess.Popen(
+            [
+                ffmpeg_binary(), "-v", "error", "-nostdin", "-y",
+                "-f", "f32le", "-ac", str(channels), "-ar", str(samplerate),
+                "-i", "pipe:0", "-b:a", bitrate, self.path,
+            ],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+    def write(self, block: np.ndarray):
+        """Write a (channels, frames) or mono (frames,) block."""
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim == 1:
+            block = block[None]
+        self.proc.stdin.write(np.ascontiguousarray(block.T).tobytes())
+
+    def close(self):
+        self.proc.stdin.close()
+        error = self.proc.stderr.read().decode(errors="replace").strip()
+        self.proc.stderr.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {self.path}: {error}")
+
+
+def decode_audio(path: str, samplerate: int, channels: int, start: float = None, duration: float = None) -> np.ndarray:
+    """Decode a file (or `duration` seconds of it from `start`) to a (channels, frames) float32 array in one pass."""
+    chunks = []
+    with FFmpegReader(path, samplerate, channels, start, duration) as reader:
+        while True:
+            block = reader.read(samplerate * 30)
+            if block.shape[1]:
+                chunks.append(block)
+            if block.shape[1] < samplerate * 30:
+                break
+    if not chunks:
+        raise RuntimeError(f"No audio decoded from {path}")
+    return np.concatenate(chunks, axis=1)
+
+
+def encode_mp3(path: str, samples: np.ndarray, samplerate: int, bitrate: str = "192k"):
+    """Encode an in-memory array straight to MP3, with no temporary WAV."""
+    writer = FFmpegWriter(path, samplerate, 1 if np.ndim(samples) == 1 else len(samples), bitrate)
+    try:
+        writer.write(samples)
+    finally:
+        writer.close()
+
+
+def transcode(src: str, dst: str, bitrate: str = "192k"):
+    """Re-encode a file with ffmpeg, e.g. a downloaded webm stream to MP3."""
+    proc = subprocess.run(
+        [ffmpeg_binary(), "-v", "error", "-nostdin", "-y", "-i", str(src), "-vn", "-b:a", bitrate, str(dst)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to convert {src}: {proc.stderr.decode(errors='replace').strip()}")
+
+
+def tag_vorbis(path: str, bpm: float):
+    """BPM as Vorbis comments (FLAC and Opus), which rewrites only the header blocks."""
+    audio = FLAC(path) if str(path).endswith(".flac") else OggOpus(path)
+    audio["BPM"] = str(int(round(bpm)))
+    audio["COMMENT"] = f"BPM: {bpm:.1f}"
+    audio.save()
@@ -0,0 +1,218 @@
+# batch.py
+# Separates a folder tree of local audio files on a pool of worker processes, resumably
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from mutagen import File as MutagenFile
+
+from pipeline import MAX_DURATION
+from settings import STEM_FORMAT, separation_params
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg", ".opus", ".m4a", ".aiff", ".aif")
+MANIFEST_NAME = "manifest.jsonl"
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_THREADS = 4
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def settings_key(model: str, include_full: bool) -> str:
+    """Hash of everything besides the input that changes a track's outputs."""
+    params = {**separation_params(model), "format": STEM_FORMAT, "full": include_full}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def find_audio(root: Path, exclude: Path = None) -> List[Path]:
+    """Audio files under root, in a stable order, skipping the output folder if it is inside."""
+    return sorted(
+        path for path in root.rglob("*")
+        if path.suffix.lower() in AUDIO_EXTENSIONS and path.is_file()
+        and not (exclude and exclude in path.parents)
+    )
+
+
+def output_names(root: Path, files: List[Path]) -> Dict[Path, str]:
+    """Relative output folder for each file (its path without the extension).
+
+    Files that only differ by extension (song.mp3 and song.wav) keep it, so
+    their stems don't overwrite each other.
+    """
+    stems = {}
+    for path in files:
+        stems.setdefault(path.relative_to(root).with_suffix(""), []).append(path)
+    names = {}
+    for base, paths in stems.items():
+        for path in paths:
+            names[path] = base.as_posix() if len(paths) == 1 else f"{base.as_posix()} ({path.suffix.lstrip('.').lower()})"
+    return names
+
+
+class Manifest:
+    """Per-track results, one JSON line each, appended as tracks finish.
+
+    Lines are flushed and synced as they are written, so an interrupted run
+    loses at most the tracks in progress; later lines for a path replace
+    earlier ones, and `compact` rewrites the file with one line per track.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        if path.exists():
+            for line in path.read_text(encoding="utf-8").splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by an interruption
+                self.entries[entry["path"]] = entry
+        self.file = None
+
+    def append(self, entry: dict):
+        self.entries[entry["path"]] = entry
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def compact(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        tmp = self.path.with_name(f".{self.path.name}.tmp")
+        tmp.write_text("".join(json.dumps(entry) + "\n" for entry in sorted(self.entries.values(), key=lambda e: e["path"])), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+def up_to_date(entry: Optional[dict], sha256: str, settings: str, output: Path) -> bool:
+    return (
+        entry is not None and entry["status"] == "done"
+        and entry["sha256"] == sha256 and entry["settings"] == settings
+        and all((output / stem).is_file() for stem in entry["stems"])
+    )
+
+
+def init_worker(model: str, workers: int):
+    """Pool initializer: import torch and load the model once per process."""
+    from splitter import set_torch_threads, load_model
+    set_torch_threads(workers)
+    load_model(model)
+
+
+def separate_file(source: str, output_dir: str, name: str, model: str, include_full: bool) -> dict:
+    """Separate one file in a pool worker; tracks over MAX_DURATION are streamed."""
+    from splitter import separate_stems, postprocess_stems
+    started = time.perf_counter()
+    info = MutagenFile(source)
+    duration = info.info.length if info is not None and info.info else None
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    if duration is None or duration > MAX_DURATION:
+        from streaming import split_stream_to_stems
+        stems, bpm, key = split_stream_to_stems(source, output_dir, name, model_name=model, include_full=include_full, total_seconds=duration)
+    else:
+        separated = separate_stems(source, model_name=model, progress=False)
+        stems, bpm, key = postprocess_stems(separated, output_dir, name, include_full=include_full)
+    return {"stems": stems, "bpm": bpm, "key": key, "duration": duration, "seconds": time.perf_counter() - started}
+
+
+def run_batch(input_root: Path, output_root: Path, workers: int, model: str, include_full: bool = False, force: bool = False) -> dict:
+    input_root, output_root = input_root.resolve(), output_root.resolve()
+    output_root.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(output_root / MANIFEST_NAME)
+    settings = settings_key(model, include_full)
+    files = find_audio(input_root, exclude=output_root if output_root != input_root else None)
+    names = output_names(input_root, files)
+
+    # Unchanged files (same size and mtime as in the manifest) aren't hashed again
+    def fingerprint(path: Path) -> tuple:
+        stat = path.stat()
+        entry = manifest.entries.get(path.relative_to(input_root).as_posix())
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            return path, entry["sha256"], stat
+        return path, file_sha256(path), stat
+
+    with ThreadPoolExecutor(HASH_THREADS) as hashers:
+        fingerprints = list(hashers.map(fingerprint, files))
+
+    todo, skipped = [], 0
+    for path, sha256, stat in fingerprints:
+        rel = path.relative_to(input_root).as_posix()
+        if not force and up_to_date(manifest.entries.get(rel), sha256, settings, output_root):
+            skipped += 1
+            continue
+        todo.append((path, rel, sha256, stat))
+    print(f"{len(files)} audio files, {skipped} up to date, {len(todo)} to separate on {workers} workers")
+
+    done = failed = 0
+    started = time.perf_counter()
+    pool = ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(model, workers),
+    ) if todo else None
+    try:
+        futures = {}
+        for path, rel, sha256, stat in todo:
+            name = Path(names[path]).name
+            out_dir = output_root / Path(names[path]).parent / name
+            futures[pool.submit(separate_file, str(path), str(out_dir), name, model, include_full)] = (rel, sha256, stat)
+        for future in as_completed(futures):
+            rel, sha256, stat = futures[future]
+            entry = {"path": rel, "sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "settings": settings, "finished_at": round(time.time(), 3)}
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                raise  # Every remaining track is lost with the pool
+            except Exception as e:
+                failed += 1
+                manifest.append({**entry, "status": "error", "error": str(e), "stems": []})
+                print(f"[{done + failed}/{len(todo)}] {rel}: failed: {e}")
+                continue
+            done += 1
+            manifest.append({
+                **entry, "status": "done",
+                "bpm": round(result["bpm"], 1), "key": result["key"],
+                "duration": round(result["duration"], 2) if result["duration"] else None,
+                "seconds": round(result["seconds"], 1),
+                "stems": [Path(stem).resolve().relative_to(output_root).as_posix() for stem in result["stems"]],
+            })
+            print(f"[{done + failed}/{len(todo)}] {rel}: {result['bpm']:.1f} BPM, {result['key']} ({result['seconds']:.0f}s)")
+    except BrokenProcessPool:
+        print("A worker process died (out of memory?); rerun to resume, perhaps with fewer --workers")
+    except KeyboardInterrupt:
+        print("Interrupted; rerun to resume")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        manifest.compact()
+    summary = {"files": len(files), "skipped": skipped, "done": done, "failed": failed, "seconds": round(time.perf_counter() - started, 1)}
+    print(f"Done: {done} separated, {failed} failed, {skipped} skipped in {summary['seconds']:.0f}s. Manifest: {manifest.path}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Separate every audio file under a folder into stems")
+    parser.add_argument("input", help="Folder to scan (recursively) for audio files")
+    parser.add_argument("--output", default="stems", help="Output root; the input's folder structure is kept")
+    parser.add_argument("--workers", type=int, default=max(1, min(4, (os.cpu_count() or 1) // 4)),
+                        help="Worker processes, each loading the model once; CPU cores are shared between them")
+    parser.add_argument("--model", default="mdx_extra_q")
+    parser.add_argument("--full", action="store_true", help="Also write each track's full mix as MP3")
+    parser.add_argument("--force", action="store_true", help="Separate files even if their stems are up to date")
+    args = parser.parse_args()
+    run_batch(Path(args.input), Path(args.output), max(1, args.workers), args.model, include_full=args.full, force=args.force)
@@ -0,0 +1,347 @@
+# benchmark.py
+# Offline benchmarks for every pipeline stage, with JSON results and regression checks
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+from fake_youtube import FakeYoutubeDL, offline_youtube
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SAMPLERATE = 44100
+
+
+# --- Synthetic audio -------------------------------------------------------
+
+def click_track(seconds: float, bpm: float = 128.0, sr: int = SAMPLERATE) -> np.ndarray:
+    """Short decaying noise bursts on every beat."""
+    out = np.zeros(int(seconds * sr), dtype=np.float32)
+    click = np.random.default_rng(0).standard_normal(int(0.02 * sr)).astype(np.float32)
+    click *= np.exp(-np.linspace(0, 8, len(click))).astype(np.float32)
+    for start in np.arange(0, len(out), 60.0 / bpm * sr).astype(int):
+        end = min(len(out), start + len(click))
+        out[start:end] += click[:end - start]
+    return out
+
+
+def tone(seconds: float, freqs=(220.0, 261.63, 329.63), sr: int = SAMPLERATE) -> np.ndarray:
+    """A sustained chord (A minor by default)."""
+    t = np.arange(int(seconds * sr)) / sr
+    return (sum(np.sin(2 * np.pi * f * t) for f in freqs) / len(freqs)).astype(np.float32)
+
+
+def noise(seconds: float, sr: int = SAMPLERATE) -> np.ndarray:
+    return np.random.default_rng(1).standard_normal(int(seconds * sr)).astype(np.float32)
+
+
+def synthetic_stems(seconds: float) -> dict:
+    """Stand-in stems for benchmarking post-processing without a model."""
+    drums = 0.6 * click_track(seconds)
+    melody = 0.3 * tone(seconds)
+    bass = 0.3 * tone(seconds, freqs=(55.0,))
+    vocals = 0.2 * tone(seconds, freqs=(440.0, 659.25)) + 0.02 * noise(seconds)
+    return {"drums": drums, "bass": bass, "melody": melody, "vocals": vocals}
+
+
+def register_video(seconds: float) -> str:
+    video_id = f"bench{int(seconds):06d}"
+    FakeYoutubeDL.videos[video_id] = seconds
+    return video_id
+
+
+# --- Measurement -----------------------------------------------------------
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def measure(fn, *args, **kwargs):
+    """Run fn once; return (result, stats).
+
+    Stats are wall and process CPU seconds, the peak of Python/NumPy
+    allocations during the call (tracemalloc; torch allocations aren't
+    traced) and the process RSS high-water mark afterwards.
+    """
+    gc.collect()
+    tracemalloc.start()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, {
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "alloc_peak_mb": round(traced_peak / (1024 * 1024), 1),
+        "rss_peak_mb": peak_rss_mb(),
+    }
+
+
+def run_stage(results: dict, name: str, fn, *args, **kwargs):
+    print(f"  {name}...", end=" ", flush=True)
+    try:
+        # The pipeline's own progress prints would interleave with the report
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            result, stats = measure(fn, *args, **kwargs)
+    except Exception as e:
+        print(f"failed: {e}")
+        results[name] = {"error": str(e)}
+        return None
+    print(f"{stats['wall_s']:.3f}s")
+    results[name] = stats
+    return result
+
+
+# --- Benchmarks ------------------------------------------------------------
+
+def bench_stages(seconds: float, workdir: Path, args) -> dict:
+    """Time each stage of the pipeline on `seconds` of synthetic audio."""
+    import splitter
+    from analysis import StemAnalysis
+    from audio_io import decode_audio
+    from converter import download_yt_audio, download_yt_to_mp3, metadata_cache, preflight
+    from peaks import compute_peaks
+
+    results = {}
+    workdir.mkdir(parents=True, exist_ok=True)
+    url = FakeYoutubeDL.video_url(register_video(seconds))
+    sr = splitter.MODEL_SAMPLERATE
+
+    with offline_youtube():
+        metadata_cache.entries.clear()
+        run_stage(results, "preflight", preflight, url, max_duration=10 ** 6)
+        source = run_stage(results, "download", download_yt_audio, url, str(workdir), max_duration=10 ** 6)
+        # download_yt_to_mp3 removes its source, so give it its own folder
+        (workdir / "mp3").mkdir(exist_ok=True)
+        run_stage(results, "transcode_mp3", download_yt_to_mp3, url, str(workdir / "mp3" / "song.mp3"), max_duration=10 ** 6)
+    if source is None:
+        return results
+    audio = run_stage(results, "decode", decode_audio, source[0], sr, splitter.MODEL_CHANNELS)
+
+    stems = None
+    if not args.skip_model and audio is not None:
+        splitter.SEGMENT, splitter.OVERLAP = args.segment, args.overlap
+        run_stage(results, "model_load", splitter.load_model, args.model, "cpu")
+        separated = run_stage(results, "separate", splitter.separate_stems, model_name=args.model, device="cpu", progress=False, audio=audio)
+        if separated is not None:
+            stems = separated["stems"]
+    if stems is None:
+        stems = synthetic_stems(seconds)
+
+    run_stage(results, "lowpass_filter", splitter.lowpass_filter, stems["bass"], cutoff=splitter.BASS_CUTOFF, fs=sr, order=6)
+    run_stage(results, "spectral_gate", splitter.spectral_gate, stems["melody"], stems["vocals"] + stems["drums"], sr, threshold=splitter.GATE_THRESHOLD)
+    run_stage(results, "bpm", splitter.detect_bpm_from_array, stems["drums"], sr)
+    run_stage(results, "key", splitter.detect_key_from_audio, stems["melody"], sr)
+
+    def shared_analysis():
+        analysis = StemAnalysis(stems, sr)
+        analysis.gate("melody", ("vocals", "drums"), splitter.GATE_THRESHOLD)
+        analysis.bpm("drums")
+        analysis.key("melody")
+
+    run_stage(results, "shared_analysis", shared_analysis)
+    wav_path = workdir / "stem.wav"
+    run_stage(results, "wav_write", sf.write, str(wav_path), stems["drums"], sr)
+    run_stage(results, "embed_bpm", splitter.embed_bpm_in_wav, str(wav_path), 128.0)
+    run_stage(results, "wav_write_tagged", splitter.write_wav, str(wav_path), stems["drums"], sr, 128.0)
+    run_stage(results, "peaks", compute_peaks, stems["drums"], sr)
+
+    separated = {"stems": stems, "full": sum(stems.values()), "samplerate": sr}
+    run_stage(results, "postprocess_total", splitter.postprocess_stems, separated, str(workdir / "out"), "song")
+    return results
+
+
+@contextlib.contextmanager
+def offline_app(seconds: float, workdir: Path, args):
+    """The FastAPI app with YouTube (and, with --skip-model, Demucs) stood in; yields a TestClient."""
+    from fastapi.testclient import TestClient
+
+    # main.py resolves its folders relative to the working directory
+    cwd = os.getcwd()
+    workdir.mkdir(parents=True, exist_ok=True)
+    (workdir / "static").mkdir(exist_ok=True)
+    (workdir / "templates").mkdir(exist_ok=True)
+    os.chdir(workdir)
+    try:
+        with offline_youtube():
+            # Read when main starts its worker processes
+            os.environ["PRELOAD_MODEL"] = "" if args.skip_model else args.model
+            import main
+            if args.skip_model:
+                import pipeline
+                def fake_separate(job):
+                    job["separated"] = {"stems": synthetic_stems(seconds), "full": job.pop("audio").mean(0), "samplerate": SAMPLERATE}
+                main.scheduler.stages["separate"].func = fake_separate
+                # Previews would need the model too
+                main.scheduler.stages["preview"].func = lambda job: None
+                pipeline.separate_stage = fake_separate
+            yield TestClient(main.app)
+    finally:
+        os.chdir(cwd)
+
+
+def bench_queue(jobs: int, seconds: float, workdir: Path, args) -> dict:
+    """End-to-end throughput of `jobs` submissions through the FastAPI app."""
+    with offline_app(seconds, workdir, args) as client:
+        start = time.perf_counter()
+        job_ids = []
+        for i in range(jobs):
+            video_id = f"queue{i:06d}"
+            FakeYoutubeDL.videos[video_id] = seconds
+            response = client.post("/start", data={"url": FakeYoutubeDL.video_url(video_id), "name": f"bench{i}"})
+            job_ids.append(response.json()["job_id"])
+        remaining = set(job_ids)
+        errors = 0
+        deadline = start + args.queue_timeout
+        while remaining and time.perf_counter() < deadline:
+            for job_id in list(remaining):
+                status = client.get(f"/status/{job_id}").json()["status"]
+                if status in ("done", "error"):
+                    remaining.discard(job_id)
+                    errors += status == "error"
+            time.sleep(0.05)
+        wall = time.perf_counter() - start
+
+    return {
+        "jobs": jobs,
+        "track_seconds": seconds,
+        "wall_s": round(wall, 3),
+        "jobs_per_minute": round(60 * (jobs - len(remaining)) / wall, 2),
+        "errors": errors,
+        "timed_out": len(remaining),
+    }
+
+
+def bench_bulk(tracks: int, seconds: float, workdir: Path, args) -> dict:
+    """A playlist of `tracks` (plus one unavailable video) through /bulk, then resubmitted.
+
+    Times the submission itself (flat expansion and concurrent pre-flight)
+    and the whole batch, and checks the resubmission skips every track.
+    """
+    list_id = f"PLbench{tracks}"
+    FakeYoutubeDL.playlists[list_id] = [f"bulk{i:07d}" for i in range(tracks)] + ["deleted0000"]
+    for video_id in FakeYoutubeDL.playlists[list_id][:tracks]:
+        FakeYoutubeDL.videos[video_id] = seconds
+    url = FakeYoutubeDL.playlist_url(list_id)
+
+    with offline_app(seconds, workdir, args) as client:
+        start = time.perf_counter()
+        batch = client.post("/bulk", data={"urls": url}).json()
+        submit = time.perf_counter() - start
+        deadline = start + args.queue_timeout
+        while not batch["complete"] and time.perf_counter() < deadline:
+            time.sleep(0.1)
+            batch = client.get(f"/batch/{batch['batch_id']}").json()
+        wall = time.perf_counter() - start
+        again = client.post("/bulk", data={"urls": url}).json()
+
+    return {
+        "tracks": tracks,
+        "track_seconds": seconds,
+        "submit_s": round(submit, 3),
+        "wall_s": round(wall, 3),
+        "counts": batch["counts"],
+        "rejected": len(batch["rejected"]),
+        "skipped_on_resubmit": len(again["skipped"]),
+        "complete": batch["complete"],
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Stages whose wall time grew by more than `threshold` (e.g. 0.2 = 20%)."""
+    regressions = []
+    for duration, stages in results.get("stages", {}).items():
+        for stage, stats in stages.items():
+            old = baseline.get("stages", {}).get(duration, {}).get(stage, {})
+            if "wall_s" in stats and old.get("wall_s"):
+                ratio = stats["wall_s"] / old["wall_s"]
+                if ratio > 1 + threshold:
+                    regressions.append(f"{stage} @ {duration}s: {old['wall_s']:.3f}s -> {stats['wall_s']:.3f}s ({ratio:.2f}x)")
+    old_queue = baseline.get("queue", {}).get("jobs_per_minute")
+    new_queue = results.get("queue", {}).get("jobs_per_minute")
+    if old_queue and new_queue is not None and new_queue < old_queue / (1 + threshold):
+        regressions.append(f"queue throughput: {old_queue} -> {new_queue} jobs/min")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the YouTube → stems pipeline")
+    parser.add_argument("--durations", type=float, nargs="+", default=[10, 60], help="Synthetic track lengths in seconds")
+    parser.add_argument("--model", default="mdx_extra_q")
+    parser.add_argument("--segment", type=float, default=8)
+    parser.add_argument("--overlap", type=float, default=0.05)
+    parser.add_argument("--skip-model", action="store_true", help="Don't run Demucs (post-processing uses synthetic stems)")
+    parser.add_argument("--queue-jobs", type=int, default=3, help="Jobs for the end-to-end queue benchmark (0 to skip)")
+    parser.add_argument("--queue-seconds", type=float, default=10, help="Track length for queue jobs")
+    parser.add_argument("--queue-timeout", type=float, default=1800)
+    parser.add_argument("--bulk-tracks", type=int, default=0, help="Playlist length for the /bulk benchmark (0 to skip)")
+    parser.add_argument("--no-warmup", action="store_true", help="Include one-off costs (imports, numba compilation) in the first run")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="Earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown before a stage counts as a regression")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="stems_bench_"))
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "model": None if args.skip_model else args.model,
+            "segment": args.segment,
+            "overlap": args.overlap,
+        },
+        "stages": {},
+    }
+    try:
+        if not args.no_warmup:
+            print("Warming up (librosa compiles its numba kernels on first use)...")
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                bench_stages(2, workdir / "warmup", args)
+        for seconds in args.durations:
+            print(f"Stages on {seconds:g}s of audio:")
+            results["stages"][f"{seconds:g}"] = bench_stages(seconds, workdir / f"stages_{seconds:g}", args)
+        if args.queue_jobs:
+            print(f"Queue throughput ({args.queue_jobs} jobs of {args.queue_seconds:g}s)...")
+            results["queue"] = bench_queue(args.queue_jobs, args.queue_seconds, workdir / "queue", args)
+            print(f"  {results['queue']['jobs_per_minute']} jobs/min")
+        if args.bulk_tracks:
+            print(f"Bulk ingestion ({args.bulk_tracks} track playlist of {args.queue_seconds:g}s tracks)...")
+            results["bulk"] = bench_bulk(args.bulk_tracks, args.queue_seconds, workdir / "queue", args)
+            print(f"  submitted in {results['bulk']['submit_s']}s, batch done in {results['bulk']['wall_s']}s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        regressions = compare(results, json.loads(Path(args.baseline).read_text()), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION: {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%}")
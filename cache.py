@@ -0,0 +1,179 @@
+# cache.py
+# Content-addressed cache of finished stems so repeat URLs skip download and separation
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from peaks import peaks_path
+
+
+def cache_key(video_id: str, params: dict) -> str:
+    """Stable key for a video separated with the given settings."""
+    payload = json.dumps({"video_id": video_id, **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def link_or_copy(src: Path, dst: Path):
+    """Hardlink src to dst, copying only when the filesystem can't link."""
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultCache:
+    """Finished jobs stored by cache key, evicted least-recently-used by size.
+
+    Each entry is a directory holding the job's output files with the song
+    name stripped (e.g. `[drums].wav`), their waveform peaks, and an
+    `entry.json` with BPM and key. Files are hardlinked in and out, so a hit
+    costs a few metadata operations and no audio is copied. The mtime of `entry.json` records the last hit so
+    LRU order survives restarts.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = {}  # key -> {"size": bytes, "atime": last access}
+        for entry_dir in self.root.iterdir():
+            meta = entry_dir / "entry.json"
+            if not entry_dir.name.startswith(".") and meta.exists():
+                self.entries[entry_dir.name] = {
+                    "size": sum(f.stat().st_size for f in entry_dir.iterdir() if f.is_file()),
+                    "atime": meta.stat().st_mtime,
+                }
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """Return the entry metadata for a hit, counting hits and misses."""
+        with self.lock:
+            meta_path = self.root / key / "entry.json"
+            if key not in self.entries or not meta_path.exists():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key]["atime"] = time.time()
+            os.utime(meta_path)
+            return json.loads(meta_path.read_text())
+
+    def materialize(self, key: str, song_dir: Path, song_name: str) -> Optional[dict]:
+        """Link a cached result into song_dir under song_name.
+
+        Returns the entry metadata plus the created `paths`, or None on a miss.
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return None
+        song_dir.mkdir(parents=True, exist_ok=True)
+        paths = []
+        try:
+            for suffix in entry["files"]:
+                dst = song_dir / f"{song_name}{suffix}"
+                link_or_copy(self.root / key / suffix, dst)
+                paths.append(str(dst))
+                cached_peaks = peaks_path(self.root / key / suffix)
+                if cached_peaks.exists():
+                    peaks_path(dst).parent.mkdir(exist_ok=True)
+                    link_or_copy(cached_peaks, peaks_path(dst))
+        except FileNotFoundError:
+            # Entry was damaged or evicted underneath us
+            self.discard(key)
+            return None
+        return {**entry, "paths": paths}
+
+    def store(self, key: str, paths: List[str], song_name: str, bpm: float, key_name: str, video_id: str = None):
+        """Add a finished job's files to the cache and evict if over budget."""
+        entry_dir = self.root / key
+        tmp_dir = self.root / f".{key}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        files = []
+        size = 0
+        for path in paths:
+            path = Path(path)
+            if not path.name.startswith(song_name):
+                continue
+            suffix = path.name[len(song_name):]
+            link_or_copy(path, tmp_dir / suffix)
+            files.append(suffix)
+            size += path.stat().st_size
+            if peaks_path(path).exists():
+                peaks_path(tmp_dir / suffix).parent.mkdir(exist_ok=True)
+                link_or_copy(peaks_path(path), peaks_path(tmp_dir / suffix))
+        (tmp_dir / "entry.json").write_text(json.dumps({
+            "video_id": video_id,
+            "files": files,
+            "bpm": bpm,
+            "key": key_name,
+            "created": time.time(),
+        }))
+
+        with self.lock:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            tmp_dir.rename(entry_dir)
+            self.entries[key] = {"size": size, "atime": time.time()}
+            self._evict()
+
+    def replace_file(self, key: str, suffix: str, new_path: Path):
+        """Swap a cached file (e.g. `[drums].wav`) for new_path, the same audio re-encoded.
+
+        The entry keeps its place in the LRU order.
+        """
+        with self.lock:
+            entry_dir = self.root / key
+            meta_path = entry_dir / "entry.json"
+            if key not in self.entries or not meta_path.exists():
+                return
+            meta = json.loads(meta_path.read_text())
+            new_suffix = suffix[:len(suffix) - len(Path(suffix).suffix)] + new_path.suffix
+            link_or_copy(new_path, entry_dir / new_suffix)
+            if peaks_path(new_path).exists():
+                peaks_path(entry_dir / new_suffix).parent.mkdir(exist_ok=True)
+                link_or_copy(peaks_path(new_path), peaks_path(entry_dir / new_suffix))
+            peaks_path(entry_dir / suffix).unlink(missing_ok=True)
+            (entry_dir / suffix).unlink(missing_ok=True)
+            meta["files"] = [new_suffix if name == suffix else name for name in meta["files"]]
+            atime = meta_path.stat().st_mtime
+            meta_path.write_text(json.dumps(meta))
+            os.utime(meta_path, (atime, atime))
+            self.entries[key]["size"] = sum(f.stat().st_size for f in entry_dir.iterdir() if f.is_file())
+
+    def discard(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+            shutil.rmtree(self.root / key, ignore_errors=True)
+
+    def _evict(self):
+        # Caller holds the lock
+        total = sum(entry["size"] for entry in self.entries.values())
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["atime"]):
+            if total <= self.max_bytes:
+                break
+            total -= self.entries.pop(key)["size"]
+            shutil.rmtree(self.root / key, ignore_errors=True)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": sum(entry["size"] for entry in self.entries.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
@@ -1,35 +1,76 @@
 # converter.py
 # Converts YouTube URL to MP3 files
 import os
+import re
+import time
 import argparse
-from typing import Tuple, Optional
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Optional
 
 import yt_dlp
-from pydub import AudioSegment
 
+from audio_io import transcode
+from metrics import timed
+
+
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})'
+)
+
+
+PLAYLIST_ID_RE = re.compile(r'[?&]list=([A-Za-z0-9_-]+)')
+# Characters that can't appear in the folder and file names built from a track name
+UNSAFE_NAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]+')
+
+
+def resolve_video_id(url: str) -> Optional[str]:
+    """Video ID from a YouTube URL without touching the network, or None."""
+    match = YOUTUBE_ID_RE.search(url)
+    return match.group(1) if match else None
 
-def download_yt_to_mp3(
-    url: str,
-    output_path: str,
-    max_duration: int = 360,  # 6 minutes in seconds
-) -> Tuple[str, int]:
 
+class MetadataCache:
+    """Resolved video metadata by video ID, for `ttl` seconds.
 
-    temp_template = os.path.join(os.path.dirname(output_path), 'temp_yt_%(id)s')
-    video_id = None
+    The info dicts include signed stream URLs, which YouTube expires after a
+    few hours, so entries must not outlive them.
+    """
 
-    ydl_opts = {
+    def __init__(self, ttl: float = 1800, max_entries: int = 256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # video_id -> (expires_at, info)
+        self.lock = threading.Lock()
+
+    def get(self, video_id: str) -> Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[video_id]
+                return None
+            self.entries.move_to_end(video_id)
+            return entry[1]
+
+    def put(self, video_id: str, info: dict):
+        with self.lock:
+            self.entries[video_id] = (time.monotonic() + self.ttl, info)
+            self.entries.move_to_end(video_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+metadata_cache = MetadataCache()
+
+
+def ydl_options(outtmpl: str = None) -> dict:
+    options = {
         'format': 'bestaudio/best',
-        'outtmpl': temp_template,
         'quiet': True,
         'noplaylist': True,
         'no_warnings': False,
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-            'nopostoverwrites': True,
-        }],
         'extractor_args': {
             'youtube': {
                 'player_client': ['web', 'mweb', 'android'],  
@@ -38,36 +79,137 @@ def download_yt_to_mp3(
         },
         'extractor_args': {'youtube': {'js_runtime': 'node'}},
     }
+    if outtmpl:
+        options['outtmpl'] = outtmpl
+    return options
+
+
+def fetch_info(url: str) -> dict:
+    """Resolve a video's metadata without downloading it (cached by video ID)."""
+    video_id = resolve_video_id(url)
+    info = metadata_cache.get(video_id) if video_id else None
+    if info is not None:
+        return info
+    with timed("preflight"), yt_dlp.YoutubeDL(ydl_options()) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if info.get('id'):
+        metadata_cache.put(info['id'], info)
+    return info
+
+
+def is_playlist(url: str) -> bool:
+    """True for playlist pages; a video link that carries a list= stays a single video."""
+    return bool(PLAYLIST_ID_RE.search(url)) and resolve_video_id(url) is None
 
+
+def expand_playlist(url: str, limit: int = 200) -> Tuple[str, List[dict]]:
+    """(playlist title, entries) of a playlist, without resolving each video.
+
+    Flat extraction reads only the playlist pages, so a 40-track playlist
+    costs a request or two; each entry has at least a `url` and usually
+    `id`, `title` and `duration`.
+    """
+    options = {**ydl_options(), 'noplaylist': False, 'extract_flat': 'in_playlist', 'playlistend': limit}
+    try:
+        with timed("preflight"), yt_dlp.YoutubeDL(options) as ydl:
+            info = ydl.extract_info(url, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        raise ValueError(f"Couldn't resolve playlist: {e}")
+    entries = []
+    for entry in list(info.get('entries') or [])[:limit]:
+        if not entry:
+            continue  # Deleted or private videos
+        entry_url = entry.get('url') or entry.get('id')
+        if entry_url and not re.match(r'https?://', entry_url):
+            entry_url = f"https://www.youtube.com/watch?v={entry_url}"
+        if entry_url:
+            entries.append({**entry, 'url': entry_url})
+    return info.get('title') or 'Playlist', entries
+
+
+def track_name(title: str, fallback: str = "track") -> str:
+    """A video title made safe to use as a job's song name."""
+    name = UNSAFE_NAME_RE.sub(" ", title or "").strip(" .")
+    return " ".join(name.split())[:120] or fallback
+
+
+def preflight(url: str, max_duration: int = 360) -> dict:
+    """Check a URL can be processed before anything is downloaded.
+
+    Raises ValueError for invalid, unavailable, live or over-length videos;
+    returns the info dict for download_yt_audio otherwise.
+    """
+    if not re.match(r'https?://', url.strip()):
+        raise ValueError("Invalid URL.")
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            video_id = info.get('id')
-            title = info.get('title', 'Unknown')
-            duration = info.get('duration', 0)
+        info = fetch_info(url.strip())
+    except yt_dlp.utils.DownloadError as e:
+        raise ValueError(f"Couldn't resolve video: {e}")
+    if info.get('_type') == 'playlist':
+        raise ValueError("Playlists aren't supported, submit a single video.")
+    if info.get('is_live'):
+        raise ValueError("Live streams aren't supported.")
+    duration = info.get('duration') or 0
+    if duration > max_duration:
+        raise ValueError(f"Video too long: {duration//60}m > {max_duration//60}m limit.")
+    return info
 
-            if duration > max_duration:
-                raise ValueError(f"Video too long: {duration//60}m > 6m limit.")
 
-        temp_mp3 = f"{temp_template.replace('%(id)s', video_id)}.mp3"
-        if not os.path.exists(temp_mp3):
-            raise RuntimeError("MP3 not created.")
+def download_yt_audio(
+    url: str,
+    output_dir: str,
+    max_duration: int = 360,  # 6 minutes in seconds
+    info: dict = None,
+) -> Tuple[str, str, int, str]:
+    """Download the best audio stream as-is, without re-encoding it.
 
-        final_audio = AudioSegment.from_file(temp_mp3)
-        final_audio.export(output_path, format="mp3", bitrate="192k")
-        print(f"Downloaded: {os.path.basename(output_path)} ({duration}s)")
+    Returns (path, title, duration, video_id). The file keeps the stream's
+    own container (webm/m4a/...), so it can be decoded exactly once later.
+    `info` is the result of `preflight`; without it the pre-flight runs
+    here, so over-length videos are still rejected before downloading.
+    """
+    if info is None:
+        info = preflight(url, max_duration)
+    temp_template = os.path.join(output_dir, 'temp_yt_%(id)s.%(ext)s')
 
-    except Exception as e:
-        raise e
+    with timed("download"), yt_dlp.YoutubeDL(ydl_options(temp_template)) as ydl:
+        # Reuses the resolved formats instead of extracting the page again
+        info = ydl.process_ie_result(dict(info), download=True)
+        video_id = info.get('id')
+        title = info.get('title', 'Unknown')
+        duration = info.get('duration', 0)
+        downloads = info.get('requested_downloads') or [{}]
+        path = downloads[0].get('filepath') or ydl.prepare_filename(info)
+
+    # Only reached when the pre-flight couldn't see a duration
+    if duration and duration > max_duration:
+        if os.path.exists(path):
+            os.remove(path)
+        raise ValueError(f"Video too long: {duration//60}m > {max_duration//60}m limit.")
+    if not os.path.exists(path):
+        raise RuntimeError("Audio not downloaded.")
+
+    print(f"Downloaded: {os.path.basename(path)} ({duration}s)")
+    return path, title, duration, video_id
+
+
+def download_yt_to_mp3(
+    url: str,
+    output_path: str,
+    max_duration: int = 360,  # 6 minutes in seconds
+    info: dict = None,
+) -> Tuple[str, int, str]:
+    """Download a video's audio and encode it to MP3 once."""
+    source, title, duration, video_id = download_yt_audio(url, os.path.dirname(output_path), max_duration, info)
+    try:
+        with timed("encoding"):
+            transcode(source, output_path, bitrate="192k")
     finally:
-        if video_id:
-            for ext in ['.mp3', '.webm', '.m4a', '.opus']:
-                f = f"{temp_template.replace('%(id)s', video_id)}{ext}"
-                if os.path.exists(f):
-                    try: os.remove(f)
-                    except: pass
-
-    return title, duration
+        if os.path.exists(source):
+            try: os.remove(source)
+            except: pass
+    print(f"Converted: {os.path.basename(output_path)}")
+    return title, duration, video_id
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+# delivery.py
+# Serves output files: cacheable, seekable downloads and ZIP bundles streamed straight from disk
+import hashlib
+import os
+import struct
+import time
+import zipfile
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+import soundfile as sf
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+
+# Finished stems never change under the same URL, so browsers may keep them
+# this long before revalidating. Previews are replaced, so always revalidate.
+DOWNLOAD_MAX_AGE = int(os.environ.get("DOWNLOAD_MAX_AGE", 7 * 24 * 3600))
+ZIP_CHUNK_SIZE = 1024 * 1024
+DECODE_BLOCK_FRAMES = 1 << 16
+
+
+def file_etag(stat: os.stat_result) -> str:
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """Whether the client's cached copy (If-None-Match, else If-Modified-Since) is current."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def cache_headers(etag: str, mtime: float, max_age: int) -> dict:
+    return {
+        "ETag": etag,
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Cache-Control": f"private, max-age={max_age}" if max_age else "no-cache",
+    }
+
+
+def file_response(request: Request, path: Path, filename: str = None, max_age: int = DOWNLOAD_MAX_AGE,
+                  media_type: str = None) -> Response:
+    """A download with an ETag, 304s for conditional requests and Range support.
+
+    Range, multi-range and If-Range requests are answered by Starlette's
+    FileResponse; this adds the validators and the 304 path.
+    """
+    try:
+        stat = path.stat()
+    except OSError:
+        stat = None
+    if stat is None or not path.is_file():
+        return JSONResponse({"error": "File not found"}, status_code=404)
+    etag = file_etag(stat)
+    headers = cache_headers(etag, stat.st_mtime, max_age)
+    if not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, filename=filename, media_type=media_type, headers=headers, stat_result=stat)
+
+
+def reencoded_source(path: Path) -> Optional[Path]:
+    """The FLAC a missing WAV stem was re-encoded to (see lifecycle.py), if any."""
+    if path.suffix.lower() != ".wav" or path.is_file():
+        return None
+    flac = path.with_suffix(".flac")
+    return flac if flac.is_file() else None
+
+
+def wav_header(frames: int, channels: int, samplerate: int) -> bytes:
+    """Header of a 16-bit PCM WAV holding the given number of frames."""
+    data_size = frames * channels * 2
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, channels,
+        samplerate, samplerate * channels * 2, channels * 2, 16, b"data", data_size,
+    )
+
+
+def decoded_wav_stream(source: Path) -> Iterator[bytes]:
+    with sf.SoundFile(str(source)) as f:
+        yield wav_header(f.frames, f.channels, f.samplerate)
+        for block in f.blocks(DECODE_BLOCK_FRAMES, dtype="int16"):
+            yield block.tobytes()
+
+
+def decoded_wav_response(request: Request, source: Path, filename: str = None, max_age: int = DOWNLOAD_MAX_AGE) -> Response:
+    """A WAV decoded on the fly from a lossless source, for URLs handed out before it was re-encoded.
+
+    The length is known up front, so players still see the size, but there
+    is no Range support: the stems' current URLs point at the source itself.
+    """
+    stat = source.stat()
+    etag = file_etag(stat)[:-1] + '-wav"'
+    headers = cache_headers(etag, stat.st_mtime, max_age)
+    if not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    info = sf.info(str(source))
+    headers["Content-Length"] = str(44 + info.frames * info.channels * 2)
+    headers["Accept-Ranges"] = "none"
+    if filename:
+        headers["Content-Disposition"] = content_disposition(filename)
+    if request.method == "HEAD":
+        return Response(media_type="audio/wav", headers=headers)
+    return StreamingResponse(decoded_wav_stream(source), media_type="audio/wav", headers=headers)
+
+
+def stem_response(request: Request, path: Path, filename: str = None, max_age: int = DOWNLOAD_MAX_AGE) -> Response:
+    """file_response for job files, decoding WAV stems that were re-encoded to FLAC since."""
+    source = reencoded_source(path)
+    if source is not None:
+        return decoded_wav_response(request, source, filename=filename, max_age=max_age)
+    return file_response(request, path, filename=filename, max_age=max_age)
+
+
+def content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+class ZipSink:
+    """Write-only file object zipfile writes into; the stream drains it as it goes.
+
+    It has no tell()/seek(), so zipfile writes data descriptors after each
+    member instead of seeking back to patch the local headers.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zip_stream(members: Iterable[Tuple[str, Path]]) -> Iterator[bytes]:
+    """Yield a ZIP of (name in archive, file) pairs, holding at most one chunk in memory.
+
+    Members are stored uncompressed: WAV barely compresses and MP3 not at
+    all, and storing keeps the stream as fast as reading the disk.
+    """
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for arcname, path in members:
+            info = zipfile.ZipInfo(arcname, date_time=time.localtime(path.stat().st_mtime)[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, "rb") as source, archive.open(info, "w", force_zip64=True) as dest:
+                while True:
+                    block = source.read(ZIP_CHUNK_SIZE)
+                    if not block:
+                        break
+                    dest.write(block)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def bundle_files(folder: Path) -> List[Path]:
+    """The files a job's bundle holds: everything in its song folder, no previews or peaks."""
+    return sorted(path for path in folder.iterdir() if path.is_file()) if folder.is_dir() else []
+
+
+def zip_response(request: Request, files: List[Path], archive_name: str) -> Response:
+    """Stream files as <archive_name>.zip, with their folder named after the archive.
+
+    The ETag is derived from the members' sizes and mtimes, so an unchanged
+    bundle revalidates without being rebuilt.
+    """
+    stats = [path.stat() for path in files]
+    etag = '"' + hashlib.md5("".join(map(file_etag, stats)).encode()).hexdigest() + '"'
+    mtime = max((stat.st_mtime for stat in stats), default=0)
+    headers = cache_headers(etag, mtime, DOWNLOAD_MAX_AGE)
+    if not_modified(request, etag, mtime):
+        return Response(status_code=304, headers=headers)
+    headers["Content-Disposition"] = content_disposition(f"{archive_name}.zip")
+    members = [(f"{archive_name}/{path.name}", path) for path in files]
+    return StreamingResponse(zip_stream(members), media_type="application/zip", headers=headers)
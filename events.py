@@ -0,0 +1,74 @@
+# events.py
+# Fans job events out to Server-Sent Events subscribers
+import asyncio
+import json
+import threading
+import time
+
+
+class EventBroker:
+    """Publishes job events from worker threads to every connected client.
+
+    Worker threads call `publish`; each `/events` connection owns an asyncio
+    queue that is fed on the server's event loop. Nothing is sent unless
+    something changed, so idle clients cost nothing.
+    """
+
+    def __init__(self, max_pending: int = 1000):
+        self.loop = None
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.max_pending = max_pending
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+    def publish(self, event_type: str, data: dict):
+        if self.loop is None:
+            return
+        message = format_sse(event_type, data)
+        try:
+            self.loop.call_soon_threadsafe(self._fanout, message)
+        except RuntimeError:
+            pass  # Event loop already closed (shutdown)
+
+    def _fanout(self, message: str):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            if q.qsize() < self.max_pending:
+                q.put_nowait(message)
+
+    def subscribe(self) -> asyncio.Queue:
+        q = asyncio.Queue()
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue):
+        with self.lock:
+            self.subscribers.discard(q)
+
+
+def format_sse(event_type: str, data: dict) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+class ProgressThrottle:
+    """Drops progress updates that are too small or too soon to be worth sending."""
+
+    def __init__(self, min_step: float = 0.01, min_interval: float = 0.25):
+        self.min_step = min_step
+        self.min_interval = min_interval
+        self.last_value = None
+        self.last_time = 0.0
+
+    def ready(self, value: float) -> bool:
+        now = time.monotonic()
+        if self.last_value is not None and value < 1.0 and (
+            abs(value - self.last_value) < self.min_step or now - self.last_time < self.min_interval
+        ):
+            return False
+        self.last_value = value
+        self.last_time = now
+        return True
@@ -0,0 +1,118 @@
+# fake_youtube.py
+# Offline stand-in for yt_dlp.YoutubeDL serving synthetic audio, used by the tests and benchmark.py
+import contextlib
+
+import numpy as np
+import soundfile as sf
+
+SAMPLERATE = 44100
+
+
+def synthetic_audio(seconds: float, sr: int = SAMPLERATE) -> np.ndarray:
+    """Stereo (frames, 2) A minor chord with a click on every beat at 120 BPM."""
+    t = np.arange(int(seconds * sr)) / sr
+    chord = sum(np.sin(2 * np.pi * f * t) for f in (220.0, 261.63, 329.63)) / 3
+    clicks = np.exp(-40 * (t % 0.5)) * np.sin(2 * np.pi * 1000 * t)
+    mono = (0.3 * chord + 0.3 * clicks).astype(np.float32)
+    return np.stack([mono, 0.9 * mono], axis=1)
+
+
+class FakeYoutubeDL:
+    """Serves synthetic audio for URLs of registered video IDs.
+
+    Implements the small part of the yt_dlp.YoutubeDL interface that
+    converter.py uses. Register videos with `FakeYoutubeDL.videos[id] = seconds`;
+    IDs must be 11 characters like real YouTube IDs. Playlists are
+    `FakeYoutubeDL.playlists[list_id] = [video IDs]` and may list IDs that
+    aren't registered, like deleted videos in a real playlist, or None for
+    entries yt-dlp can't read at all. IDs in `live` are reported as live
+    streams, and every URL extracted is appended to `extracted`.
+    """
+
+    videos = {}
+    playlists = {}
+    live = set()
+    extracted = []
+
+    def __init__(self, opts: dict):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def video_url(video_id: str) -> str:
+        return f"https://www.youtube.com/watch?v={video_id}"
+
+    @staticmethod
+    def playlist_url(list_id: str) -> str:
+        return f"https://www.youtube.com/playlist?list={list_id}"
+
+    def extract_info(self, url: str, download: bool = True) -> dict:
+        from converter import PLAYLIST_ID_RE, resolve_video_id
+        self.extracted.append(url)
+        video_id = resolve_video_id(url)
+        list_match = PLAYLIST_ID_RE.search(url)
+        if list_match and (video_id is None or not self.opts.get("noplaylist")):
+            return self.extract_playlist(list_match.group(1), download)
+        return self.extract_video(video_id, url, download)
+
+    def extract_video(self, video_id: str, url: str, download: bool) -> dict:
+        import yt_dlp
+        if video_id not in self.videos:
+            raise yt_dlp.utils.DownloadError(f"Video unavailable: {url}")
+        info = {
+            "id": video_id, "title": f"Synthetic {video_id}", "duration": int(self.videos[video_id]),
+            "ext": "wav", "is_live": video_id in self.live,
+        }
+        return self.process_ie_result(info, download)
+
+    def extract_playlist(self, list_id: str, download: bool) -> dict:
+        import yt_dlp
+        if list_id not in self.playlists:
+            raise yt_dlp.utils.DownloadError(f"Playlist unavailable: {list_id}")
+        video_ids = self.playlists[list_id][:self.opts.get("playlistend")]
+        if self.opts.get("extract_flat"):
+            # Only what the playlist page lists; deleted videos still appear
+            entries = [
+                {"_type": "url", "id": video_id, "url": self.video_url(video_id), "title": f"Synthetic {video_id}",
+                 "duration": self.videos.get(video_id)} if video_id else None
+                for video_id in video_ids
+            ]
+        else:
+            # Every entry resolved (and downloaded); like yt-dlp, an
+            # unavailable one fails the playlist unless errors are ignored
+            entries = []
+            for video_id in video_ids:
+                try:
+                    entries.append(self.extract_video(video_id, self.video_url(video_id or ""), download))
+                except yt_dlp.utils.DownloadError:
+                    if not self.opts.get("ignoreerrors"):
+                        raise
+                    entries.append(None)
+        return {"_type": "playlist", "id": list_id, "title": f"Playlist {list_id}", "entries": entries}
+
+    def process_ie_result(self, info: dict, download: bool = True) -> dict:
+        if download:
+            path = self.prepare_filename(info)
+            sf.write(path, synthetic_audio(self.videos[info["id"]]), SAMPLERATE)
+            info["requested_downloads"] = [{"filepath": path}]
+        return info
+
+    def prepare_filename(self, info: dict) -> str:
+        return self.opts["outtmpl"].replace("%(id)s", info["id"]).replace("%(ext)s", info["ext"])
+
+
+@contextlib.contextmanager
+def offline_youtube():
+    """Route converter.py's yt-dlp calls to FakeYoutubeDL."""
+    import converter
+    original = converter.yt_dlp.YoutubeDL
+    converter.yt_dlp.YoutubeDL = FakeYoutubeDL
+    try:
+        yield FakeYoutubeDL
+    finally:
+        converter.yt_dlp.YoutubeDL = original
@@ -0,0 +1,382 @@
+# inference.py
+# CPU inference backends for Demucs: int8, TorchScript, ONNX Runtime and batched segments
+import argparse
+import copy
+import inspect
+import json
+import os
+import random
+import time
+import warnings
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import julius
+import numpy as np
+import torch
+from torch import nn
+from demucs.apply import BagOfModels, TensorChunk, apply_model, tensor_chunk
+from demucs.demucs import Demucs
+from demucs.utils import center_trim
+
+from settings import INFERENCE_BACKEND, INFERENCE_BATCH
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+BACKENDS = ("fp32", "int8", "torchscript", "onnx")
+COMPILED_BACKENDS = ("torchscript", "onnx")
+
+# Deployment settings. INFERENCE_BACKEND and INFERENCE_BATCH live in
+# settings.py since they are part of separation_params() (and the cache key).
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0))  # 0: share cores between separation workers
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", 0))  # 0: torch default
+ARTIFACT_DIR = Path(os.environ.get("INFERENCE_CACHE", Path.home() / ".cache" / "yt_to_stems"))
+
+# Older demucs releases can't report per-segment progress
+APPLY_MODEL_HAS_CALLBACK = "callback" in inspect.signature(apply_model).parameters
+
+
+def configure_threads(workers: int = 1) -> int:
+    """Set torch's intra-op (and optionally inter-op) thread pools.
+
+    Without TORCH_THREADS the cores are shared evenly between `workers`
+    concurrent separations. The inter-op pool can only be sized once, before
+    torch first uses it.
+    """
+    threads = TORCH_THREADS or max(1, (os.cpu_count() or 1) // max(1, workers))
+    torch.set_num_threads(threads)
+    if TORCH_INTEROP_THREADS:
+        try:
+            torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+        except RuntimeError as e:
+            print(f"Couldn't set inter-op threads: {e}")
+    return threads
+
+
+def model_options(segment: float, device: str, backend: str = None, batch_size: int = None) -> dict:
+    """Keyword arguments for registry.get selecting the configured backend."""
+    backend = backend or INFERENCE_BACKEND
+    if device != "cpu" or backend == "fp32":
+        return {}
+    if backend not in COMPILED_BACKENDS:
+        return {"backend": backend}
+    # Compiled graphs have a fixed input shape
+    return {"backend": backend, "segment": segment, "batch_size": batch_size or INFERENCE_BATCH}
+
+
+class DemucsCore(nn.Module):
+    """The encoder, LSTM and decoder of a Demucs model: the part worth compiling.
+
+    Normalisation, padding and resampling compute shapes from the input,
+    which tracing can't follow, so CompiledModel keeps them in Python.
+    """
+
+    def __init__(self, model: Demucs):
+        super().__init__()
+        self.encoder = model.encoder
+        self.decoder = model.decoder
+        self.lstm = model.lstm
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        saved = []
+        for encode in self.encoder:
+            x = encode(x)
+            saved.append(x)
+        if self.lstm:
+            x = self.lstm(x)
+        for decode in self.decoder:
+            skip = center_trim(saved.pop(-1), x)
+            x = decode(x + skip)
+        return x
+
+
+class CompiledModel(nn.Module):
+    """Stands in for one Demucs model inside a bag, running a fixed-shape graph.
+
+    Every input is padded to `input_length`, the model's valid length for a
+    full segment, and to `batch_size` rows, so a single compiled graph serves
+    every chunk; apply_model trims the output back to the chunk.
+    """
+
+    def __init__(self, model: Demucs, input_length: int, batch_size: int):
+        super().__init__()
+        self.runner = None
+        self.input_length = input_length
+        self.batch_size = batch_size
+        self.samplerate = model.samplerate
+        self.sources = model.sources
+        self.audio_channels = model.audio_channels
+        self.segment = getattr(model, "segment", None)
+        self.normalize = model.normalize
+        self.resample = model.resample
+        # apply_model reads the device from the first parameter
+        self.anchor = nn.Parameter(torch.zeros(1), requires_grad=False)
+
+    def valid_length(self, length: int) -> int:
+        if length > self.input_length:
+            raise ValueError(f"Compiled for chunks of up to {self.input_length} samples, got {length}")
+        return self.input_length
+
+    def encode_input(self, x: torch.Tensor):
+        """Demucs.forward up to the encoder, for an input of `input_length`."""
+        mean, std = 0, 1
+        if self.normalize:
+            mono = x.mean(dim=1, keepdim=True)
+            mean = mono.mean(dim=-1, keepdim=True)
+            std = mono.std(dim=-1, keepdim=True)
+            x = (x - mean) / (1e-5 + std)
+        if self.resample:
+            x = julius.resample_frac(x, 1, 2)
+        return x, mean, std
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        rows = x.shape[0]
+        if rows < self.batch_size:
+            x = torch.cat([x, x.new_zeros(self.batch_size - rows, *x.shape[1:])])
+        x, mean, std = self.encode_input(x.float())
+        x = self.runner(x)
+        if self.resample:
+            x = julius.resample_frac(x, 2, 1)
+        x = center_trim(x * std + mean, self.input_length)
+        return x.view(x.size(0), len(self.sources), self.audio_channels, x.size(-1))[:rows]
+
+
+def artifact_path(name: str, backend: str, input_length: int, batch_size: int) -> Path:
+    suffix = ".onnx" if backend == "onnx" else ".pt"
+    tag = f"torch{torch.__version__.split('+')[0]}"
+    return ARTIFACT_DIR / f"{name}-{backend}-L{input_length}-B{batch_size}-{tag}{suffix}"
+
+
+def torchscript_runner(model: nn.Module, example: torch.Tensor, path: Path) -> Callable:
+    if not path.exists():
+        print(f"Tracing {path.name} (cached for next time)...")
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            traced = torch.jit.trace(model, example)
+            traced = torch.jit.freeze(traced.eval())
+        path.parent.mkdir(parents=True, exist_ok=True)
+        torch.jit.save(traced, str(path))
+    scripted = torch.jit.load(str(path)).eval()
+
+    def run(x):
+        with torch.no_grad():
+            return scripted(x)
+    return run
+
+
+def onnx_runner(model: nn.Module, example: torch.Tensor, path: Path) -> Callable:
+    if onnxruntime is None:
+        raise RuntimeError("The onnx backend needs onnxruntime: pip install onnxruntime onnx")
+    if not path.exists():
+        print(f"Exporting {path.name} (cached for next time)...")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            torch.onnx.export(model, example, str(path), input_names=["encoded"], output_names=["sources"], opset_version=17)
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    optimized = path.with_suffix(".opt.onnx")
+    if optimized.exists():
+        session = onnxruntime.InferenceSession(str(optimized), options, providers=["CPUExecutionProvider"])
+    else:
+        options.optimized_model_filepath = str(optimized)
+        session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+
+    def run(x):
+        return torch.from_numpy(session.run(None, {"encoded": x.cpu().numpy()})[0])
+    return run
+
+
+def convert(model: nn.Module, name: str, backend: str, segment: float = None, batch_size: int = 1) -> nn.Module:
+    """One Demucs model converted for `backend`."""
+    if backend == "int8":
+        # Dynamic quantization covers the LSTM and linear layers; the
+        # convolutions stay fp32
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    if backend not in COMPILED_BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {BACKENDS}")
+    if not isinstance(model, Demucs):
+        raise ValueError(f"The {backend} backend supports Demucs (v2) models such as mdx_extra_q, not {type(model).__name__}")
+    input_length = model.valid_length(int(model.samplerate * segment))
+    compiled = CompiledModel(model, input_length, batch_size)
+    example, _, _ = compiled.encode_input(torch.zeros(batch_size, model.audio_channels, input_length))
+    path = artifact_path(name, backend, input_length, batch_size)
+    build = torchscript_runner if backend == "torchscript" else onnx_runner
+    compiled.runner = build(DemucsCore(model).eval(), example, path)
+    return compiled
+
+
+def prepare_model(model: nn.Module, model_name: str, backend: str = "fp32", segment: float = None, batch_size: int = 1) -> nn.Module:
+    """Convert a (bag of) Demucs model(s) for a CPU backend; fp32 is returned as is."""
+    if backend == "fp32":
+        return model
+    if not isinstance(model, BagOfModels):
+        return convert(model, model_name, backend, segment, batch_size)
+    converted = [
+        convert(sub_model, f"{model_name}-{i}", backend, segment, batch_size)
+        for i, sub_model in enumerate(model.models)
+    ]
+    return BagOfModels(converted, model.weights)
+
+
+def _split(model: nn.Module, mix, segment: float, overlap: float, batch_size: int, device, on_segment: Callable):
+    """Overlap-add over segments like apply_model's split path, `batch_size` at a time."""
+    mix = tensor_chunk(mix)
+    batch, channels, length = mix.shape
+    segment_length = int(model.samplerate * segment)
+    stride = int((1 - overlap) * segment_length)
+    # The last, shorter chunk gets extra context instead of its own shape
+    input_length = model.valid_length(segment_length)
+    weight = torch.cat([
+        torch.arange(1, segment_length // 2 + 1, device=device),
+        torch.arange(segment_length - segment_length // 2, 0, -1, device=device),
+    ])
+    weight = weight / weight.max()
+
+    out = torch.zeros(batch, len(model.sources), channels, length, device=mix.device)
+    sum_weight = torch.zeros(length, device=mix.device)
+    offsets = list(range(0, length, stride))
+    for start in range(0, len(offsets), batch_size):
+        group = offsets[start:start + batch_size]
+        chunks = [TensorChunk(mix, offset, segment_length) for offset in group]
+        x = torch.cat([chunk.padded(input_length) for chunk in chunks]).to(device)
+        with torch.no_grad():
+            y = model(x)
+        for offset, chunk, chunk_out in zip(group, chunks, y.split(batch)):
+            chunk_out = center_trim(chunk_out, chunk.length)
+            out[..., offset:offset + chunk.length] += (weight[:chunk.length] * chunk_out).to(mix.device)
+            sum_weight[offset:offset + chunk.length] += weight[:chunk.length].to(mix.device)
+            on_segment(offset)
+    return out / sum_weight
+
+
+def apply_batched(
+    model: nn.Module,
+    mix: torch.Tensor,
+    segment: float,
+    overlap: float = 0.25,
+    batch_size: int = 4,
+    shifts: int = 1,
+    device=None,
+    callback: Callable[[dict], None] = None,
+) -> torch.Tensor:
+    """apply_model, running `batch_size` segments per forward pass.
+
+    Keeps apply_model's bag weighting, random time shift and triangular
+    overlap-add, and reports progress through the same callback dicts, so
+    the result differs only at the track's last segment.
+    """
+    device = torch.device(device) if device else mix.device
+    models = model.models if isinstance(model, BagOfModels) else [model]
+    weights = model.weights if isinstance(model, BagOfModels) else [[1.0] * len(model.sources)]
+    estimates = 0.0
+    totals = [0.0] * len(model.sources)
+    for model_idx, (sub_model, model_weights) in enumerate(zip(models, weights)):
+        sub_model.to(device).eval()
+
+        def on_segment(offset, model_idx=model_idx):
+            if callback:
+                callback({"model_idx_in_bag": model_idx, "models": len(models), "shift_idx": 0,
+                          "segment_offset": offset, "state": "end"})
+
+        length = mix.shape[-1]
+        if shifts:
+            max_shift = int(0.5 * sub_model.samplerate)
+            padded = tensor_chunk(mix).padded(length + 2 * max_shift)
+            out = 0.0
+            for _ in range(shifts):
+                offset = random.randint(0, max_shift)
+                shifted = TensorChunk(padded, offset, length + max_shift - offset)
+                out += _split(sub_model, shifted, segment, overlap, batch_size, device, on_segment)[..., max_shift - offset:]
+            out /= shifts
+        else:
+            out = _split(sub_model, mix, segment, overlap, batch_size, device, on_segment)
+        for k, inst_weight in enumerate(model_weights):
+            out[:, k] *= inst_weight
+            totals[k] += inst_weight
+        estimates += out
+        del out
+    for k in range(len(totals)):
+        estimates[:, k] /= totals[k]
+    return estimates
+
+
+def separate(
+    model: nn.Module,
+    mix: torch.Tensor,
+    device,
+    segment: float,
+    overlap: float,
+    batch_size: int = None,
+    progress: bool = False,
+    callback: Callable[[dict], None] = None,
+) -> torch.Tensor:
+    """Separate a (batch, channels, samples) mix with the configured batching."""
+    batch_size = batch_size or INFERENCE_BATCH
+    with torch.no_grad():
+        if batch_size > 1:
+            return apply_batched(model, mix, segment, overlap, batch_size, device=device, callback=callback)
+        extra = {"callback": callback} if callback and APPLY_MODEL_HAS_CALLBACK else {}
+        return apply_model(model, mix, device=device, progress=progress, overlap=overlap, segment=segment, **extra)
+
+
+def sdr(reference: np.ndarray, estimate: np.ndarray) -> float:
+    """Signal-to-distortion ratio of an estimate against a reference, in dB."""
+    noise = np.sum((reference - estimate) ** 2)
+    return float(10 * np.log10((np.sum(reference ** 2) + 1e-9) / (noise + 1e-9)))
+
+
+def compare_backends(model_name: str, mix: np.ndarray, configs: List[tuple], segment: float, overlap: float) -> list:
+    """Time each (backend, batch_size) and score it against fp32 with batch 1."""
+    from demucs.pretrained import get_model
+    base = get_model(model_name).eval()
+    wav = torch.from_numpy(mix)[None]
+    audio_seconds = mix.shape[-1] / base.samplerate
+    reference = None
+    results = []
+    for backend, batch_size in [("fp32", 1)] + [c for c in configs if c != ("fp32", 1)]:
+        model = prepare_model(base, model_name, backend, segment, batch_size)
+        random.seed(0)  # Same random shifts for every configuration
+        start = time.perf_counter()
+        sources = separate(model, wav, "cpu", segment, overlap, batch_size)[0].numpy()
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = sources
+        row = {
+            "backend": backend,
+            "batch_size": batch_size,
+            "seconds": round(elapsed, 2),
+            "realtime_factor": round(audio_seconds / elapsed, 2),
+            "sdr_db": {name: round(sdr(reference[i], sources[i]), 1) for i, name in enumerate(base.sources)},
+        }
+        results.append(row)
+        print(f"{backend:>12} batch {batch_size}: {elapsed:6.2f}s ({row['realtime_factor']}x realtime), "
+              f"SDR vs fp32: " + ", ".join(f"{k} {v}" for k, v in row["sdr_db"].items()))
+    return results
+
+
+if __name__ == "__main__":
+    from audio_io import decode_audio
+    parser = argparse.ArgumentParser(description="Compare CPU inference backends on a fixture track")
+    parser.add_argument("--fixture", required=True, help="Audio file to separate")
+    parser.add_argument("--seconds", type=float, default=30, help="Only use the first N seconds")
+    parser.add_argument("--model", default="mdx_extra_q")
+    parser.add_argument("--backends", nargs="+", default=["fp32", "int8", "torchscript"], choices=BACKENDS)
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 4], help="Segments per forward pass")
+    parser.add_argument("--segment", type=float, default=8)
+    parser.add_argument("--overlap", type=float, default=0.05)
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads (0: all cores)")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    mix = decode_audio(args.fixture, 44100, 2)[:, :int(args.seconds * 44100)]
+    configs = [(backend, batch) for backend in args.backends for batch in args.batch]
+    results = compare_backends(args.model, mix, configs, args.segment, args.overlap)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
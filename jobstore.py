@@ -0,0 +1,231 @@
+# jobstore.py
+# SQLite-backed record of every job, so state survives restarts
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional
+
+# Jobs in these states won't change again; anything else is resumed on restart
+FINAL_STATUSES = ("done", "error", "removed", "cancelled", "evicted")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mode TEXT NOT NULL DEFAULT 'stem',
+    priority TEXT NOT NULL DEFAULT 'normal',
+    output_root TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    video_id TEXT,
+    title TEXT,
+    duration REAL,
+    error TEXT,
+    bpm REAL,
+    key TEXT,
+    stems TEXT,
+    metrics TEXT,
+    preview TEXT,
+    batch_id TEXT,
+    accessed_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    completed_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_video_id ON jobs (video_id);
+CREATE INDEX IF NOT EXISTS jobs_completed_at ON jobs (completed_at);
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    title TEXT,
+    source TEXT,
+    skipped TEXT,
+    rejected TEXT,
+    created_at REAL NOT NULL
+);
+"""
+
+# Columns added since the first schema, for databases created before them
+MIGRATIONS = {
+    "preview": "TEXT", "priority": "TEXT NOT NULL DEFAULT 'normal'", "batch_id": "TEXT", "accessed_at": "REAL",
+    "title": "TEXT", "duration": "REAL",
+}
+
+
+class JobStore:
+    """Every job's status, results and timings in one SQLite file.
+
+    Writes go straight to the database; the most recently touched rows are
+    also kept in memory, so status polls for live jobs never hit SQLite or
+    the filesystem. One connection is shared by all threads behind a lock.
+    """
+
+    def __init__(self, path, cache_size: int = 1024):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column, kind in MIGRATIONS.items():
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_batch_id ON jobs (batch_id)")
+        self.lock = threading.Lock()
+        self.rows = OrderedDict()
+        self.cache_size = cache_size
+
+    def _remember(self, row: dict) -> dict:
+        self.rows[row["job_id"]] = row
+        self.rows.move_to_end(row["job_id"])
+        while len(self.rows) > self.cache_size:
+            self.rows.popitem(last=False)
+        return row
+
+    def _load(self, job_id: str) -> Optional[dict]:
+        if job_id in self.rows:
+            self.rows.move_to_end(job_id)
+            return self.rows[job_id]
+        row = self.conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._remember(decode_row(row)) if row else None
+
+    def _update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock:
+            self.conn.execute(f"UPDATE jobs SET {columns} WHERE job_id = ?", (*map(encode_value, fields.values()), job_id))
+            row = self._load(job_id)
+            if row is not None:
+                row.update(fields)
+
+    def create(self, job: dict, status: str = "queued"):
+        now = time.time()
+        row = {
+            "job_id": job["job_id"], "url": job["url"], "name": job["name"],
+            "mode": job.get("mode", "stem"), "priority": job.get("priority", "normal"), "output_root": job["output_root"],
+            "status": status, "stage": None, "video_id": job.get("video_id"),
+            "title": job.get("title"), "duration": job.get("duration"),
+            "error": None, "bpm": None, "key": None, "stems": None, "metrics": None, "preview": None,
+            "batch_id": job.get("batch_id"), "accessed_at": None, "created_at": now, "updated_at": now, "completed_at": None,
+        }
+        with self.lock:
+            self.conn.execute(
+                f"INSERT INTO jobs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                tuple(row.values()),
+            )
+            self._remember(row)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self._load(job_id)
+            return dict(row) if row else None
+
+    def set_status(self, job_id: str, status: str, stage: str = None):
+        self._update(job_id, status=status, stage=stage)
+
+    def set_preview(self, job_id: str, preview: dict):
+        self._update(job_id, preview=preview)
+
+    def complete(self, job_id: str, stems: list, bpm: float = None, key: str = None, video_id: str = None, metrics: dict = None):
+        # The full stems replace any preview
+        fields = dict(status="done", stage=None, stems=stems, bpm=bpm, key=key, metrics=metrics, preview=None, completed_at=time.time())
+        if video_id:
+            fields["video_id"] = video_id
+        self._update(job_id, **fields)
+
+    def set_stems(self, job_id: str, stems: list):
+        self._update(job_id, stems=stems)
+
+    def touch(self, job_id: str):
+        """Record that a job's files were read, for least-recently-used eviction."""
+        self._update(job_id, accessed_at=time.time())
+
+    def fail(self, job_id: str, error: str, metrics: dict = None):
+        self._update(job_id, status="error", stage=None, error=error, metrics=metrics, completed_at=time.time())
+
+    def completed(self, limit: int = 50, before: tuple = None, since: tuple = None) -> List[dict]:
+        """Finished jobs, newest first, or oldest first when `since` is given.
+
+        `before` and `since` are (completed_at, job_id) cursors: `before`
+        pages backwards through older jobs, `since` returns the jobs
+        completed after it, for incremental polling. Jobs completed at the
+        same moment are ordered by job_id; a cursor without one compares
+        by completed_at alone.
+        """
+        query = "SELECT * FROM jobs WHERE status = 'done'"
+        params = []
+        for cursor, op in ((before, "<"), (since, ">")):
+            if cursor is None:
+                continue
+            completed_at, job_id = cursor
+            if job_id is None:
+                query += f" AND completed_at {op} ?"
+                params.append(completed_at)
+            else:
+                query += f" AND (completed_at {op} ? OR (completed_at = ? AND job_id {op} ?))"
+                params.extend((completed_at, completed_at, job_id))
+        order = "ASC" if since is not None else "DESC"
+        query += f" ORDER BY completed_at {order}, job_id {order} LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return [decode_row(row) for row in self.conn.execute(query, params)]
+
+    def find_done(self, video_id: str, mode: str = "stem") -> Optional[dict]:
+        """The most recent finished job for a video in the given mode."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT * FROM jobs WHERE video_id = ? AND mode = ? AND status = 'done' ORDER BY completed_at DESC LIMIT 1",
+                (video_id, mode),
+            ).fetchone()
+        return decode_row(row) if row else None
+
+    def create_batch(self, batch_id: str, title: str, source: str, skipped: list, rejected: list):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO batches (batch_id, title, source, skipped, rejected, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (batch_id, title, source, json.dumps(skipped), json.dumps(rejected), time.time()),
+            )
+
+    def update_batch(self, batch_id: str, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock:
+            self.conn.execute(f"UPDATE batches SET {columns} WHERE batch_id = ?", (*map(json.dumps, fields.values()), batch_id))
+
+    def get_batch(self, batch_id: str) -> Optional[dict]:
+        """A batch with its `jobs` rows in submission order."""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return None
+            jobs = self.conn.execute("SELECT * FROM jobs WHERE batch_id = ? ORDER BY created_at", (batch_id,)).fetchall()
+        batch = dict(row)
+        batch["skipped"] = json.loads(batch["skipped"])
+        batch["rejected"] = json.loads(batch["rejected"])
+        batch["jobs"] = [decode_row(job) for job in jobs]
+        return batch
+
+    def unfinished(self) -> List[dict]:
+        """Jobs that were queued or in flight when the server last stopped."""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT * FROM jobs WHERE status NOT IN ({', '.join('?' * len(FINAL_STATUSES))}) ORDER BY created_at",
+                FINAL_STATUSES,
+            ).fetchall()
+        return [decode_row(row) for row in rows]
+
+
+def encode_value(value):
+    return json.dumps(value) if isinstance(value, (list, dict)) else value
+
+
+def decode_row(row: sqlite3.Row) -> dict:
+    row = dict(row)
+    for column in ("stems", "metrics", "preview"):
+        if row[column]:
+            row[column] = json.loads(row[column])
+    return row
@@ -0,0 +1,319 @@
+# lifecycle.py
+# Keeps finished jobs within a disk quota: cold WAV stems become FLAC, and the least recently used jobs are evicted
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import soundfile as sf
+
+from audio_io import tag_vorbis
+from cache import ResultCache, link_or_copy
+from jobstore import JobStore
+from peaks import peaks_path
+
+# Disk used by the job folders and the result cache together (files linked
+# between them count once), checked after every job and every
+# LIFECYCLE_INTERVAL seconds; over it, whole finished jobs are deleted with
+# their cached results, least recently downloaded first. 0 turns eviction off.
+DISK_QUOTA_GB = float(os.environ.get("DISK_QUOTA_GB", 50))
+# Finished jobs nobody has downloaded for this long get their WAV stems
+# re-encoded to FLAC (lossless, about half the size). 0 turns it off.
+COLD_AFTER_HOURS = float(os.environ.get("COLD_AFTER_HOURS", 72))
+LIFECYCLE_INTERVAL = float(os.environ.get("LIFECYCLE_INTERVAL", 600))
+# Downloads are recorded at most this often per job
+TOUCH_INTERVAL = 60
+REENCODE_BLOCK_FRAMES = 1 << 16
+# Statuses whose folders hold nothing worth keeping (partial downloads, stems of abandoned runs)
+DISCARDED_STATUSES = ("error", "removed", "cancelled")
+
+
+def reencode_flac(wav: Path, bpm: float = None) -> Path:
+    """Replace a WAV stem with a FLAC of the same samples, keeping its peaks and BPM tag.
+
+    The FLAC is written under a hidden name and checked frame for frame
+    before it replaces the WAV, so an interrupted pass leaves the WAV intact.
+    """
+    flac = wav.with_suffix(".flac")
+    tmp = wav.parent / f".{flac.stem}.tmp.flac"
+    try:
+        with sf.SoundFile(str(wav)) as src:
+            frames = src.frames
+            with sf.SoundFile(str(tmp), "w", src.samplerate, src.channels, format="FLAC", subtype="PCM_16") as dst:
+                for block in src.blocks(REENCODE_BLOCK_FRAMES, dtype="int16"):
+                    dst.write(block)
+        if sf.info(str(tmp)).frames != frames:
+            raise ValueError(f"{tmp.name} is short of {wav.name}")
+        if bpm:
+            tag_vorbis(tmp, bpm)
+        os.replace(tmp, flac)
+    finally:
+        tmp.unlink(missing_ok=True)
+    # Peaks only depend on the samples, which haven't changed
+    if peaks_path(wav).exists():
+        os.replace(peaks_path(wav), peaks_path(flac))
+    wav.unlink()
+    return flac
+
+
+class DiskIndex:
+    """Every file under the job folders and the result cache, by inode.
+
+    Finished stems are hardlinked between jobs and the cache, so a file's
+    bytes only come free once all its links are gone. Each inode is counted
+    once, and each link knows its owner: ("job", job_id) or ("cache", key).
+    """
+
+    def __init__(self, output_root: Path, cache_root: Path = None):
+        self.roots = {"job": Path(output_root)}
+        if cache_root is not None:
+            self.roots["cache"] = Path(cache_root)
+        self.inodes = {}  # (dev, ino) -> {"size", "nlink", "links": [(path, owner)]}
+        self.by_owner = {}  # owner -> set of inodes
+        for kind, root in self.roots.items():
+            for folder, _, files in os.walk(root):
+                for name in files:
+                    path = Path(folder) / name
+                    try:
+                        stat = path.stat()
+                    except OSError:
+                        continue  # Deleted while walking
+                    parts = path.relative_to(root).parts
+                    if len(parts) < 2:
+                        continue  # Not inside a job or cache entry (e.g. jobs.db)
+                    inode = (stat.st_dev, stat.st_ino)
+                    entry = self.inodes.setdefault(inode, {"size": stat.st_size, "nlink": stat.st_nlink, "links": []})
+                    entry["links"].append((path, (kind, parts[0])))
+                    self.by_owner.setdefault((kind, parts[0]), set()).add(inode)
+
+    def inode(self, path: Path) -> Optional[tuple]:
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        inode = (stat.st_dev, stat.st_ino)
+        return inode if inode in self.inodes else None
+
+    def total(self) -> int:
+        return sum(entry["size"] for entry in self.inodes.values())
+
+    def owner_bytes(self, owner: tuple) -> int:
+        return sum(self.inodes[inode]["size"] for inode in self.by_owner.get(owner, ()))
+
+    def shared_bytes(self, owner: tuple) -> int:
+        """Bytes of owner's files that are also linked from elsewhere, so deleting it alone doesn't free them."""
+        return sum(
+            self.inodes[inode]["size"] for inode in self.by_owner.get(owner, ())
+            if self.inodes[inode]["nlink"] > sum(1 for _, link_owner in self.inodes[inode]["links"] if link_owner == owner)
+        )
+
+    def linked_owners(self, owner: tuple, kind: str) -> set:
+        """Owners of the given kind sharing files with owner."""
+        return {
+            link_owner for inode in self.by_owner.get(owner, ()) for _, link_owner in self.inodes[inode]["links"]
+            if link_owner[0] == kind and link_owner != owner
+        }
+
+    def remove(self, owners: set):
+        """Forget owners' links, after their folders were deleted."""
+        for owner in owners:
+            for inode in self.by_owner.pop(owner, ()):
+                entry = self.inodes.get(inode)
+                if entry is None:
+                    continue
+                entry["links"] = [link for link in entry["links"] if link[1] != owner]
+                if not entry["links"]:
+                    del self.inodes[inode]
+
+
+class LifecycleManager:
+    """Background pass over the job folders in output_root.
+
+    Each pass deletes the folders of failed and removed jobs, re-encodes
+    cold jobs to FLAC and evicts finished jobs while the job folders and
+    the result cache together use more than the quota. Files hardlinked
+    between them are counted once. is_busy(job_id) guards jobs the
+    scheduler still holds; on_evict(row) is called after a job's folder
+    is deleted.
+    """
+
+    def __init__(self, output_root: Path, store: JobStore, is_busy: Callable[[str], bool],
+                 on_evict: Callable[[dict], None] = None, cache: ResultCache = None,
+                 quota_bytes: int = int(DISK_QUOTA_GB * 1024 ** 3),
+                 cold_after: float = COLD_AFTER_HOURS * 3600, interval: float = LIFECYCLE_INTERVAL):
+        self.output_root = Path(output_root)
+        self.store = store
+        self.is_busy = is_busy
+        self.on_evict = on_evict
+        self.cache = cache
+        self.quota_bytes = quota_bytes
+        self.cold_after = cold_after
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.usage: Dict[str, dict] = {}  # job_id -> bytes and shared_bytes at the last pass
+        self.used = 0
+        self.touched: Dict[str, float] = {}
+        self.scanned_at = None
+        self.evictions = 0
+        self.reencoded = 0
+        self.bytes_saved = 0
+
+    def start(self):
+        threading.Thread(target=self._loop, name="lifecycle", daemon=True).start()
+
+    def wake(self):
+        """Run a pass now, e.g. after a job finished writing its stems."""
+        self.wakeup.set()
+
+    def touch(self, job_id: str):
+        """Note that a job's files were downloaded, which keeps it warm and last in line for eviction."""
+        now = time.time()
+        if now - self.touched.get(job_id, 0) >= TOUCH_INTERVAL:
+            self.touched[job_id] = now
+            self.store.touch(job_id)
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Lifecycle pass failed: {e}")
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def _index(self) -> DiskIndex:
+        return DiskIndex(self.output_root, self.cache.root if self.cache is not None else None)
+
+    def run_once(self):
+        with self.lock:
+            jobs = {}
+            for folder in self.output_root.iterdir():
+                if not folder.is_dir() or self.is_busy(folder.name):
+                    continue
+                row = self.store.get(folder.name)
+                if row is None:
+                    continue  # Not a job folder, or one this store never knew
+                if row["status"] in DISCARDED_STATUSES or row["status"] == "evicted":
+                    shutil.rmtree(folder, ignore_errors=True)
+                elif row["status"] == "done":
+                    jobs[folder.name] = row
+            index = self._index()
+            if self.cold_after > 0:
+                now = time.time()
+                cold = {job_id for job_id, row in jobs.items() if now - last_used(row) >= self.cold_after}
+                if any([self._reencode(jobs[job_id], jobs, cold, index) for job_id in sorted(cold)]):
+                    index = self._index()
+            if self.quota_bytes > 0:
+                self._evict(jobs, index)
+            self.usage = {
+                job_id: {"bytes": index.owner_bytes(("job", job_id)), "shared_bytes": index.shared_bytes(("job", job_id))}
+                for job_id in jobs if ("job", job_id) in index.by_owner
+            }
+            self.used = index.total()
+            self.scanned_at = time.time()
+
+    def _reencode(self, row: dict, jobs: Dict[str, dict], cold: set, index: DiskIndex) -> bool:
+        """Re-encode a cold job's WAV stems, with every other link to them (the
+        cache's, other cold jobs'), so the WAVs' space really comes free."""
+        song_dir = self.output_root / row["job_id"] / row["name"]
+        renamed = {}  # job_id -> {old file name: new file name}
+        for wav in sorted(song_dir.glob("*.wav")) if song_dir.is_dir() else []:
+            inode = index.inode(wav)
+            if inode is None:
+                continue
+            entry = index.inodes[inode]
+            others = [(path, owner) for path, owner in entry["links"] if path != wav]
+            if len(entry["links"]) < entry["nlink"] or any(
+                kind == "job" and owner_id not in cold for _, (kind, owner_id) in others
+            ):
+                # Also linked from a job still in use or from outside these
+                # folders: re-encoding would keep the WAV and add a FLAC
+                continue
+            try:
+                flac = reencode_flac(wav, row["bpm"])
+            except Exception as e:
+                # E.g. a WAV still open for download on Windows; retried next pass
+                print(f"Re-encoding {wav.name} failed: {e}")
+                continue
+            renamed.setdefault(row["job_id"], {})[wav.name] = flac.name
+            for path, (kind, owner_id) in others:
+                if kind == "cache":
+                    self.cache.replace_file(owner_id, path.name, flac)
+                    continue
+                link_or_copy(flac, path.with_suffix(".flac"))
+                if peaks_path(path).exists():
+                    os.replace(peaks_path(path), peaks_path(path.with_suffix(".flac")))
+                path.unlink(missing_ok=True)
+                renamed.setdefault(owner_id, {})[path.name] = path.with_suffix(".flac").name
+            self.reencoded += 1
+            self.bytes_saved += entry["size"] - flac.stat().st_size
+        for job_id, names in renamed.items():
+            self._rename_stems(jobs[job_id], names)
+            print(f"Re-encoded {len(names)} cold stems of {jobs[job_id]['name']} to FLAC")
+        return bool(renamed)
+
+    def _rename_stems(self, row: dict, renamed: Dict[str, str]):
+        stems = [
+            {**stem, "name": renamed.get(stem["name"], stem["name"]),
+             "url": stem["url"].rsplit("/", 1)[0] + "/" + renamed.get(stem["name"], stem["name"])}
+            for stem in row["stems"] or []
+        ]
+        self.store.set_stems(row["job_id"], stems)
+
+    def _evict(self, jobs: Dict[str, dict], index: DiskIndex):
+        total = index.total()
+        for job_id in sorted(jobs, key=lambda job_id: last_used(jobs[job_id])):
+            if total <= self.quota_bytes:
+                break
+            if self.is_busy(job_id):
+                continue
+            # The job's cached result holds the same files, so deleting the
+            # folder alone would free next to nothing
+            owners = {("job", job_id)} | index.linked_owners(("job", job_id), "cache")
+            shutil.rmtree(self.output_root / job_id, ignore_errors=True)
+            for _, key in owners - {("job", job_id)}:
+                self.cache.discard(key)
+            index.remove(owners)
+            total = index.total()
+            self.store.set_status(job_id, "evicted")
+            self.evictions += 1
+            print(f"Evicted {jobs[job_id]['name']} ({job_id}) to stay under the disk quota")
+            if self.on_evict:
+                self.on_evict(jobs[job_id])
+
+    def used_bytes(self) -> int:
+        return self.used
+
+    def report(self, limit: Optional[int] = None) -> dict:
+        """Space used per finished job as of the last pass, largest first."""
+        jobs = []
+        for job_id, usage in sorted(self.usage.items(), key=lambda item: -item[1]["bytes"])[:limit]:
+            row = self.store.get(job_id)
+            if row is None:
+                continue
+            song_dir = self.output_root / job_id / row["name"]
+            formats = sorted({path.suffix.lstrip(".") for path in song_dir.iterdir() if path.is_file()}) if song_dir.is_dir() else []
+            jobs.append({
+                "job_id": job_id,
+                "name": row["name"],
+                **usage,
+                "formats": formats,
+                "last_used": last_used(row),
+            })
+        return {
+            "used_bytes": self.used,
+            "quota_bytes": self.quota_bytes or None,
+            "cold_after_hours": self.cold_after / 3600 or None,
+            "scanned_at": self.scanned_at,
+            "evictions": self.evictions,
+            "reencoded_stems": self.reencoded,
+            "reencode_bytes_saved": self.bytes_saved,
+            "jobs": jobs,
+        }
+
+
+def last_used(row: dict) -> float:
+    return max(row["accessed_at"] or 0, row["completed_at"] or 0, row["created_at"])
@@ -2,19 +2,42 @@
 # Connevts a FastAPI web interface to the youtube_to_stems pipeline
 from fastapi import FastAPI, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from pathlib import Path
+import os
+import asyncio
 import uuid
 import shutil
 import threading
-import time
-from collections import deque
-from pipeline import youtube_to_stems
+from pipeline import download_stage, max_duration_for
+from admission import AdmissionController, MemoryEstimator
+from preview import PREVIEW_DIR, PREVIEW_SECONDS, PreviewQueue, preview_task
+from scheduler import PRIORITY_CLASSES, Stage, StagedScheduler
+from settings import separation_params
+from workers import WorkerPool, discard_work
+from converter import resolve_video_id, preflight, is_playlist, expand_playlist, track_name
+from cache import ResultCache, cache_key
+from events import EventBroker, ProgressThrottle, format_sse
+from peaks import peaks_path, ensure_peaks
+from delivery import bundle_files, file_response, reencoded_source, stem_response, zip_response
+from mixdown import MIX_FORMATS, MixCache, job_stems, parse_gains
+from metrics import collector, RateEstimator
+from jobstore import FINAL_STATUSES, JobStore
+from lifecycle import LifecycleManager
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Events are published from worker threads onto the server's loop
+    broker.bind(asyncio.get_running_loop())
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  
@@ -28,95 +51,666 @@ templates = Jinja2Templates(directory="templates")
 
 OUTPUT_ROOT = Path("./temp_jobs")
 OUTPUT_ROOT.mkdir(exist_ok=True)
+PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "mdx_extra_q") or None  # Empty: load lazily on the first job
 
-job_queue = deque()
-queue_lock = threading.Lock()
-current_job = None
-completed_jobs = []  # Store completed jobs for this session
-
-
-def job_worker():
-    global current_job, completed_jobs
-    while True:
-        with queue_lock:
-            if job_queue:
-                job = job_queue.popleft()
-                current_job = job
-            else:
-                current_job = None
-        if current_job:
-            job_id, url, name, mode = current_job["job_id"], current_job["url"], current_job["name"], current_job.get("mode", "stem")
-            job_dir = OUTPUT_ROOT / job_id
-            try:
-                (job_dir / "status.txt").write_text("downloading")
-                stems = []
-                bpm = None
-                key = None
-                if mode == "youtube":
-                    # Only download mp3, do not split
-                    from converter import download_yt_to_mp3
-                    mp3_path = job_dir / name / f"{name}.mp3"
-                    (job_dir / name).mkdir(parents=True, exist_ok=True)
-                    title, duration = download_yt_to_mp3(url, str(mp3_path), max_duration=360)
+# Pool sizes for the staged scheduler. Downloads run in this process;
+# the other stages run in worker processes, one per worker.
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 2))
+PREVIEW_WORKERS = int(os.environ.get("PREVIEW_WORKERS", 1))
+SEPARATION_WORKERS = int(os.environ.get("SEPARATION_WORKERS", 1))
+POSTPROCESS_WORKERS = int(os.environ.get("POSTPROCESS_WORKERS", 2))
+
+# /bulk submissions: at most this many tracks, pre-flighted this many at a time
+MAX_BATCH_TRACKS = int(os.environ.get("MAX_BATCH_TRACKS", 200))
+BULK_PREFLIGHT_WORKERS = int(os.environ.get("BULK_PREFLIGHT_WORKERS", 8))
+
+# Status, results and timings of every job, kept across restarts
+JOB_DB = Path(os.environ.get("JOB_DB", OUTPUT_ROOT / "jobs.db"))
+COMPLETED_PAGE_SIZE = 50
+store = JobStore(JOB_DB)
+
+# Rough seconds of processing per second of audio until real jobs are measured
+processing_rate = RateEstimator({"stem": 0.5, "youtube": 0.05})
+# Jobs only start while their estimated peak memory fits MEMORY_BUDGET_MB
+admission = AdmissionController(MemoryEstimator())
+
+broker = EventBroker()
+EVENT_KEEPALIVE_SECONDS = 15
+
+# Finished stems keyed by video ID + separation settings
+CACHE_ROOT = Path(os.environ.get("CACHE_ROOT", "./stem_cache"))
+CACHE_MAX_GB = float(os.environ.get("CACHE_MAX_GB", 20))
+result_cache = ResultCache(CACHE_ROOT, int(CACHE_MAX_GB * 1024 ** 3))
+# Rendered /mix results (MIX_CACHE_ROOT, MIX_CACHE_MB)
+mix_cache = MixCache()
+
+# Identical requests in flight share one computation: cache key -> the job
+# doing the work, and that job's ID -> the jobs waiting for its result
+inflight = {}
+followers = {}
+inflight_lock = threading.Lock()
+# Jobs whose preview may still be published: job ID -> the preview's cancel
+# event. A job leaves it once its full stems (or its end) supersede the preview.
+previewing = {}
+preview_lock = threading.Lock()
+
+
+def format_bpm(bpm):
+    return f"{bpm:.1f}" if bpm is not None else None
+
+
+def completed_cursor(row: dict) -> str:
+    """Position of a finished job in /completed; repr keeps completed_at exact."""
+    return f"{row['completed_at']!r}:{row['job_id']}"
+
+
+def parse_cursor(cursor: str = None) -> tuple:
+    if cursor is None:
+        return None
+    completed_at, _, job_id = cursor.partition(":")
+    return float(completed_at), job_id or None
+
+
+def completed_entry(row: dict) -> dict:
+    """A finished job as listed in /completed and sent in "done" events."""
+    return {
+        "job_id": row["job_id"],
+        "song_name": row["name"],
+        "stems": row["stems"] or [],
+        "bpm": format_bpm(row["bpm"]),
+        "key": row["key"],
+        "url": row["url"],
+        "completed_at": row["completed_at"],
+    }
+
+
+def file_entries(job_id: str, song_name: str, paths, tier: str = None) -> list:
+    """Download links for output files; preview files are served from their own route."""
+    prefix = f"/download/{job_id}/{song_name}" + (f"/{tier}" if tier else "")
+    return [{"name": Path(path).name, "url": f"{prefix}/{Path(path).name}"} for path in paths]
+
+
+def public_preview(preview: dict) -> dict:
+    return {**preview, "bpm": format_bpm(preview["bpm"])}
+
+
+def public_job(job: dict) -> dict:
+    """The fields of a job that are safe to send to clients."""
+    # A coalesced job is as far along as the job doing its work
+    live = job.get("leader", job)
+    return {
+        "job_id": job["job_id"],
+        "url": job["url"],
+        "name": job["name"],
+        "mode": job.get("mode", "stem"),
+        "priority": job.get("priority", "normal"),
+        "stage": live.get("stage"),
+        "waiting": live.get("waiting", False),
+        "progress": live.get("progress"),
+        "title": job.get("title"),
+        "duration": job.get("duration"),
+        "estimated_seconds": job.get("estimated_seconds"),
+        "memory_estimate_mb": live.get("memory_estimate_mb"),
+        "waiting_for_memory": live.get("waiting_for_memory", False),
+        "coalesced_with": job["leader"]["job_id"] if "leader" in job else None,
+    }
+
+
+def join_inflight(job: dict, key: str):
+    """Attach job to the in-flight job with the same cache key and return that job,
+    or register job as the one computing key and return None."""
+    with inflight_lock:
+        leader = inflight.get(key)
+        if leader is not None:
+            job["leader"] = leader
+            followers[leader["job_id"]].append(job)
+            return leader
+        job["cache_key"] = key
+        inflight[key] = job
+        followers[job["job_id"]] = []
+        return None
+
+
+def release_followers(job: dict) -> list:
+    """Stop coalescing onto job and return the jobs that were waiting for it."""
+    with inflight_lock:
+        if job.get("cache_key") and inflight.get(job["cache_key"]) is job:
+            del inflight[job["cache_key"]]
+        waiting = followers.pop(job["job_id"], [])
+    for follower in waiting:
+        follower.pop("leader", None)
+    return waiting
+
+
+def followers_of(job: dict) -> list:
+    with inflight_lock:
+        return list(followers.get(job["job_id"], ()))
+
+
+def waiting_on(job: dict) -> list:
+    """The jobs whose clients are waiting for job's result: its followers, and
+    job itself unless its own client removed it (it then runs detached)."""
+    return ([] if job.get("detached") else [job]) + followers_of(job)
+
+
+def queued_jobs(pending: list, active: list) -> list:
+    """Jobs not started yet in the order they'll start, then coalesced ones."""
+    return [public_job(job) for job in pending] + [public_job(job) for leader in pending + active for job in followers_of(leader)]
+
+
+def find_follower(job_id: str):
+    with inflight_lock:
+        for waiting in followers.values():
+            for job in waiting:
+                if job["job_id"] == job_id:
+                    return job
+    return None
+
+
+def track_progress(job: dict):
+    """Give a job a progress callback that publishes throttled progress events."""
+    throttle = ProgressThrottle()
+
+    def report(fraction: float):
+        job["progress"] = round(fraction, 3)
+        if throttle.ready(fraction):
+            for target in waiting_on(job):
+                broker.publish("progress", {"job_id": target["job_id"], "progress": job["progress"]})
+
+    job["progress_callback"] = report
+
+
+def track_preview(job: dict):
+    """Publish a job's preview stems and provisional BPM/key as soon as they're written."""
+
+    def publish(preview: dict):
+        with preview_lock:
+            if job["job_id"] not in previewing:
+                # The full stems came first; this preview is of no use now
+                shutil.rmtree(OUTPUT_ROOT / job["job_id"] / job["name"] / PREVIEW_DIR, ignore_errors=True)
+                return
+            preview = {**preview, "stems": file_entries(job["job_id"], job["name"], preview["stems"], PREVIEW_DIR)}
+            # Coalesced jobs play the preview from this job's folder
+            for target in waiting_on(job):
+                store.set_preview(target["job_id"], preview)
+                broker.publish("preview", {"job_id": target["job_id"], "name": target["name"], **public_preview(preview)})
+
+    job["preview_callback"] = publish
+
+
+def start_preview(job: dict):
+    """Queue a downloaded job's preview to run beside its full separation."""
+    try:
+        task = preview_task(job)
+    except Exception as e:
+        print(f"Preview failed (non-critical): {e}")
+        return
+    if task is None:
+        return
+    cancel = threading.Event()
+    task.update(cancel=cancel, should_stop=cancel.is_set, preview_callback=job["preview_callback"], metrics=job["metrics"])
+    with preview_lock:
+        previewing[job["job_id"]] = cancel
+    previews.submit(task)
+
+
+def stop_preview(job: dict):
+    """Stop a job's preview, if it has one, and never publish it."""
+    with preview_lock:
+        cancel = previewing.pop(job["job_id"], None)
+    if cancel is not None:
+        cancel.set()
+
+
+def download_job(job: dict):
+    download_stage(job)
+    if job.get("mode", "stem") != "youtube":
+        start_preview(job)
+
+
+def on_stage(job: dict, stage: Stage):
+    for target in waiting_on(job):
+        store.set_status(target["job_id"], stage.status, stage.name)
+        broker.publish("stage", {**public_job(target), "status": stage.status})
+
+
+def job_metrics(job: dict):
+    return job["metrics"].to_dict() if "metrics" in job else None
+
+
+def on_done(job: dict):
+    stop_preview(job)
+    if job.get("mode", "stem") != "youtube" and job.get("video_id"):
+        try:
+            key = job.get("cache_key") or cache_key(job["video_id"], separation_params())
+            result_cache.store(key, job["stems"], job["name"], job["bpm"], job["key"], video_id=job["video_id"])
+        except Exception as e:
+            print(f"Caching result failed (non-critical): {e}")
+    collector.jobs.inc("done")
+    if "metrics" in job:
+        stage_seconds = sum(r["wall_s"] for r in job["metrics"].to_dict()["records"] if r["kind"] == "stage")
+        processing_rate.update(job.get("mode", "stem"), stage_seconds, job.get("duration"))
+        admission.observe(job, job["metrics"].to_dict()["records"])
+    discard_work(job)
+    for follower in release_followers(job):
+        hit = result_cache.materialize(job["cache_key"], OUTPUT_ROOT / follower["job_id"] / follower["name"], follower["name"])
+        if hit:
+            complete_job(follower, hit["bpm"], hit["key"])
+        else:
+            # The result didn't make it into the cache; compute it separately
+            submit_job(follower)
+    if job.get("detached"):
+        # Cancelled by its own client, kept running for the jobs above
+        shutil.rmtree(OUTPUT_ROOT / job["job_id"], ignore_errors=True)
+    else:
+        complete_job(job, job.get("bpm"), job.get("key"))
+    lifecycle.wake()
+
+
+def complete_job(job: dict, bpm: float = None, key: str = None):
+    job_id, name = job["job_id"], job["name"]
+    job_dir = OUTPUT_ROOT / job_id
+    stems = []
+    if job.get("mode", "stem") == "youtube":
+        stems.append({
+            "name": f"{name}[full].mp3",
+            "url": f"/download/{job_id}/{name}/{name}.mp3"
+        })
+    else:
+        song_dir = job_dir / name
+        # The full stems replace the preview
+        shutil.rmtree(song_dir / PREVIEW_DIR, ignore_errors=True)
+        if song_dir.exists():
+            for f in song_dir.iterdir():
+                if f.is_file():
                     stems.append({
-                        "name": f"{name}[full].mp3",
-                        "url": f"/download/{job_id}/{name}/{name}.mp3"
+                        "name": f.name,
+                        "url": f"/download/{job_id}/{name}/{f.name}"
                     })
-                    (job_dir / "status.txt").write_text("done")
-                else:
-                    from pipeline import youtube_to_stems
-                    youtube_to_stems(url, name, str(job_dir))
-                    (job_dir / "status.txt").write_text("done")
-                    # Collect stems and metadata for completed jobs
-                    song_dir = job_dir / name
-                    metadata_file = job_dir / "metadata.txt"
-                    if metadata_file.exists():
-                        try:
-                            metadata = metadata_file.read_text().strip()
-                            for line in metadata.split('\n'):
-                                if line.startswith('BPM:'):
-                                    bpm = line.replace('BPM:', '').strip()
-                                elif line.startswith('Key:'):
-                                    key = line.replace('Key:', '').strip()
-                        except Exception:
-                            pass
-                    if song_dir.exists():
-                        for f in song_dir.iterdir():
-                            if f.is_file():
-                                stems.append({
-                                    "name": f.name,
-                                    "url": f"/download/{job_id}/{name}/{f.name}"
-                                })
-                completed_jobs.append({
-                    "job_id": job_id,
-                    "song_name": name,
-                    "stems": stems,
-                    "bpm": bpm,
-                    "key": key,
-                    "url": url
-                })
-            except Exception as e:
-                (job_dir / "status.txt").write_text("error")
-                (job_dir / "error.txt").write_text(str(e))
+    store.complete(job_id, stems, bpm, key, video_id=job.get("video_id"), metrics=job_metrics(job))
+    broker.publish("done", completed_entry(store.get(job_id)))
+    publish_batch(job)
+
+
+def on_error(job: dict, error: Exception):
+    stop_preview(job)
+    discard_work(job)
+    if not job.get("detached"):
+        fail_job(job, str(error), metrics=job_metrics(job))
+    for follower in release_followers(job):
+        fail_job(follower, str(error))
+
+
+def fail_job(job: dict, error: str, metrics: dict = None):
+    store.fail(job["job_id"], error, metrics=metrics)
+    collector.jobs.inc("error")
+    broker.publish("failed", {"job_id": job["job_id"], "name": job["name"], "error": error})
+    publish_batch(job)
+
+
+def on_cancel(job: dict):
+    if not job.get("detached"):
+        store.set_status(job["job_id"], "cancelled")
+        collector.jobs.inc("cancelled")
+        broker.publish("cancelled", {"job_id": job["job_id"]})
+        publish_batch(job)
+    drop_job(job)
+
+
+def drop_job(job: dict):
+    """Clean up after a job that was cancelled or removed from the queue.
+
+    Its files are deleted, it stops being the job identical requests
+    coalesce onto, and any that were waiting start their own computation.
+    """
+    stop_preview(job)
+    discard_work(job)
+    shutil.rmtree(OUTPUT_ROOT / job["job_id"], ignore_errors=True)
+    for follower in release_followers(job):
+        submit_job(follower)
+
+
+def new_job(url: str, name: str, mode: str = "stem", priority: str = "normal", batch_id: str = None) -> dict:
+    job_id = str(uuid.uuid4())[:8]
+    job = {"job_id": job_id, "url": url, "name": name, "mode": mode, "priority": priority, "output_root": str(OUTPUT_ROOT / job_id)}
+    if batch_id:
+        job["batch_id"] = batch_id
+    return job
+
+
+def reuse_result(job: dict, video_id: str) -> tuple:
+    """Look for a result job can share instead of computing its own.
+
+    ("cached", cache entry) when the result cache has it, ("coalesced",
+    leader) when an identical job is in flight (job now follows it), or
+    (None, None) when job computes it itself; job is then the in-flight
+    job later identical ones follow.
+    """
+    key = cache_key(video_id, separation_params()) if job.get("mode", "stem") != "youtube" and video_id else None
+    if key is None:
+        return None, None
+    hit = result_cache.materialize(key, OUTPUT_ROOT / job["job_id"] / job["name"], job["name"])
+    if hit:
+        return "cached", hit
+    leader = join_inflight(job, key)
+    if leader is None:
+        return None, None
+    if PRIORITY_CLASSES[job["priority"]] < PRIORITY_CLASSES[leader.get("priority", "normal")]:
+        leader["priority"] = job["priority"]
+    job.update(video_id=video_id, title=leader.get("title"), duration=leader.get("duration"))
+    return "coalesced", leader
+
+
+async def admit(job: dict) -> dict:
+    """Start a new job and return its /start response; ValueError if pre-flight rejects it."""
+    job_id, url, name, mode = job["job_id"], job["url"], job["name"], job["mode"]
+    final_dir = OUTPUT_ROOT / job_id / name
+    response = {"job_id": job_id, "song_name": name, "output_folder": str(final_dir)}
+
+    # Repeat URL: link the cached stems into the new job and finish
+    # immediately. Same video already in flight: wait for its result
+    # instead of separating it again.
+    video_id = resolve_video_id(url)
+    outcome, found = reuse_result(job, video_id)
+    if outcome == "cached":
+        store.create({**job, "video_id": video_id})
+        complete_job(job, found["bpm"], found["key"])
+        return {**response, "cached": True}
+    if outcome == "coalesced":
+        store.create(job)
+        broker.publish("queued", public_job(job))
+        return {**response, "coalesced_with": found["job_id"]}
+
+    # Resolve metadata before queuing, so bad or over-long URLs are rejected
+    # without downloading anything. Requests pre-flight concurrently.
+    try:
+        info = await run_in_threadpool(preflight, url, max_duration_for(mode))
+    except ValueError as e:
+        # Requests that joined this one in the meantime fail the same way
+        for follower in release_followers(job):
+            fail_job(follower, str(e))
+        raise
+    job.update(
+        info=info,
+        video_id=info.get("id") or video_id,
+        title=info.get("title"),
+        duration=info.get("duration"),
+        estimated_seconds=processing_rate.estimate(mode, info.get("duration")),
+    )
+    store.create(job)
+    submit_job(job)
+    return response
+
+
+def live_progress() -> dict:
+    """Progress of every job past the queue, coalesced ones included, by job ID."""
+    _, active = scheduler.snapshot()
+    progress = {}
+    for job in active:
+        for target in [job, *followers_of(job)]:
+            progress[target["job_id"]] = job.get("progress")
+    return progress
+
+
+def batch_view(batch_id: str, tracks: bool = True):
+    """A batch's counts by status and overall progress (finished tracks count
+    as whole, running ones by their progress), and optionally each track."""
+    batch = store.get_batch(batch_id)
+    if batch is None:
+        return None
+    live = live_progress()
+    counts, total = {}, 0.0
+    for row in batch["jobs"]:
+        counts[row["status"]] = counts.get(row["status"], 0) + 1
+        row["progress"] = 1.0 if row["status"] in FINAL_STATUSES else live.get(row["job_id"]) or 0.0
+        total += row["progress"]
+    view = {
+        "batch_id": batch_id,
+        "title": batch["title"],
+        "created_at": batch["created_at"],
+        "total": len(batch["jobs"]),
+        "counts": counts,
+        "progress": round(total / len(batch["jobs"]), 3) if batch["jobs"] else 1.0,
+        "complete": all(row["status"] in FINAL_STATUSES for row in batch["jobs"]),
+        "skipped": batch["skipped"],
+        "rejected": batch["rejected"],
+    }
+    if tracks:
+        view["tracks"] = [{
+            "job_id": row["job_id"],
+            "name": row["name"],
+            "url": row["url"],
+            "status": row["status"],
+            "stage": row["stage"],
+            "progress": round(row["progress"], 3),
+            "error": row["error"],
+            "stems": row["stems"] or [],
+        } for row in batch["jobs"]]
+    return view
+
+
+def publish_batch(job: dict):
+    """Send a "batch" event when a job of a batch finishes."""
+    batch_id = job.get("batch_id") or (store.get(job["job_id"]) or {}).get("batch_id")
+    if batch_id:
+        broker.publish("batch", batch_view(batch_id, tracks=False))
+
+
+def submit_job(job: dict):
+    if job.get("mode", "stem") == "youtube":
+        # Only download mp3, do not split
+        job["stages"] = ["download"]
+    (OUTPUT_ROOT / job["job_id"] / job["name"]).mkdir(parents=True, exist_ok=True)
+    store.set_status(job["job_id"], "queued")
+    track_progress(job)
+    track_preview(job)
+    scheduler.submit(job)
+    broker.publish("queued", public_job(job))
+
+
+# Torch, Demucs and librosa only load in these processes, so the API starts
+# fast and running jobs can't hold its GIL or crash it. CPU cores are shared
+# between the separation workers and the preview workers running beside them.
+TORCH_WORKERS = SEPARATION_WORKERS + (PREVIEW_WORKERS if PREVIEW_SECONDS > 0 else 0)
+preview_pool = WorkerPool("preview", PREVIEW_WORKERS, preload=PRELOAD_MODEL, torch_workers=TORCH_WORKERS)
+separation_pool = WorkerPool("separate", SEPARATION_WORKERS, preload=PRELOAD_MODEL, torch_workers=TORCH_WORKERS)
+postprocess_pool = WorkerPool("postprocess", POSTPROCESS_WORKERS)
+worker_pools = (preview_pool, separation_pool, postprocess_pool)
+
+# Previews don't hold up the job: each is queued when its job's download
+# finishes and only published if it is done before the full stems
+previews = PreviewQueue(preview_pool.stage("preview_stage"), PREVIEW_WORKERS)
+
+scheduler = StagedScheduler(
+    [
+        Stage("download", download_job, DOWNLOAD_WORKERS, status="downloading"),
+        Stage("separate", separation_pool.stage("separate_stage"), SEPARATION_WORKERS, status="separating"),
+        Stage("postprocess", postprocess_pool.stage("postprocess_stage"), POSTPROCESS_WORKERS, status="cleaning"),
+    ],
+    on_stage=on_stage,
+    on_done=on_done,
+    on_error=on_error,
+    on_cancel=on_cancel,
+    admission=admission,
+)
+for pool in worker_pools:
+    pool.start()
+previews.start()
+scheduler.start()
+
+
+def job_busy(job_id: str) -> bool:
+    """Whether the scheduler still holds the job, as a leader or a follower."""
+    pending, active = scheduler.snapshot()
+    return any(job["job_id"] == job_id for job in pending + active) or find_follower(job_id) is not None
+
+
+def on_evict(row: dict):
+    broker.publish("evicted", {"job_id": row["job_id"], "name": row["name"]})
+    publish_batch(row)
+
+
+# Disk quota, cold re-encoding and per-job usage (DISK_QUOTA_GB, COLD_AFTER_HOURS)
+lifecycle = LifecycleManager(OUTPUT_ROOT, store, is_busy=job_busy, on_evict=on_evict, cache=result_cache)
+lifecycle.start()
+
+
+def recover_jobs():
+    """Requeue jobs that were queued or running when the server stopped.
+
+    In-flight work (decoded audio, partial stems) lived in memory, so
+    interrupted jobs start over from the download. Like new jobs, they are
+    finished from the result cache or coalesced where possible; only the
+    pre-flight is skipped, as it passed before.
+    """
+    for row in store.unfinished():
+        if row["status"] == "cancelling":
+            store.set_status(row["job_id"], "cancelled")
+            continue
+        job = {key: row[key] for key in ("job_id", "url", "name", "mode", "priority", "output_root")}
+        job.update({key: row[key] for key in ("video_id", "title", "duration", "batch_id") if row[key] is not None})
+        outcome, found = reuse_result(job, row["video_id"] or resolve_video_id(row["url"]))
+        if outcome == "cached":
+            complete_job(job, found["bpm"], found["key"])
+        elif outcome == "coalesced":
+            store.set_status(job["job_id"], "queued")
+            broker.publish("queued", public_job(job))
         else:
-            time.sleep(1)
+            job["estimated_seconds"] = processing_rate.estimate(job["mode"], job.get("duration"))
+            submit_job(job)
+        print(f"Recovered job {job['job_id']} ({job['name']}), was {row['status']}" + (f", {outcome}" if outcome else ""))
+
+
+recover_jobs()
+
+collector.gauge("stems_queue_depth", "Jobs waiting to start", lambda: len(scheduler.snapshot()[0]))
+collector.gauge("stems_active_jobs", "Jobs past the queue and not yet finished", lambda: len(scheduler.snapshot()[1]))
+collector.gauge("stems_waiting_jobs", "Active jobs waiting for the next stage", lambda: sum(job.get("waiting", False) for job in scheduler.snapshot()[1]))
+collector.gauge("stems_worker_restarts", "Worker processes restarted after dying", lambda: sum(pool.restarts() for pool in worker_pools))
+collector.gauge("stems_memory_reserved_megabytes", "Estimated peak memory reserved by running jobs", admission.reserved_mb)
+collector.gauge("stems_memory_budget_megabytes", "Memory running jobs may reserve (0: unlimited)", lambda: admission.budget_mb)
+collector.gauge("stems_disk_bytes", "Bytes used by the job folders and the stem cache at the last lifecycle pass, shared files counted once", lambda: lifecycle.used_bytes())
+collector.gauge("stems_evictions", "Finished jobs deleted to stay under the disk quota", lambda: lifecycle.evictions)
+
+
+# Worker processes by pool, with each one's model registry load times and
+# hit/miss counts
+@app.get("/models")
+async def model_stats():
+    return JSONResponse({pool.name: pool.stats() for pool in worker_pools})
+
+# Stage latency histograms and queue gauges for Prometheus
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(collector.render(), media_type="text/plain; version=0.0.4")
+
+# Result cache size and hit/miss counts, and the same for rendered mixes
+@app.get("/cache")
+async def cache_stats():
+    return JSONResponse({**result_cache.stats(), "mixes": mix_cache.stats()})
+
+# Memory reserved by each running job, the budget, jobs held back for
+# memory, and the estimator's calibration from measured peaks
+@app.get("/memory")
+async def memory():
+    pending, _ = scheduler.snapshot()
+    waiting = [public_job(job) for job in pending if job.get("waiting_for_memory")]
+    return JSONResponse({**admission.snapshot(), "waiting": waiting})
 
-worker_thread = threading.Thread(target=job_worker, daemon=True)
-worker_thread.start()
+# Disk used by each finished job, largest first, as of the last lifecycle pass
+@app.get("/storage")
+async def storage(limit: int = 100):
+    return JSONResponse(lifecycle.report(max(1, limit)))
 
-#List of completed jobs
+# Completed jobs, newest first. Page back with before=<next_before>, or poll
+# for new ones, oldest first, with since=<next_since> (repeat while a full
+# page comes back). Cursors are "<completed_at>:<job_id>"; a bare
+# completed_at works too.
 @app.get("/completed")
-async def completed_jobs_endpoint():
-    return JSONResponse({"completed": list(reversed(completed_jobs))})
+async def completed_jobs_endpoint(limit: int = COMPLETED_PAGE_SIZE, before: str = None, since: str = None):
+    limit = max(1, min(limit, 500))
+    try:
+        before_cursor, since_cursor = parse_cursor(before), parse_cursor(since)
+    except ValueError:
+        return JSONResponse({"error": "Invalid cursor, expected <completed_at>:<job_id>"}, status_code=400)
+    rows = store.completed(limit, before=before_cursor, since=since_cursor)
+    response = {
+        "completed": [completed_entry(row) for row in rows],
+        "next_before": completed_cursor(rows[-1]) if len(rows) == limit and since is None else None,
+    }
+    if since is not None:
+        response["next_since"] = completed_cursor(rows[-1]) if rows else since
+    return JSONResponse(response)
 
-# Removes job from queue
+# Server-Sent Events: a snapshot on connect, then one message per change
+@app.get("/events")
+async def events(request: Request):
+    q = broker.subscribe()
+
+    async def stream():
+        try:
+            pending, active = scheduler.snapshot()
+            yield format_sse("snapshot", {
+                "queue": queued_jobs(pending, active),
+                "active": [public_job(job) for job in active],
+                "completed": [completed_entry(row) for row in store.completed(COMPLETED_PAGE_SIZE)],
+            })
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(q.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            broker.unsubscribe(q)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Removes a job from the queue, or cancels it if it has started. A running
+# job stops at its next stage or Demucs segment (202 until then).
 @app.post("/remove_job/{job_id}")
 async def remove_job(job_id: str):
-    with queue_lock:
-        for i, job in enumerate(job_queue):
-            if job["job_id"] == job_id:
-                job_queue.remove(job)
-                return JSONResponse({"removed": True})
+    follower = find_follower(job_id)
+    if follower is not None:
+        leader = follower["leader"]
+        with inflight_lock:
+            waiting = followers.get(leader["job_id"], [])
+            if follower in waiting:
+                waiting.remove(follower)
+            orphaned = leader.get("detached") and not waiting
+        follower.pop("leader", None)
+        store.set_status(job_id, "removed")
+        broker.publish("removed", {"job_id": job_id})
+        publish_batch({"job_id": job_id})
+        if orphaned and scheduler.cancel(leader["job_id"]) == "removed":
+            # Nobody is waiting for the result any more. A running leader is
+            # cleaned up by on_cancel; one that hadn't started is gone now.
+            drop_job(leader)
+        return JSONResponse({"removed": True})
+
+    pending, active = scheduler.snapshot()
+    job = next((job for job in pending + active if job["job_id"] == job_id), None)
+    if job is not None and not job.get("detached") and followers_of(job):
+        # Other requests are waiting for this computation: keep it running
+        # for them and drop only this job
+        job["detached"] = True
+        store.set_status(job_id, "cancelled")
+        collector.jobs.inc("cancelled")
+        broker.publish("cancelled", {"job_id": job_id})
+        publish_batch(job)
+        return JSONResponse({"removed": True})
+
+    outcome = scheduler.cancel(job_id)
+    if outcome == "removed":
+        store.set_status(job_id, "removed")
+        broker.publish("removed", {"job_id": job_id})
+        publish_batch({"job_id": job_id})
+        if job is not None:
+            drop_job(job)
+        return JSONResponse({"removed": True})
+    if outcome == "cancelling":
+        store.set_status(job_id, "cancelling")
+        broker.publish("cancelling", {"job_id": job_id})
+        return JSONResponse({"removed": False, "cancelling": True}, status_code=202)
     return JSONResponse({"removed": False, "reason": "Not found"}, status_code=404)
 
 
@@ -125,22 +719,99 @@ async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post("/start")
-async def start(url: str = Form(...), name: str = Form(...), mode: str = Form('stem')):
-    job_id = str(uuid.uuid4())[:8]
-    job_dir = OUTPUT_ROOT / job_id
-    final_dir = job_dir / name
-    final_dir.mkdir(parents=True, exist_ok=True)
-    (job_dir / "status.txt").write_text("queued")
-    job = {"job_id": job_id, "url": url, "name": name, "mode": mode}
-    with queue_lock:
-        job_queue.append(job)
-    return JSONResponse({"job_id": job_id, "song_name": name, "output_folder": str(final_dir)})
+async def start(url: str = Form(...), name: str = Form(...), mode: str = Form('stem'), priority: str = Form('normal')):
+    if priority not in PRIORITY_CLASSES:
+        return JSONResponse({"error": f"Unknown priority {priority!r}, expected one of {', '.join(PRIORITY_CLASSES)}"}, status_code=400)
+    job = new_job(url, name, mode, priority)
+    try:
+        return JSONResponse(await admit(job))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+# Queue many tracks at once: `urls` holds video and/or playlist URLs, one
+# per line. Tracks already done are skipped; the rest form one batch.
+@app.post("/bulk")
+async def bulk(urls: str = Form(...), mode: str = Form('stem'), priority: str = Form('normal')):
+    if priority not in PRIORITY_CLASSES:
+        return JSONResponse({"error": f"Unknown priority {priority!r}, expected one of {', '.join(PRIORITY_CLASSES)}"}, status_code=400)
+    lines = urls.split()
+    if not lines:
+        return JSONResponse({"error": "No URLs given"}, status_code=400)
+
+    title, entries, rejected = None, [], []
+    for line in lines:
+        if is_playlist(line):
+            try:
+                playlist_title, found = await run_in_threadpool(expand_playlist, line, MAX_BATCH_TRACKS)
+            except ValueError as e:
+                rejected.append({"url": line, "error": str(e)})
+                continue
+            title = title or playlist_title
+            entries.extend(found)
+        else:
+            entries.append({"url": line})
+    if len(entries) > MAX_BATCH_TRACKS:
+        rejected.extend({"url": entry["url"], "error": f"Over the {MAX_BATCH_TRACKS} track limit"} for entry in entries[MAX_BATCH_TRACKS:])
+        entries = entries[:MAX_BATCH_TRACKS]
+
+    # Drop repeats and tracks that already have stems
+    tracks, skipped, seen = [], [], set()
+    for entry in entries:
+        video_id = resolve_video_id(entry["url"])
+        if (video_id or entry["url"]) in seen:
+            continue
+        seen.add(video_id or entry["url"])
+        done = store.find_done(video_id, mode) if video_id else None
+        if done and (OUTPUT_ROOT / done["job_id"] / done["name"]).is_dir():
+            skipped.append({"url": entry["url"], "video_id": video_id, "job_id": done["job_id"], "name": done["name"]})
+        else:
+            tracks.append(entry)
+
+    # Resolve names and reject bad tracks concurrently; admit() reuses the
+    # cached metadata afterwards
+    limit = asyncio.Semaphore(BULK_PREFLIGHT_WORKERS)
+
+    async def resolve(entry: dict):
+        async with limit:
+            try:
+                return await run_in_threadpool(preflight, entry["url"], max_duration_for(mode)), None
+            except ValueError as e:
+                return None, str(e)
+
+    resolved = await asyncio.gather(*(resolve(entry) for entry in tracks))
+    batch_id = str(uuid.uuid4())[:8]
+    store.create_batch(batch_id, title, " ".join(lines), skipped, rejected)
+    for entry, (info, error) in zip(tracks, resolved):
+        if error is None:
+            job = new_job(entry["url"], track_name(info.get("title") or entry.get("title"), info.get("id") or "track"), mode, priority, batch_id)
+            try:
+                await admit(job)
+                continue
+            except ValueError as e:
+                error = str(e)
+        rejected.append({"url": entry["url"], "error": error})
+    # Rejections found while admitting are recorded too
+    store.update_batch(batch_id, rejected=rejected)
+    return JSONResponse(batch_view(batch_id))
+
+# Progress of a /bulk batch: counts by status, overall progress and each track
+@app.get("/batch/{batch_id}")
+async def get_batch(batch_id: str):
+    view = batch_view(batch_id)
+    if view is None:
+        return JSONResponse({"error": "Batch not found"}, status_code=404)
+    return JSONResponse(view)
 
 @app.get("/queue")
 async def get_queue():
-    with queue_lock:
-        queue_list = list(job_queue)
-    return JSONResponse({"queue": queue_list, "current_job": current_job})
+    pending, active = scheduler.snapshot()
+    queue = queued_jobs(pending, active)
+    active = [public_job(job) for job in active]
+    return JSONResponse({
+        "queue": queue,
+        "current_job": active[0] if active else None,
+        "active": active,
+    })
 
 @app.get("/job/{job_id}/{song_name}", response_class=HTMLResponse)
 async def job_page(request: Request, job_id: str, song_name: str):
@@ -151,42 +822,107 @@ async def job_page(request: Request, job_id: str, song_name: str):
         "OUTPUT_ROOT": OUTPUT_ROOT
     })
 
-@app.get("/download/{job_id}/{song_name}/{filename}")
-async def download(job_id: str, song_name: str, filename: str):
-    return FileResponse(OUTPUT_ROOT / job_id / song_name / filename, filename=filename)
+# Downloads answer Range requests (so players can seek) and conditional
+# requests against their ETag (so browsers can keep stems between visits).
+# WAV URLs of stems re-encoded to FLAC since are decoded back on the fly.
+@app.api_route("/download/{job_id}/{song_name}/{filename}", methods=["GET", "HEAD"])
+async def download(request: Request, job_id: str, song_name: str, filename: str):
+    lifecycle.touch(job_id)
+    return stem_response(request, OUTPUT_ROOT / job_id / song_name / filename, filename=filename)
+
+# Preview stems, until the full job replaces them
+@app.api_route("/download/{job_id}/{song_name}/preview/{filename}", methods=["GET", "HEAD"])
+async def download_preview(request: Request, job_id: str, song_name: str, filename: str):
+    return file_response(request, OUTPUT_ROOT / job_id / song_name / PREVIEW_DIR / filename, filename=filename, max_age=0)
+
+# Every file of a finished job in one ZIP, streamed as it is read from disk
+@app.api_route("/download_all/{job_id}", methods=["GET", "HEAD"])
+async def download_all(request: Request, job_id: str):
+    row = store.get(job_id)
+    if row is None:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    if row["status"] != "done":
+        return JSONResponse({"error": f"Job is {row['status']}"}, status_code=409)
+    files = bundle_files(OUTPUT_ROOT / job_id / row["name"])
+    if not files:
+        return JSONResponse({"error": "No files"}, status_code=404)
+    lifecycle.touch(job_id)
+    return zip_response(request, files, row["name"])
+
+# A finished job's stems summed on the server: ?preset=instrumental (or
+# acapella, drumless, bassless) and/or per-stem gains like ?drums=1&vocals=0.5,
+# as WAV or format=mp3. Rendered mixes are cached, so repeats are plain downloads.
+@app.api_route("/mix/{job_id}", methods=["GET", "HEAD"])
+async def mix(request: Request, job_id: str, format: str = "wav"):
+    row = store.get(job_id)
+    if row is None:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    if row["status"] != "done":
+        return JSONResponse({"error": f"Job is {row['status']}"}, status_code=409)
+    if format not in MIX_FORMATS:
+        return JSONResponse({"error": f"Unknown format {format!r}, expected one of {', '.join(MIX_FORMATS)}"}, status_code=400)
+    stems = job_stems(OUTPUT_ROOT / job_id / row["name"], row["name"])
+    if not stems:
+        return JSONResponse({"error": "Job has no stems"}, status_code=404)
+    try:
+        gains = parse_gains(dict(request.query_params), list(stems))
+    except ValueError as e:
+        return JSONResponse({"error": str(e), "stems": list(stems)}, status_code=400)
+    lifecycle.touch(job_id)
+    path = await run_in_threadpool(mix_cache.get, job_id, stems, gains, format)
+    label = request.query_params.get("preset") or "+".join(gains)
+    return file_response(request, path, filename=f"{row['name']}[{label}].{format}")
+
+# Precomputed waveform peaks for a stem, so the player doesn't fetch the audio
+@app.get("/peaks/{job_id}/{song_name}/{filename}")
+async def get_peaks(request: Request, job_id: str, song_name: str, filename: str):
+    return await peaks_response(request, OUTPUT_ROOT / job_id / song_name / filename)
+
+@app.get("/peaks/{job_id}/{song_name}/preview/{filename}")
+async def get_preview_peaks(request: Request, job_id: str, song_name: str, filename: str):
+    return await peaks_response(request, OUTPUT_ROOT / job_id / song_name / PREVIEW_DIR / filename, max_age=0)
+
+async def peaks_response(request: Request, audio_path: Path, **kwargs):
+    audio_path = reencoded_source(audio_path) or audio_path
+    path = peaks_path(audio_path)
+    if not path.exists():
+        # Files that didn't come out of the splitter (e.g. YouTube mode mp3s)
+        if not audio_path.is_file():
+            return JSONResponse({"error": "Peaks not found"}, status_code=404)
+        path = await run_in_threadpool(ensure_peaks, audio_path)
+    return file_response(request, path, media_type="application/json", **kwargs)
 
 @app.get("/status/{job_id}")
 async def get_status(job_id: str):
     """Get the current status of a job"""
-    status_file = OUTPUT_ROOT / job_id / "status.txt"
-    if not status_file.exists():
+    row = store.get(job_id)
+    if row is None:
         return JSONResponse({"status": "not_found"}, status_code=404)
-    
-    status = status_file.read_text().strip()
-    error = None
-    bpm = None
-    key = None
+
     progress = None
-    
-    if status == "error":
-        error_file = OUTPUT_ROOT / job_id / "error.txt"
-        if error_file.exists():
-            error = error_file.read_text().strip()
-    elif status == "done":
-        # Read metadata if available
-        metadata_file = OUTPUT_ROOT / job_id / "metadata.txt"
-        if metadata_file.exists():
-            try:
-                metadata = metadata_file.read_text().strip()
-                for line in metadata.split('\n'):
-                    if line.startswith('BPM:'):
-                        bpm = line.replace('BPM:', '').strip()
-                    elif line.startswith('Key:'):
-                        key = line.replace('Key:', '').strip()
-            except:
-                pass
-    
-    return JSONResponse({"status": status, "error": error, "bpm": bpm, "key": key, "progress": progress})
+    metrics = row["metrics"]
+    _, active = scheduler.snapshot()
+    for job in active:
+        if job["job_id"] == job_id:
+            progress = job.get("progress")
+            metrics = job_metrics(job)
+    follower = find_follower(job_id)
+    if follower is not None:
+        progress = public_job(follower)["progress"]
+
+    # Until the job is done, the preview (if any) holds the only stems and a
+    # provisional BPM/key
+    return JSONResponse({
+        "status": row["status"],
+        "stage": row["stage"],
+        "error": row["error"],
+        "tier": "full" if row["status"] == "done" else ("preview" if row["preview"] else None),
+        "bpm": format_bpm(row["bpm"]) if row["status"] == "done" else None,
+        "key": row["key"] if row["status"] == "done" else None,
+        "preview": public_preview(row["preview"]) if row["preview"] else None,
+        "progress": progress,
+        "metrics": metrics,
+    })
 
 
 @app.get("/files/{job_id}/{song_name}")
@@ -203,5 +939,7 @@ async def list_files(job_id: str, song_name: str):
                 "name": file_path.name,
                 "url": f"/download/{job_id}/{song_name}/{file_path.name}"
             })
-    
-    return JSONResponse({"files": files})
\ No newline at end of file
+
+    preview_folder = folder / PREVIEW_DIR
+    preview = file_entries(job_id, song_name, sorted(p for p in preview_folder.iterdir() if p.is_file()), PREVIEW_DIR) if preview_folder.is_dir() else []
+    return JSONResponse({"files": files, "preview": preview})
\ No newline at end of file
@@ -0,0 +1,280 @@
+# metrics.py
+# Times pipeline stages per job and aggregates them in Prometheus text format
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Histogram buckets (seconds) for stage and step latency
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process (0 if it can't be read)."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Peak, not current
+    except ImportError:
+        return 0
+
+
+class RssSampler:
+    """Background thread that tracks peak RSS for every open timer.
+
+    RSS is process-wide, so when jobs overlap each one sees the other's
+    memory too; the peak is an upper bound for the step itself. The thread
+    only runs while at least one timer is open.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.records = []
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def open(self, record: dict):
+        record["peak_rss_bytes"] = current_rss_bytes()
+        with self.cond:
+            self.records.append(record)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def close(self, record: dict):
+        rss = current_rss_bytes()
+        with self.cond:
+            self.records.remove(record)
+        record["peak_rss_bytes"] = max(record["peak_rss_bytes"], rss)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.records:
+                    self.cond.wait()
+            rss = current_rss_bytes()
+            with self.cond:
+                for record in self.records:
+                    record["peak_rss_bytes"] = max(record["peak_rss_bytes"], rss)
+            time.sleep(self.interval)
+
+
+class Histogram:
+    """A Prometheus histogram with one label."""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}  # label value -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        with self.lock:
+            series = self.series.setdefault(label_value, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for value, series in sorted(self.series.items()):
+                label = f'{self.label}="{value}"'
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+                lines.append(f"{self.name}_sum{{{label}}} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+class Counter:
+    """A Prometheus counter with one label."""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for value, total in sorted(self.values.items()):
+                lines.append(f'{self.name}{{{self.label}="{value}"}} {total:g}')
+        return lines
+
+
+class MetricsCollector:
+    """Process-wide aggregates behind the `/metrics` endpoint.
+
+    Gauges are callbacks evaluated at scrape time, so queue depth and active
+    jobs are always read straight from the scheduler.
+    """
+
+    def __init__(self):
+        self.stage_seconds = Histogram("stems_stage_duration_seconds", "Wall time of scheduler stages", "stage")
+        self.step_seconds = Histogram("stems_step_duration_seconds", "Wall time of steps within stages", "step")
+        self.cpu_seconds = Counter("stems_cpu_seconds_total", "CPU time of the thread running each stage or step", "name")
+        self.jobs = Counter("stems_jobs_total", "Finished jobs by outcome", "status")
+        self.gauges = {}
+        self.peak_rss = {}
+        self.lock = threading.Lock()
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], float]):
+        self.gauges[name] = (help_text, read)
+
+    def observe(self, record: dict):
+        histogram = self.stage_seconds if record["kind"] == "stage" else self.step_seconds
+        histogram.observe(record["name"], record["wall_s"])
+        if record.get("cpu_s") is not None:
+            self.cpu_seconds.inc(record["name"], record["cpu_s"])
+        if record.get("peak_rss_mb") is not None:
+            with self.lock:
+                self.peak_rss[record["name"]] = max(self.peak_rss.get(record["name"], 0), record["peak_rss_mb"])
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.stage_seconds, self.step_seconds, self.cpu_seconds, self.jobs):
+            lines += metric.render()
+        lines += [
+            "# HELP stems_peak_rss_megabytes Highest process RSS seen during each stage or step",
+            "# TYPE stems_peak_rss_megabytes gauge",
+        ]
+        with self.lock:
+            for name, peak in sorted(self.peak_rss.items()):
+                lines.append(f'stems_peak_rss_megabytes{{name="{name}"}} {peak}')
+        for name, (help_text, read) in self.gauges.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {read():g}"]
+        return "\n".join(lines) + "\n"
+
+
+collector = MetricsCollector()
+sampler = RssSampler()
+_current = threading.local()
+
+
+class JobMetrics:
+    """Timing records for one job, in the order they finished."""
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, record: dict):
+        with self.lock:
+            self.records.append(record)
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            records = list(self.records)
+        totals = {}
+        for record in records:
+            totals[record["name"]] = round(totals.get(record["name"], 0) + record["wall_s"], 4)
+        return {"records": records, "totals": totals}
+
+    def save(self, path):
+        Path(path).write_text(json.dumps(self.to_dict(), indent=2))
+
+
+@contextmanager
+def job_context(job_metrics: Optional[JobMetrics]):
+    """Make `timed` blocks in this thread record into `job_metrics`."""
+    previous = getattr(_current, "job", None)
+    _current.job = job_metrics
+    try:
+        yield job_metrics
+    finally:
+        _current.job = previous
+
+
+def current_job_metrics() -> Optional[JobMetrics]:
+    """The JobMetrics of this thread, to hand to helper threads."""
+    return getattr(_current, "job", None)
+
+
+@contextmanager
+def timed(name: str, kind: str = "step", job_metrics: Optional[JobMetrics] = None):
+    """Record wall time, thread CPU time and peak RSS of the block.
+
+    Records go to `job_metrics`, or the job set with `job_context` on this
+    thread, and always to the process-wide collector. CPU time is the
+    calling thread's; work torch spreads over its own thread pool (the bulk
+    of separation) shows up in wall time only.
+    """
+    job_metrics = job_metrics or current_job_metrics()
+    record = {"name": name, "kind": kind, "started_at": round(time.time(), 3)}
+    sampler.open(record)
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield record
+    finally:
+        record["wall_s"] = round(time.perf_counter() - wall, 4)
+        record["cpu_s"] = round(time.thread_time() - cpu, 4)
+        sampler.close(record)
+        record["peak_rss_mb"] = round(record.pop("peak_rss_bytes") / (1024 * 1024), 1)
+        collector.observe(record)
+        if job_metrics is not None:
+            job_metrics.add(record)
+
+
+def record_wait(job_metrics: Optional[JobMetrics], seconds: float, before: str):
+    """Record time a job spent queued before stage `before`."""
+    record = {"name": "queue_wait", "kind": "step", "before": before, "started_at": round(time.time() - seconds, 3), "wall_s": round(seconds, 4)}
+    collector.observe(record)
+    if job_metrics is not None:
+        job_metrics.add(record)
+
+
+class RateEstimator:
+    """Processing seconds per second of audio, learned from finished jobs.
+
+    A moving average per job mode, starting from a rough default, used to
+    estimate how long a queued job will take from its duration.
+    """
+
+    def __init__(self, defaults: dict, weight: float = 0.3):
+        self.rates = dict(defaults)
+        self.weight = weight
+        self.lock = threading.Lock()
+
+    def update(self, mode: str, processing_seconds: float, audio_seconds: float):
+        if not audio_seconds or processing_seconds <= 0:
+            return
+        rate = processing_seconds / audio_seconds
+        with self.lock:
+            old = self.rates.get(mode)
+            self.rates[mode] = rate if old is None else (1 - self.weight) * old + self.weight * rate
+
+    def estimate(self, mode: str, audio_seconds: float) -> Optional[float]:
+        with self.lock:
+            rate = self.rates.get(mode)
+        if rate is None or not audio_seconds:
+            return None
+        return round(rate * audio_seconds, 1)
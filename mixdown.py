@@ -0,0 +1,272 @@
+# mixdown.py
+# Sums a job's stems with per-stem gains into one file, reading the WAVs through memory maps
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import soundfile as sf
+
+from audio_io import FFmpegWriter
+
+MIX_FORMATS = ("wav", "mp3")
+# Gains are linear; 1 is the stem as written
+MAX_GAIN = 4.0
+# Named mixes, on top of explicit per-stem gains
+MIX_PRESETS = {
+    "instrumental": {"drums": 1.0, "bass": 1.0, "melody": 1.0},
+    "acapella": {"vocals": 1.0},
+    "drumless": {"bass": 1.0, "melody": 1.0, "vocals": 1.0},
+    "bassless": {"drums": 1.0, "melody": 1.0, "vocals": 1.0},
+}
+# Frames summed per step: big enough to keep NumPy busy, small enough that
+# the working buffers stay in cache and little of each stem is paged in at once
+MIX_BLOCK_FRAMES = 1 << 16
+MIX_CACHE_ROOT = Path(os.environ.get("MIX_CACHE_ROOT", "./mix_cache"))
+MIX_CACHE_MB = float(os.environ.get("MIX_CACHE_MB", 2048))
+
+# WAVE_FORMAT_PCM and WAVE_FORMAT_IEEE_FLOAT; EXTENSIBLE carries one of them
+# in the first two bytes of its subformat GUID
+WAV_DTYPES = {(1, 16): "<i2", (1, 32): "<i4", (3, 32): "<f4", (3, 64): "<f8"}
+
+
+class MappedWav:
+    """A PCM or float WAV's samples, memory-mapped where they lie in the file.
+
+    Nothing is read until a block is asked for, and the OS pages it in (and
+    out again) as needed, so a mix never holds whole stems in memory.
+    """
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+            if riff != b"RIFF" or wave != b"WAVE":
+                raise ValueError(f"{path.name} is not a WAV file")
+            fmt = None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise ValueError(f"{path.name} has no data chunk")
+                chunk_id, size = struct.unpack("<4sI", header)
+                if chunk_id == b"fmt ":
+                    body = f.read(size)
+                    tag, channels, samplerate = struct.unpack("<HHI", body[:8])
+                    bits = struct.unpack("<H", body[14:16])[0]
+                    if tag == 0xFFFE:
+                        tag = struct.unpack("<H", body[24:26])[0]
+                    fmt = (tag, bits, channels, samplerate)
+                elif chunk_id == b"data":
+                    offset = f.tell()
+                    break
+                else:
+                    f.seek(size, 1)
+                if size % 2:
+                    f.seek(1, 1)  # Chunks are word-aligned
+        if fmt is None or (fmt[0], fmt[1]) not in WAV_DTYPES:
+            raise ValueError(f"{path.name} is not 16/32-bit PCM or float")
+        tag, bits, self.channels, self.samplerate = fmt
+        dtype = np.dtype(WAV_DTYPES[(tag, bits)])
+        # The size field can be wrong (or 0xFFFFFFFF) in streamed WAVs; trust the file length
+        size = min(size, path.stat().st_size - offset)
+        self.frames = size // (dtype.itemsize * self.channels)
+        self.scale = 1.0 / (1 << (bits - 1)) if tag == 1 else 1.0
+        self.samples = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(self.frames, self.channels))
+
+    def read_scaled(self, start: int, stop: int, gain: float, out: np.ndarray):
+        """Write gain * frames [start, stop) into out, a (frames, channels) float32 array."""
+        # Converts and scales in one pass, straight from the mapped samples
+        np.multiply(self.samples[start:stop], np.float32(gain * self.scale), out=out)
+
+
+class SoundFileStem:
+    """Same interface as MappedWav for formats that can't be mapped (e.g. FLAC), read block by block."""
+
+    def __init__(self, path: Path):
+        self.file = sf.SoundFile(str(path))
+        self.channels = self.file.channels
+        self.samplerate = self.file.samplerate
+        self.frames = self.file.frames
+
+    def read_scaled(self, start: int, stop: int, gain: float, out: np.ndarray):
+        self.file.seek(start)
+        self.file.read(stop - start, dtype="float32", always_2d=True, out=out)
+        out *= np.float32(gain)
+
+
+def open_stem(path: Path):
+    if path.suffix.lower() == ".wav":
+        try:
+            return MappedWav(path)
+        except ValueError:
+            pass
+    return SoundFileStem(path)
+
+
+def job_stems(song_dir: Path, song_name: str) -> Dict[str, Path]:
+    """A job's stem files by tag (`<song>[drums].wav` -> "drums"), without the full mix."""
+    stems = {}
+    prefix = f"{song_name}["
+    for path in sorted(song_dir.iterdir()) if song_dir.is_dir() else []:
+        if not path.is_file() or not path.name.startswith(prefix) or "]" not in path.name[len(prefix):]:
+            continue
+        tag = path.name[len(prefix):path.name.rindex("]")]
+        # Prefer WAV (memory-mappable) when a stem exists in several formats
+        if tag != "full" and (tag not in stems or path.suffix.lower() == ".wav"):
+            stems[tag] = path
+    return stems
+
+
+def parse_gains(params: Dict[str, str], tags: List[str]) -> Dict[str, float]:
+    """Per-stem gains from query parameters: a `preset`, then `<stem>=<gain>` overrides."""
+    preset = params.get("preset")
+    if preset is not None and preset not in MIX_PRESETS:
+        raise ValueError(f"Unknown preset {preset!r}, expected one of {', '.join(MIX_PRESETS)}")
+    unknown = [name for name in params if name not in tags and name not in ("preset", "format")]
+    if unknown:
+        raise ValueError(f"Job has no {', '.join(unknown)} stem")
+    gains = dict(MIX_PRESETS.get(preset, {}))
+    for tag in tags:
+        if tag in params:
+            try:
+                gains[tag] = float(params[tag])
+            except ValueError:
+                raise ValueError(f"Gain for {tag} must be a number")
+            if not 0 <= gains[tag] <= MAX_GAIN:
+                raise ValueError(f"Gain for {tag} must be between 0 and {MAX_GAIN:g}")
+    gains = {tag: gain for tag, gain in gains.items() if gain > 0}
+    missing = [tag for tag in gains if tag not in tags]
+    if missing:
+        raise ValueError(f"Job has no {', '.join(missing)} stem")
+    if not gains:
+        raise ValueError("Pick at least one stem (e.g. ?drums=1&bass=1) or a preset")
+    return gains
+
+
+def render_mix(stems: Dict[str, Path], gains: Dict[str, float], path: Path, fmt: str):
+    """Write the gain-weighted sum of stems to path, MIX_BLOCK_FRAMES at a time."""
+    sources = {tag: open_stem(stems[tag]) for tag in gains}
+    first = next(iter(sources.values()))
+    samplerate, channels = first.samplerate, first.channels
+    frames = min(source.frames for source in sources.values())
+    if any(source.samplerate != samplerate or source.channels != channels for source in sources.values()):
+        raise ValueError("Stems differ in sample rate or channel count")
+
+    if fmt == "mp3":
+        writer = FFmpegWriter(path, samplerate, channels)
+        write = lambda block: writer.write(block.T)
+    else:
+        # Converted to 16-bit here, in place, rather than by libsndfile
+        writer = sf.SoundFile(str(path), "w", samplerate, channels, subtype="PCM_16", format="WAV")
+
+        def write(block):
+            block *= 32767
+            writer.write(np.rint(block, out=block).astype(np.int16))
+    try:
+        mix = np.empty((MIX_BLOCK_FRAMES, channels), dtype=np.float32)
+        scratch = np.empty_like(mix)
+        for start in range(0, frames, MIX_BLOCK_FRAMES):
+            stop = min(start + MIX_BLOCK_FRAMES, frames)
+            out, part = mix[:stop - start], scratch[:stop - start]
+            for i, (tag, source) in enumerate(sources.items()):
+                source.read_scaled(start, stop, gains[tag], part if i else out)
+                if i:
+                    out += part
+            np.clip(out, -1.0, 1.0, out=out)
+            write(out)
+    finally:
+        writer.close()
+
+
+class MixCache:
+    """Rendered mixes on disk, evicted least-recently-used by total size.
+
+    Keys cover the stem files' sizes and mtimes, so re-encoded or replaced
+    stems never serve a stale mix. A file's mtime records its last hit, so
+    the LRU order survives restarts.
+    """
+
+    def __init__(self, root: Path = MIX_CACHE_ROOT, max_bytes: int = int(MIX_CACHE_MB * 1024 ** 2)):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.rendering = {}  # key -> lock, so concurrent requests render a mix once
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = {
+            path.name: {"size": path.stat().st_size, "atime": path.stat().st_mtime}
+            for path in self.root.iterdir() if path.is_file() and not path.name.startswith(".")
+        }
+
+    @staticmethod
+    def key(job_id: str, stems: Dict[str, Path], gains: Dict[str, float], fmt: str) -> str:
+        files = {tag: [stems[tag].name, stems[tag].stat().st_size, stems[tag].stat().st_mtime_ns] for tag in gains}
+        payload = json.dumps({"job_id": job_id, "files": files, "gains": gains, "format": fmt}, sort_keys=True)
+        return f"{hashlib.sha256(payload.encode()).hexdigest()[:32]}.{fmt}"
+
+    def get(self, job_id: str, stems: Dict[str, Path], gains: Dict[str, float], fmt: str) -> Path:
+        """Path of the rendered mix, rendering it first on a miss."""
+        key = self.key(job_id, stems, gains, fmt)
+        path = self.root / key
+        if self._hit(key):
+            return path
+        with self.lock:
+            render_lock = self.rendering.setdefault(key, threading.Lock())
+        with render_lock:
+            # Another request may have rendered it while this one waited
+            if self._hit(key, count_miss=True):
+                return path
+            tmp = self.root / f".{key}.tmp.{fmt}"  # Hidden until complete
+            try:
+                render_mix(stems, gains, tmp, fmt)
+                tmp.rename(path)
+                with self.lock:
+                    self.entries[key] = {"size": path.stat().st_size, "atime": time.time()}
+                    self._evict(keep=key)
+            finally:
+                tmp.unlink(missing_ok=True)
+                with self.lock:
+                    self.rendering.pop(key, None)
+        return path
+
+    def _hit(self, key: str, count_miss: bool = False) -> bool:
+        with self.lock:
+            if key in self.entries and (self.root / key).exists():
+                self.hits += 1
+                self.entries[key]["atime"] = time.time()
+                os.utime(self.root / key)
+                return True
+            if count_miss:
+                self.misses += 1
+            return False
+
+    def _evict(self, keep: Optional[str] = None):
+        # Caller holds the lock
+        total = sum(entry["size"] for entry in self.entries.values())
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["atime"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.entries.pop(key)["size"]
+            (self.root / key).unlink(missing_ok=True)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": sum(entry["size"] for entry in self.entries.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
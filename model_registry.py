@@ -0,0 +1,149 @@
+# model_registry.py
+# Keeps Demucs models loaded between jobs so each song doesn't pay for a cold load
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from demucs.pretrained import get_model
+
+from inference import prepare_model
+
+
+DEFAULT_MAX_MODELS = 2
+DEFAULT_MEMORY_BUDGET_MB = 2048
+
+
+def model_size_bytes(model) -> int:
+    """Approximate resident size of a model from its parameters and buffers."""
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def variant_name(model_name: str, device: str, backend: str = "fp32", **options) -> str:
+    name = f"{model_name}@{device}"
+    if backend != "fp32":
+        name += f"/{backend}" + "".join(f"-{key}{value}" for key, value in sorted(options.items()))
+    return name
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models keyed by (model_name, device, backend).
+
+    Backends other than fp32 (see inference.py) are built from the fp32 model,
+    which is itself loaded through the registry; `options` are passed on to
+    inference.prepare_model.
+
+    Models are evicted least-recently-used first once more than `max_models`
+    are loaded or their combined size exceeds `memory_budget_mb`. The most
+    recently requested model is never evicted, even if it alone is over budget.
+    """
+
+    def __init__(self, max_models: int = DEFAULT_MAX_MODELS, memory_budget_mb: int = DEFAULT_MEMORY_BUDGET_MB):
+        self.max_models = max_models
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = {}
+
+    def get(self, model_name: str, device: str = "cpu", backend: str = "fp32", **options):
+        key = (model_name, device, backend, tuple(sorted(options.items())))
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key]
+            # Only one thread loads a given model; others wait for it
+            event = self._loading.get(key)
+            if event is None:
+                event = threading.Event()
+                self._loading[key] = event
+                loader = True
+                self.misses += 1
+            else:
+                loader = False
+
+        if not loader:
+            event.wait()
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    self.hits += 1
+                    return self._models[key]
+            # The loading thread failed; try again ourselves
+            return self.get(model_name, device, backend, **options)
+
+        try:
+            model = self._load(key)
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            event.set()
+        return model
+
+    def _load(self, key: tuple):
+        model_name, device, backend, options = key
+        name = variant_name(model_name, device, backend, **dict(options))
+        print(f"Loading {name}...")
+        start = time.perf_counter()
+        if backend != "fp32":
+            model = prepare_model(self.get(model_name, device), model_name, backend, **dict(options))
+        else:
+            model = get_model(model_name)
+            model.eval()
+            if device == "cuda":
+                model = model.cuda()
+                try:
+                    model = model.half()
+                except Exception:
+                    pass
+        elapsed = time.perf_counter() - start
+        print(f"Loaded {name} in {elapsed:.2f}s")
+
+        with self._lock:
+            self._models[key] = model
+            self._sizes[key] = model_size_bytes(model)
+            self.load_seconds[name] = round(elapsed, 3)
+            self._evict()
+        return model
+
+    def _evict(self):
+        # Caller holds the lock
+        while len(self._models) > 1 and (
+            len(self._models) > self.max_models
+            or sum(self._sizes.values()) > self.memory_budget
+        ):
+            key, _ = self._models.popitem(last=False)
+            self._sizes.pop(key, None)
+            self.evictions += 1
+            print(f"Evicted {variant_name(key[0], key[1], key[2], **dict(key[3]))} from model registry")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def preload(self, model_name: str, device: str = None, **variant):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        return self.get(model_name, device, **variant)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "loaded": [variant_name(name, device, backend, **dict(options)) for name, device, backend, options in self._models],
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "load_seconds": dict(self.load_seconds),
+                "memory_mb": round(sum(self._sizes.values()) / (1024 * 1024), 1),
+            }
+
+
+registry = ModelRegistry()
@@ -0,0 +1,122 @@
+# peaks.py
+# Precomputes waveform peaks so the browser never has to decode full stems
+import json
+from pathlib import Path
+
+import numpy as np
+
+# Buckets per zoom level. Each level must divide the finest one.
+PEAK_LEVELS = (4096, 1024, 256)
+PEAKS_DIR = ".peaks"
+# Rate ffmpeg decodes to for files libsndfile can't read
+PEAKS_FALLBACK_SAMPLERATE = 44100
+
+
+def peaks_path(audio_path) -> Path:
+    """Where the peaks for an output file live: a hidden folder next to it."""
+    audio_path = Path(audio_path)
+    return audio_path.parent / PEAKS_DIR / f"{audio_path.name}.json"
+
+
+def compute_peaks(samples: np.ndarray, samplerate: int, levels=PEAK_LEVELS) -> dict:
+    """Min/max per bucket at several zoom levels, quantized to int8.
+
+    Only the finest level touches the audio; coarser levels are reduced from
+    it, so the cost is one vectorized pass over the samples.
+    """
+    samples = np.asarray(samples, dtype=np.float32).reshape(-1)
+    length = len(samples)
+    finest = max(levels)
+    size = max(1, -(-length // finest))
+    mins, maxs = bucket_minmax(samples, size, finest)
+    return peak_pyramid(mins, maxs, size, length, samplerate, levels)
+
+
+def bucket_minmax(samples: np.ndarray, size: int, buckets: int):
+    """Min and max of consecutive `size`-sample buckets; missing buckets are 0."""
+    mins = np.zeros(buckets, dtype=np.float32)
+    maxs = np.zeros(buckets, dtype=np.float32)
+    whole = min(len(samples) // size, buckets)
+    if whole:
+        body = samples[:whole * size].reshape(whole, size)
+        mins[:whole] = body.min(axis=1)
+        maxs[:whole] = body.max(axis=1)
+    if whole < buckets and len(samples) > whole * size:
+        tail = samples[whole * size:(whole + 1) * size]
+        mins[whole] = tail.min()
+        maxs[whole] = tail.max()
+    return mins, maxs
+
+
+def peak_pyramid(mins: np.ndarray, maxs: np.ndarray, size: int, length: int, samplerate: int, levels=PEAK_LEVELS) -> dict:
+    finest = len(mins)
+    scale = float(max(np.abs(mins).max(), np.abs(maxs).max())) or 1.0
+    result = {
+        "version": 1,
+        "sample_rate": samplerate,
+        "length": length,
+        "scale": scale,
+        "levels": [],
+    }
+    for buckets in sorted(levels, reverse=True):
+        factor = finest // buckets
+        level_min = mins.reshape(buckets, factor).min(axis=1)
+        level_max = maxs.reshape(buckets, factor).max(axis=1)
+        result["levels"].append({
+            "buckets": buckets,
+            "samples_per_bucket": size * factor,
+            "min": np.round(level_min / scale * 127).astype(np.int8).tolist(),
+            "max": np.round(level_max / scale * 127).astype(np.int8).tolist(),
+        })
+    return result
+
+
+def compute_peaks_from_file(audio_path, levels=PEAK_LEVELS) -> dict:
+    """Same as compute_peaks, but reads the file block by block."""
+    import soundfile as sf
+    info = sf.info(str(audio_path))
+    length = info.frames
+    finest = max(levels)
+    size = max(1, -(-length // finest))
+    mins = np.zeros(finest, dtype=np.float32)
+    maxs = np.zeros(finest, dtype=np.float32)
+    # Whole buckets per block, so blocks never split a bucket
+    per_block = max(1, (1 << 20) // size)
+    bucket = 0
+    for block in sf.blocks(str(audio_path), blocksize=per_block * size, dtype="float32", always_2d=True):
+        count = min(-(-len(block) // size), finest - bucket)
+        if count <= 0:
+            break
+        block_min, block_max = bucket_minmax(block.mean(axis=1), size, count)
+        mins[bucket:bucket + count] = block_min
+        maxs[bucket:bucket + count] = block_max
+        bucket += count
+    return peak_pyramid(mins, maxs, size, length, info.samplerate, levels)
+
+
+def write_peaks(audio_path, samples: np.ndarray, samplerate: int) -> Path:
+    """Compute peaks for samples that were written to audio_path and save them."""
+    path = peaks_path(audio_path)
+    path.parent.mkdir(exist_ok=True)
+    path.write_text(json.dumps(compute_peaks(samples, samplerate), separators=(",", ":")))
+    return path
+
+
+def write_peaks_from_file(audio_path) -> Path:
+    path = peaks_path(audio_path)
+    path.parent.mkdir(exist_ok=True)
+    path.write_text(json.dumps(compute_peaks_from_file(audio_path), separators=(",", ":")))
+    return path
+
+
+def ensure_peaks(audio_path) -> Path:
+    """Peaks for an existing audio file, computing them once if they're missing."""
+    path = peaks_path(audio_path)
+    if not path.exists():
+        try:
+            write_peaks_from_file(audio_path)
+        except Exception:
+            # Formats libsndfile can't read
+            from audio_io import decode_audio
+            write_peaks(audio_path, decode_audio(str(audio_path), PEAKS_FALLBACK_SAMPLERATE, 1)[0], PEAKS_FALLBACK_SAMPLERATE)
+    return path
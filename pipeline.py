@@ -2,20 +2,107 @@
 # Connects converter.py and splitter.py into a full YouTube to stems pipeline
 import argparse
 from pathlib import Path
-from converter import download_yt_to_mp3
-from splitter import split_mp3_to_stems
+from audio_io import decode_audio
+from converter import download_yt_audio, download_yt_to_mp3
+from metrics import timed
+from settings import MODEL_SAMPLERATE, MODEL_CHANNELS
 
+# Tracks up to MAX_DURATION are separated in memory; longer ones (up to
+# STREAMING_MAX_DURATION) are streamed window by window with flat memory use.
+MAX_DURATION = 360
+STREAMING_MAX_DURATION = 4 * 3600
 
-def youtube_to_stems(url: str, name: str, output_root: str = "."):
-    output_dir = Path(output_root) / name
+# Each stage takes a job dict ({"url", "name", "output_root", ...}) and adds its
+# results to it, so the scheduler in main.py can run them on separate pools.
+# An "info" key holds metadata already resolved by converter.preflight.
+# torch, demucs and librosa are imported inside the stages that use them, so
+# the API process, which only runs downloads, never loads them.
+
+
+def max_duration_for(mode: str) -> int:
+    return MAX_DURATION if mode == "youtube" else STREAMING_MAX_DURATION
+
+
+def download_stage(job: dict):
+    output_dir = Path(job["output_root"]) / job["name"]
     output_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Downloading: {job['url']}")
+    if job.get("mode", "stem") == "youtube":
+        mp3_path = output_dir / f"{job['name']}.mp3"
+        title, duration, video_id = download_yt_to_mp3(job["url"], str(mp3_path), max_duration=max_duration_for("youtube"), info=job.pop("info", None))
+        job.update(title=title, duration=duration, video_id=video_id)
+        return
+
+    source, title, duration, video_id = download_yt_audio(
+        job["url"], str(output_dir), max_duration=max_duration_for("stem"), info=job.pop("info", None),
+    )
+    print(f"Title: {title} | Duration: {duration//60}m{duration%60}s")
+    job.update(source_path=source, title=title, duration=duration, video_id=video_id)
+    if duration <= MAX_DURATION:
+        # Decode once; the splitter works straight from this buffer
+        try:
+            with timed("decode"):
+                job["audio"] = decode_audio(source, MODEL_SAMPLERATE, MODEL_CHANNELS)
+        finally:
+            remove_source(job)
+
+
+def preview_stage(task: dict):
+    """Separate a preview_task's excerpt; runs beside the job's full separation."""
+    from preview import make_preview
+    preview = make_preview(task)
+    if task.get("preview_callback"):
+        task["preview_callback"](preview)
+
+
+def separate_stage(job: dict):
+    if "audio" not in job:
+        # Long track: separation, filtering and writing all happen here,
+        # decoding the source file window by window
+        from streaming import split_stream_to_stems
+        output_dir = Path(job["output_root"]) / job["name"]
+        job["streamed"] = split_stream_to_stems(
+            job["source_path"], str(output_dir), job["name"],
+            total_seconds=job["duration"],
+            progress_callback=job.get("progress_callback"),
+            should_stop=job.get("should_stop"),
+        )
+        remove_source(job)
+        return
+    from splitter import separate_stems
+    print(f"Splitting into stems...")
+    job["separated"] = separate_stems(
+        audio=job.pop("audio"), progress_callback=job.get("progress_callback"), should_stop=job.get("should_stop"),
+    )
+
+
+def remove_source(job: dict):
+    source = Path(job.pop("source_path", "") or "")
+    if source.is_file():
+        try:
+            source.unlink()
+            print(f"Cleaned up: {source.name}")
+        except Exception:
+            pass
+
+
+def postprocess_stage(job: dict):
+    output_dir = Path(job["output_root"]) / job["name"]
+    if "streamed" in job:
+        stems, bpm, key = job.pop("streamed")
+    else:
+        from splitter import postprocess_stems
+        separated = job.pop("separated")
+        stems, bpm, key = postprocess_stems(separated, str(output_dir), job["name"])
+    job.update(stems=stems, bpm=bpm, key=key)
+
+
+def youtube_to_stems(url: str, name: str, output_root: str = "."):
+    job = {"url": url, "name": name, "output_root": output_root}
     status_file = Path(output_root) / "status.txt"
 
-    mp3_path = output_dir / f"{name}.mp3"
-    print(f"Downloading: {url}")
     try:
-        title, duration = download_yt_to_mp3(url, str(mp3_path), max_duration=360)
-        print(f"Title: {title} | Duration: {duration//60}m{duration%60}s")
+        download_stage(job)
     except ValueError as e:
         print(f"Rejected: {e}")
         status_file.write_text("error")
@@ -23,11 +110,10 @@ def youtube_to_stems(url: str, name: str, output_root: str = "."):
         return
 
     status_file.write_text("splitting")
-    print(f"Splitting into stems...")
     try:
-        stems, bpm, key = split_mp3_to_stems(str(mp3_path), str(output_dir), status_file=status_file)
-        metadata_file = Path(output_root) / "metadata.txt"
-        metadata_file.write_text(f"BPM: {bpm:.1f}\nKey: {key}\n")
+        separate_stage(job)
+        postprocess_stage(job)
+        (Path(output_root) / "metadata.txt").write_text(f"BPM: {job['bpm']:.1f}\nKey: {job['key']}\n")
         status_file.write_text("done")
     except Exception as e:
         print(f"Error during splitting: {e}")
@@ -35,23 +121,17 @@ def youtube_to_stems(url: str, name: str, output_root: str = "."):
         (Path(output_root) / "error.txt").write_text(str(e))
         return
 
-    try:
-        mp3_path.unlink()
-        print(f"Cleaned up: {mp3_path.name}")
-    except Exception:
-        pass
-
     print(f"\nRAVEDROP COMPLETE!")
-    print(f"Folder: {output_dir}")
-    for s in sorted(stems):
+    print(f"Folder: {Path(output_root) / name}")
+    for s in sorted(job["stems"]):
         print(f"   • {Path(s).name}")
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="YouTube → Named Stems (≤6min)")
+    parser = argparse.ArgumentParser(description="YouTube → Named Stems")
     parser.add_argument("--url", required=True, help="YouTube URL")
     parser.add_argument("--name", required=True, help="Song name (used for folder & files)")
     parser.add_argument("--output", default=".", help="Output root folder")
     args = parser.parse_args()
 
-    youtube_to_stems(args.url, args.name, args.output)
\ No newline at end of file
+    youtube_to_stems(args.url, args.name, args.output)
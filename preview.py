@@ -0,0 +1,118 @@
+# preview.py
+# Quick stems for a short excerpt, published while the full separation runs
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+from audio_io import decode_audio
+from metrics import timed
+from settings import MODEL_SAMPLERATE, MODEL_CHANNELS, PREVIEW_FORMAT
+
+# Length of the excerpt; 0 turns previews off. Tracks shorter than twice
+# this are separated in full about as quickly, so they get no preview.
+PREVIEW_SECONDS = float(os.environ.get("PREVIEW_SECONDS", 30))
+# Cheaper settings than the full job: fewer models from the bag (mdx_extra_q
+# has four) and no segment overlap
+PREVIEW_MODELS = int(os.environ.get("PREVIEW_MODELS", 1))
+PREVIEW_OVERLAP = float(os.environ.get("PREVIEW_OVERLAP", 0))
+# Long (streamed) tracks aren't decoded up front; the excerpt is picked from
+# this much of their opening
+PREVIEW_SCAN_SECONDS = 180
+# Preview files live in this subfolder of the song's folder until the full
+# stems replace them
+PREVIEW_DIR = "preview"
+
+
+def wants_preview(duration) -> bool:
+    return PREVIEW_SECONDS > 0 and bool(duration) and duration >= 2 * PREVIEW_SECONDS
+
+
+def loudest_window(audio: np.ndarray, samplerate: int, seconds: float) -> int:
+    """Start frame of the loudest `seconds`-long window, on one-second steps."""
+    hops = audio.shape[-1] // samplerate
+    window = int(seconds)
+    if hops <= window:
+        return 0
+    blocks = audio[:, :hops * samplerate].reshape(audio.shape[0], hops, samplerate)
+    energy = np.einsum("chs,chs->h", blocks, blocks)
+    return int(np.argmax(np.convolve(energy, np.ones(window), mode="valid"))) * samplerate
+
+
+def pick_excerpt(job: dict) -> tuple:
+    """(excerpt, start seconds) from the job's decoded audio or, for long tracks, its source file."""
+    if "audio" in job:
+        audio = job["audio"]
+    else:
+        with timed("decode"):
+            audio = decode_audio(job["source_path"], MODEL_SAMPLERATE, MODEL_CHANNELS, duration=PREVIEW_SCAN_SECONDS)
+    start = loudest_window(audio, MODEL_SAMPLERATE, PREVIEW_SECONDS)
+    # A copy, so the preview doesn't keep the whole track in memory
+    return audio[:, start:start + int(PREVIEW_SECONDS * MODEL_SAMPLERATE)].copy(), start / MODEL_SAMPLERATE
+
+
+def preview_task(job: dict) -> Optional[dict]:
+    """What a downloaded job's preview needs, or None if it gets no preview.
+
+    Picked in the API process when the download finishes, so the preview
+    has its own copy of the excerpt and never shares the job's audio or
+    source file with the full separation running beside it.
+    """
+    if not wants_preview(job.get("duration")):
+        return None
+    excerpt, start = pick_excerpt(job)
+    return {"job_id": job["job_id"], "name": job["name"], "output_root": job["output_root"], "excerpt": excerpt, "start": start}
+
+
+def make_preview(task: dict) -> dict:
+    """Separate and write the preview stems of a preview_task.
+
+    The result holds the written `stems` paths, a provisional `bpm` and
+    `key`, and the excerpt's `start` and `seconds` within the track.
+    """
+    from splitter import separate_stems, postprocess_stems
+    excerpt = task.pop("excerpt")
+    print(f"Previewing {excerpt.shape[1] / MODEL_SAMPLERATE:.0f}s from {task['start']:.0f}s...")
+    separated = separate_stems(
+        audio=excerpt, progress=False, overlap=PREVIEW_OVERLAP, bag_size=PREVIEW_MODELS, should_stop=task.get("should_stop"),
+    )
+    output_dir = Path(task["output_root"]) / task["name"] / PREVIEW_DIR
+    output_dir.parent.mkdir(parents=True, exist_ok=True)
+    stems, bpm, key = postprocess_stems(separated, str(output_dir), task["name"], stem_format=PREVIEW_FORMAT)
+    return {"stems": stems, "bpm": bpm, "key": key, "start": task["start"], "seconds": excerpt.shape[1] / MODEL_SAMPLERATE}
+
+
+class PreviewQueue:
+    """Preview tasks waiting for one of `workers` threads, beside the staged pipeline.
+
+    A job's preview is queued when its download finishes and runs while the
+    job itself goes on to the full separation; `run(task)` does the work.
+    Tasks whose `cancel` event is set (their job finished or went away
+    first) are skipped, and their failures aren't reported.
+    """
+
+    def __init__(self, run: Callable[[dict], None], workers: int = 1):
+        self.run = run
+        self.workers = max(1, workers)
+        self.tasks = queue.Queue()
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._loop, name=f"preview-{i}", daemon=True).start()
+
+    def submit(self, task: dict):
+        self.tasks.put(task)
+
+    def _loop(self):
+        while True:
+            task = self.tasks.get()
+            if task["cancel"].is_set():
+                continue
+            try:
+                self.run(task)
+            except Exception as e:
+                if not task["cancel"].is_set():
+                    print(f"Preview of job {task['job_id']} failed (non-critical): {e}")
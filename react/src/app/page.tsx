@@ -16,106 +16,132 @@ export default function Home() {
   const [key, setKey] = useState<string | null>(null);
   const [showResults, setShowResults] = useState(false);
   const [queue, setQueue] = useState<any[]>([]);
-  const [currentJob, setCurrentJob] = useState<any>(null);
+  const [activeJobs, setActiveJobs] = useState<any[]>([]);
+  const [progress, setProgress] = useState<number | null>(null);
+  // Quick stems for an excerpt, shown until the full job replaces them
+  const [preview, setPreview] = useState<any | null>(null);
   const [queueOpen, setQueueOpen] = useState(false);
   const [completedOpen, setCompletedOpen] = useState(false);
   const [completedJobs, setCompletedJobs] = useState<any[]>([]);
+  const currentJob = activeJobs.length > 0 ? activeJobs[0] : null;
 
-  // State to control completed jobs polling
-  const [shouldPollCompleted, setShouldPollCompleted] = useState(false);
-
-  // Polling ref to track if we should continue polling
-  const pollingRef = useRef(false);
+  // The job this form submitted, readable from event handlers
+  const jobIdRef = useRef<string | null>(null);
 
   // Add mode state
   const [mode, setMode] = useState<'youtube' | 'stem'>('stem');
 
-  // Poll job status
-  useEffect(() => {
-    if (!jobId || !pollingRef.current) return;
+  const showDone = (job: any) => {
+    setIsLoading(false);
+    setStatus("done");
+    setProgress(null);
+    setPreview(null);
+    if (job.bpm) setBpm(job.bpm);
+    if (job.key) setKey(job.key);
+    setDownloadLinks(job.stems || []);
+    setTimeout(() => setShowResults(true), 150);
+  };
 
-    const pollStatus = async () => {
-      try {
-        const res = await fetch(`http://localhost:8000/status/${jobId}`);
-        if (!res.ok) {
-          console.error("Failed to fetch status");
-          return;
-        }
-        const data = await res.json();
-        
-        if (data.status === "done") {
-          setIsLoading(false);
-          setStatus("done");
-          pollingRef.current = false;
-          
-          if (data.bpm) setBpm(data.bpm);
-          if (data.key) setKey(data.key);
-          
-          if (songName) {
-            const filesRes = await fetch(`http://localhost:8000/files/${jobId}/${songName}`);
-            if (filesRes.ok) {
-              const filesData = await filesRes.json();
-              setDownloadLinks(filesData.files || []);
-            }
-          }
-          
-          setTimeout(() => setShowResults(true), 150);
-        } else if (data.status === "error") {
-          setIsLoading(false);
-          setStatus("error");
-          setError(data.error || "An error occurred during processing");
-          pollingRef.current = false;
-        } else if (data.status === "downloading" || data.status === "splitting" || data.status === "cleaning" || data.status === "separating") {
-          setStatus(data.status);
-        }
-      } catch (err) {
-        console.error("Error polling status:", err);
-      }
-    };
+  const showError = (message?: string) => {
+    setIsLoading(false);
+    setStatus("error");
+    setProgress(null);
+    setError(message || "An error occurred during processing");
+  };
 
-    pollStatus();
-    const interval = setInterval(pollStatus, 500); 
-    return () => {
-      clearInterval(interval);
-    };
-  }, [jobId, songName]);
+  // One-off status check, for jobs that finished before their events arrived
+  const checkStatus = async (jobId: string, songName: string) => {
+    try {
+      const res = await fetch(`http://localhost:8000/status/${jobId}`);
+      if (!res.ok) return;
+      const data = await res.json();
+      if (data.status === "done") {
+        const filesRes = await fetch(`http://localhost:8000/files/${jobId}/${songName}`);
+        const filesData = filesRes.ok ? await filesRes.json() : { files: [] };
+        showDone({ ...data, stems: filesData.files || [] });
+      } else if (data.status === "error") {
+        showError(data.error);
+      } else if (data.status !== "queued") {
+        setStatus(data.status);
+        setProgress(data.progress);
+        if (data.preview) setPreview(data.preview);
+      }
+    } catch (err) {
+      console.error("Error checking status:", err);
+    }
+  };
 
-  // Poll job queue
+  // Subscribe once to job events; the server only sends when something changes
   useEffect(() => {
-    const pollQueue = async () => {
-      try {
-        const res = await fetch("http://localhost:8000/queue");
-        if (res.ok) {
-          const data = await res.json();
-          setQueue(data.queue || []);
-          setCurrentJob(data.current_job || null);
-        }
-      } catch (err) {
-        console.error("Error polling queue:", err);
+    const source = new EventSource("http://localhost:8000/events");
+    const parse = (e: Event) => JSON.parse((e as MessageEvent).data);
+    const without = (jobs: any[], jobId: string) => jobs.filter(j => j.job_id !== jobId);
+
+    source.addEventListener("snapshot", e => {
+      const data = parse(e);
+      setQueue(data.queue || []);
+      setActiveJobs(data.active || []);
+      setCompletedJobs(data.completed || []);
+    });
+    source.addEventListener("queued", e => {
+      const job = parse(e);
+      setQueue(q => [...without(q, job.job_id), job]);
+    });
+    source.addEventListener("removed", e => {
+      const { job_id } = parse(e);
+      setQueue(q => without(q, job_id));
+    });
+    source.addEventListener("stage", e => {
+      const job = parse(e);
+      setQueue(q => without(q, job.job_id));
+      setActiveJobs(a => a.some(j => j.job_id === job.job_id)
+        ? a.map(j => j.job_id === job.job_id ? job : j)
+        : [...a, job]);
+      if (job.job_id === jobIdRef.current) {
+        setStatus(job.status);
+        setProgress(null);
       }
-    };
-    pollQueue();
-    const interval = setInterval(pollQueue, 500);
-    return () => clearInterval(interval);
+    });
+    source.addEventListener("progress", e => {
+      const { job_id, progress } = parse(e);
+      setActiveJobs(a => a.map(j => j.job_id === job_id ? { ...j, progress } : j));
+      if (job_id === jobIdRef.current) setProgress(progress);
+    });
+    source.addEventListener("preview", e => {
+      const data = parse(e);
+      if (data.job_id === jobIdRef.current) setPreview(data);
+    });
+    source.addEventListener("done", e => {
+      const job = parse(e);
+      setQueue(q => without(q, job.job_id));
+      setActiveJobs(a => without(a, job.job_id));
+      setCompletedJobs(c => [job, ...without(c, job.job_id)]);
+      if (job.job_id === jobIdRef.current) showDone(job);
+    });
+    source.addEventListener("failed", e => {
+      const data = parse(e);
+      setQueue(q => without(q, data.job_id));
+      setActiveJobs(a => without(a, data.job_id));
+      if (data.job_id === jobIdRef.current) showError(data.error);
+    });
+    source.addEventListener("cancelled", e => {
+      const { job_id } = parse(e);
+      setQueue(q => without(q, job_id));
+      setActiveJobs(a => without(a, job_id));
+      if (job_id === jobIdRef.current) {
+        setIsLoading(false);
+        setStatus("cancelled");
+        setProgress(null);
+        setPreview(null);
+      }
+    });
+    source.addEventListener("evicted", e => {
+      const { job_id } = parse(e);
+      setCompletedJobs(c => without(c, job_id));
+    });
+    return () => source.close();
   }, []);
 
-  // Poll completed jobs only when shouldPollCompleted is true
-  useEffect(() => {
-    if (!shouldPollCompleted) return;
-    const pollCompleted = async () => {
-      try {
-        const res = await fetch("http://localhost:8000/completed");
-        if (res.ok) {
-          const data = await res.json();
-          setCompletedJobs(data.completed || []);
-        }
-      } catch {}
-    };
-    pollCompleted();
-    const interval = setInterval(pollCompleted, 500); 
-    return () => clearInterval(interval);
-  }, [shouldPollCompleted]);
-
   // Start conversion
   const handleConvert = async (e: React.FormEvent) => {
     e.preventDefault();
@@ -129,8 +155,9 @@ export default function Home() {
     setBpm(null);
     setKey(null);
     setShowResults(false);
-    pollingRef.current = false;
-    setShouldPollCompleted(true);
+    setProgress(null);
+    setPreview(null);
+    jobIdRef.current = null;
     
     try {
       const formData = new FormData();
@@ -142,16 +169,19 @@ export default function Home() {
         body: formData
       });
       if (!res.ok) {
-        setError("Failed to start conversion");
+        // Rejected by the pre-flight check (bad URL, too long, ...)
+        const data = await res.json().catch(() => ({}));
+        setError(data.error || "Failed to start conversion");
         setIsLoading(false);
         return;
       }
       const data = await res.json();
       if (data.job_id && data.song_name) {
+        jobIdRef.current = data.job_id;
         setJobId(data.job_id);
         setSongName(data.song_name);
         setOutputFolder(data.output_folder);
-        pollingRef.current = true;
+        await checkStatus(data.job_id, data.song_name);
       } else {
         setError("Failed to start conversion");
         setIsLoading(false);
@@ -163,7 +193,12 @@ export default function Home() {
     }
   };
 
-  // Remove job from queue
+  const formatSeconds = (seconds: number) => {
+    const s = Math.round(seconds);
+    return `${Math.floor(s / 60)}:${String(s % 60).padStart(2, "0")}`;
+  };
+
+  // Remove job from queue, or cancel it if it is running
   const handleRemoveJob = async (jobId: string) => {
     try {
       await fetch(`http://localhost:8000/remove_job/${jobId}`, { method: "POST" });
@@ -184,7 +219,9 @@ export default function Home() {
     setBpm(null);
     setKey(null);
     setShowResults(false);
-    pollingRef.current = false;
+    setProgress(null);
+    setPreview(null);
+    jobIdRef.current = null;
   };
 
   // Remove spinner and show form when no job is running
@@ -198,7 +235,9 @@ export default function Home() {
       setDownloadLinks([]);
       setBpm(null);
       setKey(null);
-      pollingRef.current = false;
+      setProgress(null);
+      setPreview(null);
+      jobIdRef.current = null;
     }
   }, [isLoading, status, queue]);
 
@@ -216,6 +255,26 @@ export default function Home() {
           <p className="text-[#8a8a8a] text-xs font-light tracking-wider uppercase">
             {getStatusText(status, currentJob?.name)}
           </p>
+          {progress !== null && (
+            <div className="w-48 h-1 mt-4 bg-[#1f1f1f] rounded overflow-hidden">
+              <div className="h-full bg-[#818cf8] transition-all duration-300" style={{ width: `${Math.round(progress * 100)}%` }}></div>
+            </div>
+          )}
+          {preview && (
+            <div className="w-full mt-6">
+              <p className="text-[#8a8a8a] text-xs font-light tracking-wider uppercase text-center mb-3">
+                Preview · {formatSeconds(preview.start)}–{formatSeconds(preview.start + preview.seconds)}
+                {preview.bpm && ` · ~${preview.bpm} BPM`}
+                {preview.key && ` · ${preview.key}`}
+              </p>
+              {preview.stems.map((stem: any) => (
+                <div key={stem.url} className="flex items-center gap-2 mb-2">
+                  <WaveformPlayer src={`http://localhost:8000${stem.url}`} name={stem.name} />
+                  <span className="text-[#e8e8e8] text-sm font-mono truncate flex-1">{stem.name}</span>
+                </div>
+              ))}
+            </div>
+          )}
         </div>
       </div>
     );
@@ -231,6 +290,7 @@ export default function Home() {
       separating: "Splitting",
       done: "Complete",
       error: "Error",
+      cancelled: "Cancelled",
     };
     let base = statusMap[status] || status;
     if (jobName) base += ` (${jobName})`;
@@ -258,7 +318,13 @@ export default function Home() {
                 </button>
                 <span className="text-[#8a8a8a] text-xs font-light uppercase tracking-wider mb-2">Currently Processing</span>
                 {currentJob ? (
-                  <div className="text-[#e8e8e8] text-lg font-bold font-mono text-center mb-2">{currentJob.name}</div>
+                  <>
+                    <div className="text-[#e8e8e8] text-lg font-bold font-mono text-center mb-2">{currentJob.name}</div>
+                    <button
+                      className="px-2 py-1 text-xs bg-[#252525] border border-[#3a3a3a] rounded text-[#d4a4a4] hover:bg-[#3a1f1f] hover:border-[#4a2a2a]"
+                      onClick={() => handleRemoveJob(currentJob.job_id)}
+                    >Cancel</button>
+                  </>
                 ) : (
                   <div className="text-[#6a6a6a] text-lg font-light font-mono text-center mb-2">Idle</div>
                 )}
@@ -273,6 +339,12 @@ export default function Home() {
                         <div className="flex items-center gap-3">
                           <span className="text-[#818cf8] text-base font-bold font-mono">{idx + 1}</span>
                           <span className="text-[#e8e8e8] text-base font-bold font-mono truncate">{job.name}</span>
+                          {job.duration != null && (
+                            <span className="text-[#8a8a8a] text-xs font-mono">
+                              {formatSeconds(job.duration)}
+                              {job.estimated_seconds != null && ` · ~${formatSeconds(job.estimated_seconds)} to process`}
+                            </span>
+                          )}
                         </div>
                         <button
                           className="ml-2 px-2 py-1 text-xs bg-[#252525] border border-[#3a3a3a] rounded text-[#d4a4a4] hover:bg-[#3a1f1f] hover:border-[#4a2a2a]"
@@ -326,6 +398,16 @@ export default function Home() {
                             </svg>
                           </a>
                         )}
+                        {job.stems && job.stems.length > 1 && (
+                          <a href={`http://localhost:8000/download_all/${job.job_id}`} download title="Download all as ZIP" className="ml-auto text-xs font-mono text-[#818cf8] hover:text-[#a5b4fc]">
+                            ZIP
+                          </a>
+                        )}
+                        {job.stems && job.stems.some((stem: any) => stem.name.includes("[vocals]")) && (
+                          <a href={`http://localhost:8000/mix/${job.job_id}?preset=instrumental`} download title="Drums, bass and melody in one WAV" className="text-xs font-mono text-[#818cf8] hover:text-[#a5b4fc]">
+                            INST
+                          </a>
+                        )}
                       </div>
 
                       {(job.bpm || job.key) && (
@@ -1,5 +1,18 @@
 import React, { useRef, useEffect, useState } from "react";
 
+interface PeaksLevel {
+  buckets: number;
+  samples_per_bucket: number;
+  min: number[];
+  max: number[];
+}
+
+interface PeaksData {
+  sample_rate: number;
+  length: number;
+  levels: PeaksLevel[];
+}
+
 interface WaveformPlayerProps {
   src: string;
   name: string;
@@ -13,29 +26,33 @@ export default function WaveformPlayer({ src, name }: WaveformPlayerProps) {
   const [playing, setPlaying] = useState(false);
   const [peaks, setPeaks] = useState<number[]>([]);
 
-  // Draw waveform
+  // Load precomputed peaks; the audio itself is only streamed on play
   useEffect(() => {
     if (!src) return;
-    fetch(src)
-      .then(res => res.arrayBuffer())
-      .then(buffer => {
-        const ctx = new (window.AudioContext || (window as any).webkitAudioContext)();
-        return ctx.decodeAudioData(buffer);
+    fetch(src.replace("/download/", "/peaks/"))
+      .then(res => {
+        if (!res.ok) throw new Error("Peaks not available");
+        return res.json();
       })
-      .then(audioBuffer => {
-        const rawData = audioBuffer.getChannelData(0);
-        const samples = 200;
-        const blockSize = Math.floor(rawData.length / samples);
+      .then((data: PeaksData) => {
+        const canvasWidth = canvasRef.current?.width || 300;
+        // Coarsest level that still has at least one bucket per pixel
+        const levels = [...data.levels].sort((a, b) => a.buckets - b.buckets);
+        const level = levels.find(l => l.buckets >= canvasWidth) || levels[levels.length - 1];
+        const bars = Math.min(200, level.buckets);
+        const perBar = level.buckets / bars;
         const peaksArr = [];
-        for (let i = 0; i < samples; i++) {
-          let sum = 0;
-          for (let j = 0; j < blockSize; j++) {
-            sum += Math.abs(rawData[i * blockSize + j]);
+        for (let i = 0; i < bars; i++) {
+          let peak = 0;
+          for (let j = Math.floor(i * perBar); j < Math.floor((i + 1) * perBar); j++) {
+            peak = Math.max(peak, Math.abs(level.min[j]), Math.abs(level.max[j]));
           }
-          peaksArr.push(sum / blockSize);
+          peaksArr.push(peak);
         }
         setPeaks(peaksArr);
-      });
+        if (data.sample_rate > 0) setDuration(data.length / data.sample_rate);
+      })
+      .catch(err => console.error("Error loading peaks:", err));
   }, [src]);
 
   useEffect(() => {
@@ -57,7 +74,7 @@ export default function WaveformPlayer({ src, name }: WaveformPlayerProps) {
     }
     // Draw progress overlay
     ctx.fillStyle = "rgba(255,255,255,0.2)";
-    const progress = (currentTime / duration) * width;
+    const progress = duration > 0 ? (currentTime / duration) * width : 0;
     ctx.fillRect(0, 0, progress, height);
   }, [peaks, currentTime, duration]);
 
@@ -142,6 +159,7 @@ export default function WaveformPlayer({ src, name }: WaveformPlayerProps) {
       <audio
         ref={audioRef}
         src={src}
+        preload="none"
         onTimeUpdate={handleTimeUpdate}
         onLoadedMetadata={handleLoadedMetadata}
         onEnded={() => setPlaying(false)}
@@ -0,0 +1,210 @@
+# scheduler.py
+# Runs jobs through download -> separate -> post-process stages on separate worker pools
+import itertools
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional
+from metrics import JobMetrics, job_context, record_wait, timed
+
+# Jobs run shortest first: a job's score is its audio length in seconds plus
+# its priority class offset, minus AGING_RATE for every second it has
+# waited, so long and low-priority jobs still get their turn
+PRIORITY_CLASSES = {"high": -600, "normal": 0, "low": 600}
+AGING_RATE = 1.0
+DEFAULT_DURATION = 240  # For jobs whose length isn't known
+
+
+class JobCancelled(Exception):
+    """Raised inside a stage once its job has been cancelled."""
+
+
+def job_score(job: dict, now: float) -> float:
+    duration = job.get("duration") or DEFAULT_DURATION
+    waited = now - job.get("submitted_at", now)
+    return PRIORITY_CLASSES.get(job.get("priority", "normal"), 0) + duration - AGING_RATE * waited
+
+
+def check_cancelled(job: dict):
+    should_stop = job.get("should_stop")
+    if should_stop and should_stop():
+        raise JobCancelled(f"Job {job.get('job_id')} was cancelled")
+
+
+class Stage:
+    """One step of the pipeline with its own pool of worker threads.
+
+    `func(job)` mutates the job dict in place; anything it raises marks the
+    job as failed. `status` is the value reported to clients while a job is
+    in this stage.
+    """
+
+    def __init__(self, name: str, func: Callable[[dict], None], workers: int = 1, status: Optional[str] = None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.status = status or name
+
+
+class StagedScheduler:
+    """Hands jobs between stages so downloads overlap with separation.
+
+    New jobs wait in an unbounded pool (what `/queue` shows), and both it
+    and the bounded queues between stages hand out the job with the lowest
+    job_score first. The bounded queues make a fast stage block instead of
+    piling up decoded audio in memory. A job's
+    `stages` key lists the stage names it needs, in order; it defaults to
+    every stage, and the first stage must always be the first one listed.
+    Each job gets a `metrics` JobMetrics recording its queue waits and
+    stage timings; steps timed inside a stage are attributed to it too.
+
+    With an `admission` controller, the next pending job only starts once
+    `admission.try_reserve(job)` accepts it (jobs behind it wait, so a big
+    job isn't starved by smaller ones), and `admission.release(job)` is
+    called when it finishes.
+
+    `cancel` drops a pending job or flags a running one: its `should_stop()`
+    turns true, the scheduler stops it before its next stage, and long steps
+    (Demucs segments) poll it and raise JobCancelled. Either way it ends in
+    `on_cancel` rather than `on_error`.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        on_stage: Callable[[dict, Stage], None] = None,
+        on_done: Callable[[dict], None] = None,
+        on_error: Callable[[dict, Exception], None] = None,
+        on_cancel: Callable[[dict], None] = None,
+        queue_size: int = 2,
+        admission=None,
+    ):
+        self.stages = {stage.name: stage for stage in stages}
+        self.order = [stage.name for stage in stages]
+        self.on_stage = on_stage
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self.admission = admission
+        self.pending = []
+        self.cond = threading.Condition()
+        self.active = {}  # job_id -> job, for jobs past the pending queue
+        self.handoff = {name: queue.PriorityQueue(maxsize=queue_size) for name in self.order[1:]}
+        self.sequence = itertools.count()  # Tie-breaker, so jobs are never compared
+        self.threads = []
+
+    def start(self):
+        for name in self.order:
+            stage = self.stages[name]
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._run, args=(stage,), name=f"{name}-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, job: dict):
+        job.setdefault("stages", list(self.order))
+        job.setdefault("metrics", JobMetrics())
+        job.setdefault("priority", "normal")
+        job["cancel"] = threading.Event()
+        job["should_stop"] = job["cancel"].is_set
+        job["queued_at"] = job["submitted_at"] = time.monotonic()
+        with self.cond:
+            self.pending.append(job)
+            self.cond.notify()
+
+    def remove(self, job_id: str) -> bool:
+        """Drop a job that hasn't started yet."""
+        with self.cond:
+            for job in self.pending:
+                if job["job_id"] == job_id:
+                    self.pending.remove(job)
+                    return True
+        return False
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        """"removed" for a pending job, "cancelling" for a running one, None if unknown."""
+        if self.remove(job_id):
+            return "removed"
+        with self.cond:
+            job = self.active.get(job_id)
+        if job is None:
+            return None
+        job["cancel"].set()
+        return "cancelling"
+
+    def snapshot(self):
+        """Return (pending jobs in the order they'll start, active jobs) as lists of job dicts."""
+        now = time.monotonic()
+        with self.cond:
+            pending = sorted(self.pending, key=lambda job: job_score(job, now))
+            return pending, list(self.active.values())
+
+    def _next_job(self, stage: Stage) -> dict:
+        if stage.name == self.order[0]:
+            with self.cond:
+                while True:
+                    if self.pending:
+                        now = time.monotonic()
+                        job = min(self.pending, key=lambda job: job_score(job, now))
+                        if self.admission is None or self.admission.try_reserve(job):
+                            break
+                        if not job.get("waiting_for_memory"):
+                            job["waiting_for_memory"] = True
+                            print(f"Job {job['job_id']} needs ~{job['memory_estimate_mb']:.0f} MB; waiting for running jobs to free memory")
+                    # Woken by new jobs and by finished ones releasing memory
+                    self.cond.wait()
+                job.pop("waiting_for_memory", None)
+                self.pending.remove(job)
+                self.active[job["job_id"]] = job
+                return job
+        return self.handoff[stage.name].get()[-1]
+
+    def _run(self, stage: Stage):
+        while True:
+            job = self._next_job(stage)
+            job["stage"] = stage.name
+            job["waiting"] = False
+            record_wait(job["metrics"], time.monotonic() - job.pop("queued_at", time.monotonic()), stage.name)
+            try:
+                check_cancelled(job)
+                if self.on_stage:
+                    self.on_stage(job, stage)
+                with job_context(job["metrics"]), timed(stage.name, kind="stage"):
+                    stage.func(job)
+                check_cancelled(job)
+            except Exception as e:
+                self._finish(job)
+                if isinstance(e, JobCancelled) or job["cancel"].is_set():
+                    print(f"Cancelled job {job['job_id']} during {stage.name}")
+                    if self.on_cancel:
+                        self.on_cancel(job)
+                    continue
+                traceback.print_exc()
+                if self.on_error:
+                    self.on_error(job, e)
+                continue
+
+            remaining = job["stages"][job["stages"].index(stage.name) + 1:]
+            if remaining:
+                job["stage"] = remaining[0]
+                job["waiting"] = True
+                job["queued_at"] = time.monotonic()
+                # Blocks while the next stage is saturated
+                self.handoff[remaining[0]].put((job_score(job, time.monotonic()), next(self.sequence), job))
+            else:
+                self._finish(job)
+                if self.on_done:
+                    try:
+                        self.on_done(job)
+                    except Exception as e:
+                        traceback.print_exc()
+                        if self.on_error:
+                            self.on_error(job, e)
+
+    def _finish(self, job: dict):
+        with self.cond:
+            self.active.pop(job["job_id"], None)
+            if self.admission is not None:
+                self.admission.release(job)
+                self.cond.notify_all()
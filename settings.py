@@ -0,0 +1,51 @@
+# settings.py
+# Separation settings shared by the API process and the workers, importable without torch
+import os
+
+# Separation settings. Anything that changes the output belongs in
+# separation_params() so cached results are keyed on it.
+SEGMENT = 8
+OVERLAP = 0.05
+BASS_CUTOFF = 200
+GATE_THRESHOLD = 0.12
+
+# Every pretrained Demucs model works on 44.1 kHz stereo, so audio can be
+# decoded to this format before the model is loaded
+MODEL_SAMPLERATE = 44100
+MODEL_CHANNELS = 2
+
+# Encoding of finished stems: "wav", or "flac" for lossless files about half
+# the size. Previews are only listened to, so they default to a lossy format
+# ("mp3" or "opus"). Encoding doesn't change the audio that is cached, so
+# neither is part of separation_params().
+STEM_FORMAT = os.environ.get("STEM_FORMAT", "wav")
+PREVIEW_FORMAT = os.environ.get("PREVIEW_FORMAT", "mp3")
+LOSSLESS_FORMATS = ("wav", "flac")
+LOSSY_FORMATS = ("mp3", "opus")
+if STEM_FORMAT not in LOSSLESS_FORMATS:
+    raise ValueError(f"STEM_FORMAT must be one of {', '.join(LOSSLESS_FORMATS)}, not {STEM_FORMAT!r}")
+if PREVIEW_FORMAT not in LOSSLESS_FORMATS + LOSSY_FORMATS:
+    raise ValueError(f"PREVIEW_FORMAT must be one of {', '.join(LOSSLESS_FORMATS + LOSSY_FORMATS)}, not {PREVIEW_FORMAT!r}")
+
+# CPU inference backend (see inference.py). Anything but fp32 with batch 1
+# changes the output slightly, so it is part of separation_params().
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "fp32")
+INFERENCE_BATCH = int(os.environ.get("INFERENCE_BATCH", 1))  # Segments per forward pass
+
+
+def quality_params() -> dict:
+    """Inference settings that change separation output."""
+    if INFERENCE_BACKEND == "fp32" and INFERENCE_BATCH <= 1:
+        return {}
+    return {"backend": INFERENCE_BACKEND, "batch_size": INFERENCE_BATCH}
+
+
+def separation_params(model_name: str = "mdx_extra_q") -> dict:
+    return {
+        "model": model_name,
+        "segment": SEGMENT,
+        "overlap": OVERLAP,
+        "bass_cutoff": BASS_CUTOFF,
+        "gate_threshold": GATE_THRESHOLD,
+        **quality_params(),
+    }
@@ -1,17 +1,41 @@
 # splitter.py
 # Splits MP3 files into stems
+import io
 import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import Callable, List, Tuple
 import torch
 import soundfile as sf
 import numpy as np
 import librosa
+from demucs.apply import BagOfModels
 from scipy.signal import butter, lfilter
 from mutagen.wave import WAVE
-from demucs.pretrained import get_model
-from demucs.apply import apply_model
-from demucs.audio import AudioFile
+from mutagen.id3 import ID3, TBPM, TIT1, TXXX
+import inference
+from audio_io import decode_audio, encode_mp3, tag_vorbis
+from model_registry import registry
+from peaks import write_peaks
+from analysis import StemAnalysis, key_from_chroma
+from metrics import timed, job_context, current_job_metrics
+from scheduler import JobCancelled
+from settings import SEGMENT, OVERLAP, BASS_CUTOFF, GATE_THRESHOLD, MODEL_SAMPLERATE, MODEL_CHANNELS, STEM_FORMAT, separation_params
+
+# Demucs source name -> tag used in output file names, in model output order
+STEM_TAGS = {
+    "drums": "drums",
+    "bass": "bass",
+    "other": "melody",
+    "vocals": "vocals",
+}
+
+# Threads shared by every job's post-processing. NumPy, SciPy and libsndfile
+# release the GIL, so filtering, gating, analysis and writing overlap.
+POSTPROCESS_THREADS = int(os.environ.get("POSTPROCESS_THREADS", max(2, min(8, os.cpu_count() or 2))))
+_postprocess_pool = None
+
 
 def lowpass_filter(data, cutoff, fs, order=5):
     nyq = 0.5 * fs
@@ -30,7 +54,7 @@ def detect_bpm_from_array(drums_data: np.ndarray, sr: int) -> float:
     try:
         onset_env = librosa.onset.onset_strength(y=drums_data, sr=sr)
         tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
-        return float(tempo)
+        return float(np.atleast_1d(tempo)[0])
     except Exception as e:
         print(f"BPM detection failed: {e}")
         return 128.0  
@@ -38,122 +62,200 @@ def detect_bpm_from_array(drums_data: np.ndarray, sr: int) -> float:
 def detect_key_from_audio(audio_data: np.ndarray, sr: int) -> str:
     try:
         chroma = librosa.feature.chroma_stft(y=audio_data, sr=sr)
-        chroma_mean = np.mean(chroma, axis=1)
-        
-        # Key profiles for major and minor keys (Krumhansl-Schmuckler)
-        major_profile = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
-        minor_profile = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
-        
-        major_profile = major_profile / np.sum(major_profile)
-        minor_profile = minor_profile / np.sum(minor_profile)
-        chroma_mean = chroma_mean / np.sum(chroma_mean)
-        
-        # Correlate with all 12 major and minor keys
-        keys = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-        best_corr = -1
-        best_key = 'C major'
-        
-        for i in range(12):
-            rotated_chroma = np.roll(chroma_mean, -i)
-            
-            # Correlate with major
-            major_corr = np.corrcoef(rotated_chroma, major_profile)[0, 1]
-            if not np.isnan(major_corr) and major_corr > best_corr:
-                best_corr = major_corr
-                best_key = keys[i] + ' major'
-            
-            minor_corr = np.corrcoef(rotated_chroma, minor_profile)[0, 1]
-            if not np.isnan(minor_corr) and minor_corr > best_corr:
-                best_corr = minor_corr
-                best_key = keys[i] + ' minor'
-        
-        return best_key
+        return key_from_chroma(np.mean(chroma, axis=1))
     except Exception as e:
         print(f"Key detection failed: {e}")
         return "Unknown"
 
 
+def bpm_tags(bpm: float) -> ID3:
+    tags = ID3()
+    tags.add(TBPM(encoding=3, text=str(int(round(bpm)))))
+    tags.add(TIT1(encoding=3, text=f"BPM: {bpm:.1f}"))
+    tags.add(TXXX(encoding=3, desc="BPM", text=str(bpm)))
+    return tags
+
+
+def bpm_id3_chunk(bpm: float) -> bytes:
+    """A RIFF "id3 " chunk holding the BPM tags, as mutagen's WAVE reads them."""
+    data = io.BytesIO()
+    bpm_tags(bpm).save(data, padding=lambda info: 0)
+    data = data.getvalue()
+    return b"id3 " + struct.pack("<I", len(data)) + data + b"\0" * (len(data) % 2)
+
+
+def append_id3_chunk(f, bpm: float):
+    """Append BPM tags to an open WAV file and fix up the RIFF size."""
+    f.seek(0, os.SEEK_END)
+    f.write(bpm_id3_chunk(bpm))
+    size = f.tell()
+    f.seek(4)
+    f.write(struct.pack("<I", size - 8))
+
+
+def write_wav(path: str, samples: np.ndarray, samplerate: int, bpm: float = None):
+    """Write a WAV with its BPM tags in the same pass (no re-save by mutagen)."""
+    with open(path, "w+b") as f:
+        sf.write(f, samples, samplerate, format="WAV")
+        if bpm is not None:
+            append_id3_chunk(f, bpm)
+
+
+def write_stem(path: str, samples: np.ndarray, samplerate: int, bpm: float = None):
+    """Write a stem in the format its extension names (wav, flac, mp3 or opus), with BPM tags."""
+    suffix = Path(path).suffix.lower()
+    if suffix == ".wav":
+        write_wav(path, samples, samplerate, bpm)
+        return
+    if suffix == ".flac":
+        sf.write(path, samples, samplerate, format="FLAC", subtype="PCM_16")
+    else:
+        # ffmpeg takes (channels, frames), soundfile (frames, channels)
+        encode_mp3(path, samples.T, samplerate, bitrate="192k" if suffix == ".mp3" else "128k")
+    if bpm is not None:
+        if suffix == ".mp3":
+            bpm_tags(bpm).save(path)
+        else:
+            tag_vorbis(path, bpm)
+
+
+def tag_wav(wav_path: str, bpm: float):
+    """Add BPM tags to a finished WAV by appending a chunk, without rewriting the audio."""
+    try:
+        with open(wav_path, "r+b") as f:
+            append_id3_chunk(f, bpm)
+        print(f"Embedded BPM: {bpm:.1f} → {Path(wav_path).name}")
+    except Exception as e:
+        print(f"BPM embed failed (non-critical): {e}")
+
+
+def tag_stem(path: str, bpm: float):
+    """Add BPM tags to a finished WAV or FLAC stem."""
+    if not path.endswith(".flac"):
+        tag_wav(path, bpm)
+        return
+    try:
+        tag_vorbis(path, bpm)
+        print(f"Embedded BPM: {bpm:.1f} → {Path(path).name}")
+    except Exception as e:
+        print(f"BPM embed failed (non-critical): {e}")
+
+
 def embed_bpm_in_wav(wav_path: str, bpm: float):
     try:
         audio = WAVE(wav_path)
         if audio.tags is None:
             audio.add_tags()
-        
-        bpm_int = int(round(bpm))
-        from mutagen.id3 import TBPM, TIT1, TXXX
-        
-        audio.tags.add(TBPM(encoding=3, text=str(bpm_int)))
-        audio.tags.add(TIT1(encoding=3, text=f"BPM: {bpm:.1f}"))
-        audio.tags.add(TXXX(encoding=3, desc="BPM", text=str(bpm)))
-        
+        for frame in bpm_tags(bpm).values():
+            audio.tags.add(frame)
         audio.save()
         print(f"Embedded BPM: {bpm:.1f} → {Path(wav_path).name}")
     except Exception as e:
         print(f"BPM embed failed (non-critical): {e}")
 
 
-def split_mp3_to_stems(
-    input_path: str,
-    output_dir: str,
-    model_name: str = "mdx_extra_q",  
-    device: str = None,
-    progress: bool = True,
-    include_full: bool = True,
-    status_file = None,
-) -> List[str]:
-    input_path = Path(input_path)
-    output_dir = Path(output_dir)
-    output_dir.mkdir(exist_ok=True)
+def set_torch_threads(workers: int = 1):
+    """Share the CPU cores between `workers` concurrent separations."""
+    threads = inference.configure_threads(workers)
+    print(f"Torch using {threads} threads per separation")
+
+
+def load_model(model_name: str = "mdx_extra_q", device: str = None):
+    """The model for `device` with the configured CPU inference backend."""
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return registry.get(model_name, device, **inference.model_options(SEGMENT, device))
+
+
+def demucs_progress(progress_callback, length: int, samplerate: int, should_stop: Callable[[], bool] = None):
+    """Adapt apply_model's per-segment callback to a 0..1 fraction of the job.
+
+    apply_model reports each segment's offset once it finishes, per model in
+    the bag; the random shift adds up to half a second, which is folded into
+    the length estimate. Raising from the callback aborts the separation, so
+    a cancelled job stops within one segment.
+    """
+    padded_length = length + samplerate // 2
+    segment_length = int(SEGMENT * samplerate)
+
+    def on_segment(info: dict):
+        if should_stop and should_stop():
+            raise JobCancelled("Cancelled during separation")
+        if info.get("state") != "end" or not progress_callback:
+            return
+        models = info.get("models", 1) or 1
+        done = min(1.0, (info.get("segment_offset", 0) + segment_length) / padded_length)
+        progress_callback(min(1.0, (info.get("model_idx_in_bag", 0) + done) / models))
 
-    if not input_path.exists():
-        raise FileNotFoundError(f"Input not found: {input_path}")
+    return on_segment
 
-    base_name = input_path.stem 
 
+def separate_stems(
+    input_path: str = None,
+    model_name: str = "mdx_extra_q",
+    device: str = None,
+    progress: bool = True,
+    progress_callback: Callable[[float], None] = None,
+    audio: np.ndarray = None,
+    overlap: float = None,
+    bag_size: int = None,
+    should_stop: Callable[[], bool] = None,
+) -> dict:
+    """Run Demucs on a file or decoded audio and return mono stems aligned to the full mix.
+
+    `audio` is a (channels, frames) float32 array already at the model's
+    sample rate (see audio_io.decode_audio); when given, input_path is unused.
+    The returned dict holds `stems` (tag -> np.ndarray), `full` (the mono mix)
+    and `samplerate`, so post-processing can run without the model or torch.
+    `progress_callback` receives the separated fraction (0..1) as segments
+    finish; unbatched, it needs a demucs version whose apply_model takes a
+    callback. `overlap` overrides OVERLAP and `bag_size` keeps only the first
+    models of a bag, trading quality for speed (used for previews). When
+    `should_stop()` turns true, JobCancelled is raised at the next segment.
+    """
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"Using device: {device}")
 
-    # Model
-    print(f"Loading {model_name} model...")
-    model = get_model(model_name)
-    model.eval()
+    # Model (kept warm between jobs by the registry)
+    with timed("model_load"):
+        model = load_model(model_name, device)
+    if bag_size and isinstance(model, BagOfModels) and bag_size < len(model.models):
+        model = BagOfModels(model.models[:bag_size], model.weights[:bag_size])
+
+    if audio is None:
+        input_path = Path(input_path)
+        if not input_path.exists():
+            raise FileNotFoundError(f"Input not found: {input_path}")
+        print(f"Loading: {input_path.name}")
+        with timed("decode"):
+            audio = decode_audio(str(input_path), model.samplerate, model.audio_channels)
+    if audio.shape[0] != model.audio_channels:
+        raise ValueError(f"Expected {model.audio_channels} channels, got {audio.shape[0]}")
+    wav = torch.from_numpy(audio).to(device)
     if device == "cuda":
-        model = model.cuda()
-        try:
-            model = model.half()
-            wav = wav.half()
-        except:
-            pass  
+        wav = wav.to(next(model.parameters()).dtype)
 
-    print(f"Loading: {input_path.name}")
-    wav = AudioFile(str(input_path)).read(
-        streams=0,
-        samplerate=model.samplerate,
-        channels=model.audio_channels,
-    ).to(device)
+    callback = None
+    if progress_callback or should_stop:
+        callback = demucs_progress(progress_callback, wav.shape[-1], model.samplerate, should_stop)
 
     print("Splitting stems...")
-    with torch.no_grad():  
-        sources = apply_model(
+    with torch.no_grad(), timed("separation"):
+        sources = inference.separate(
             model,
             wav[None],
             device=device,
+            segment=SEGMENT,
+            overlap=OVERLAP if overlap is None else overlap,
             progress=progress,
-            overlap=0.05,    
-            segment=8,       
+            callback=callback,
         )[0]
+    if progress_callback:
+        progress_callback(1.0)
 
-    stem_tags = {
-        "drums": "drums",
-        "bass": "bass",
-        "other": "melody",
-        "vocals": "vocals",
-    }
-    output_paths = []
-    samplerate = model.samplerate
-    
-    stems_dict = {tag: sources[i].mean(0).cpu().numpy() for i, (src_name, tag) in enumerate(stem_tags.items())}
+    stems_dict = {tag: sources[i].mean(0).float().cpu().numpy() for i, (src_name, tag) in enumerate(STEM_TAGS.items())}
+    del sources
 
     # Align all stems to the same length as the full mix
     full_length = wav.shape[-1]
@@ -165,97 +267,194 @@ def split_mp3_to_stems(
             stem = stem[:full_length]
         stems_dict[tag] = stem
 
-    # Update status to "splitting" (if not already set)
-    if status_file:
-        if isinstance(status_file, str):
-            status_file = Path(status_file)
-        try:
-            current_status = status_file.read_text().strip() if status_file.exists() else ""
-            if current_status != "splitting":
-                status_file.write_text("splitting")
-        except:
-            pass
-    
-    for tag, stem in stems_dict.items():
-        if tag == "bass":
-            print("Tuning bass: 200Hz low-pass...")
-            stem = lowpass_filter(stem, cutoff=200, fs=samplerate, order=6)
-
-        if tag == "melody":
-            print("Cleaning melody: removing vocal/drum bleed...")
-            vocals = stems_dict.get("vocals")
-            drums = stems_dict.get("drums")
-            if vocals is not None and drums is not None:
-                ref = vocals + drums
-                stem_clean = spectral_gate(stem, ref, samplerate, threshold=0.12)
-                if len(stem_clean) < len(stem):
-                    stem_clean = np.pad(stem_clean, (0, len(stem) - len(stem_clean)))
-                if np.max(np.abs(stem_clean)) < 0.05:
-                    print("Melody too quiet after cleaning, blending in other stems for fullness...")
-                    blend = 0.25 * vocals + 0.25 * drums + 0.25 * stems_dict.get("bass", 0)
-                    if len(blend) != len(stem_clean):
-                        min_len = min(len(blend), len(stem_clean))
-                        blend = blend[:min_len]
-                        stem_clean = stem_clean[:min_len]
-                    stem_clean = stem_clean + blend
-                stem = stem_clean
-
-        # Write to disk
-        stem_path = output_dir / f"{base_name}[{tag}].wav"
-        sf.write(str(stem_path), stem, samplerate)
-        print(f"Saved: {stem_path.name}")
-        output_paths.append(str(stem_path))
+    return {
+        "stems": stems_dict,
+        "full": wav.mean(0).float().cpu().numpy(),
+        "samplerate": model.samplerate,
+    }
 
-    if include_full:
-        full_path = output_dir / f"{base_name}[full].mp3"
-        full_wav = wav.mean(0).cpu().numpy()
-        temp_wav = str(full_path).replace(".mp3", ".wav")
-        sf.write(temp_wav, full_wav, samplerate)
+
+def postprocess_pool() -> ThreadPoolExecutor:
+    global _postprocess_pool
+    if _postprocess_pool is None:
+        _postprocess_pool = ThreadPoolExecutor(POSTPROCESS_THREADS, thread_name_prefix="postprocess")
+    return _postprocess_pool
+
+
+def in_job(func: Callable) -> Callable:
+    """Wrap func so timings inside it are recorded for the calling thread's job."""
+    job_metrics = current_job_metrics()
+
+    def run(*args, **kwargs):
+        with job_context(job_metrics):
+            return func(*args, **kwargs)
+    return run
+
+
+def clean_stem(tag: str, stems_dict: dict, analysis: StemAnalysis, samplerate: int) -> np.ndarray:
+    """Bass low-pass or melody gating; other stems pass through."""
+    stem = stems_dict[tag]
+    if tag == "bass":
+        print(f"Tuning bass: {BASS_CUTOFF}Hz low-pass...")
+        with timed("filtering"):
+            stem = lowpass_filter(stem, cutoff=BASS_CUTOFF, fs=samplerate, order=6)
+
+    if tag == "melody":
+        print("Cleaning melody: removing vocal/drum bleed...")
+        vocals = stems_dict.get("vocals")
+        drums = stems_dict.get("drums")
+        if vocals is not None and drums is not None:
+            with timed("gating"):
+                stem_clean = analysis.gate("melody", ("vocals", "drums"), threshold=GATE_THRESHOLD)
+            if len(stem_clean) < len(stem):
+                stem_clean = np.pad(stem_clean, (0, len(stem) - len(stem_clean)))
+            if np.max(np.abs(stem_clean)) < 0.05:
+                print("Melody too quiet after cleaning, blending in other stems for fullness...")
+                blend = 0.25 * vocals + 0.25 * drums + 0.25 * stems_dict.get("bass", 0)
+                if len(blend) != len(stem_clean):
+                    min_len = min(len(blend), len(stem_clean))
+                    blend = blend[:min_len]
+                    stem_clean = stem_clean[:min_len]
+                stem_clean = stem_clean + blend
+            stem = stem_clean
+    return stem
+
+
+def save_stem(path: Path, stem: np.ndarray, samplerate: int, bpm: float) -> str:
+    with timed("encoding"):
+        write_stem(str(path), stem, samplerate, bpm)
+    with timed("peaks"):
+        write_peaks(path, stem, samplerate)
+    print(f"Saved: {path.name} (BPM {bpm:.1f})")
+    return str(path)
+
+
+def save_full_mix(path: Path, full_wav: np.ndarray, samplerate: int) -> str:
+    with timed("encoding"):
         try:
-            from pydub import AudioSegment
-            audio = AudioSegment.from_wav(temp_wav)
-            audio.export(str(full_path), format="mp3", bitrate="192k")
-            os.remove(temp_wav)
+            encode_mp3(str(path), full_wav, samplerate, bitrate="192k")
         except Exception as e:
-            print(f"MP3 export failed (keeping WAV): {e}")
-            full_path = Path(temp_wav)
-        print(f"Saved: {full_path.name}")
-        output_paths.append(str(full_path))
+            print(f"MP3 export failed (writing WAV): {e}")
+            path = path.with_suffix(".wav")
+            sf.write(str(path), full_wav, samplerate)
+    with timed("peaks"):
+        write_peaks(path, full_wav, samplerate)
+    print(f"Saved: {path.name}")
+    return str(path)
 
-    bpm = 128.0
-    if "drums" in stems_dict:
+
+def postprocess_stems(
+    separated: dict,
+    output_dir: str,
+    base_name: str,
+    include_full: bool = True,
+    stem_format: str = STEM_FORMAT,
+) -> Tuple[List[str], float, str]:
+    """Filter, write and tag the stems returned by `separate_stems`.
+
+    BPM/key analysis, per-stem cleaning and the full-mix encode run
+    concurrently on the post-processing pool. Each stem is written once,
+    in `stem_format`, with its BPM tags, as soon as it is clean and the BPM
+    is known; the stems are encoded in parallel on the same pool.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True)
+    stems_dict = separated["stems"]
+    samplerate = separated["samplerate"]
+    pool = postprocess_pool()
+    # STFTs computed here are shared by gating, BPM and key detection
+    analysis = StemAnalysis(stems_dict, samplerate)
+
+    def detect_bpm():
+        if "drums" not in stems_dict:
+            return 128.0
         print("Detecting BPM from drums...")
-        drums_data = stems_dict["drums"]
-        bpm = detect_bpm_from_array(drums_data, samplerate)
+        with timed("analysis"):
+            bpm = analysis.bpm("drums")
         print(f"Detected BPM: {bpm:.1f}")
+        return bpm
 
-    key = "Unknown"
-    if "melody" in stems_dict:
-        print("Detecting key from melody...")
-        melody_data = stems_dict["melody"]
-        key = detect_key_from_audio(melody_data, samplerate)
-        print(f"Detected Key: {key}")
-    elif include_full:
-        print("Detecting key from full mix...")
-        full_data = wav.mean(0).cpu().numpy()
-        key = detect_key_from_audio(full_data, samplerate)
+    def detect_key():
+        with timed("analysis"):
+            if "melody" in stems_dict:
+                print("Detecting key from melody...")
+                key = analysis.key("melody")
+            elif include_full:
+                print("Detecting key from full mix...")
+                key = detect_key_from_audio(separated["full"], samplerate)
+            else:
+                return "Unknown"
         print(f"Detected Key: {key}")
+        return key
+
+    # Work that doesn't depend on anything else starts straight away
+    bpm_future = pool.submit(in_job(detect_bpm))
+    key_future = pool.submit(in_job(detect_key))
+    cleaned = {tag: pool.submit(in_job(clean_stem), tag, stems_dict, analysis, samplerate) for tag in stems_dict}
+    full_future = None
+    if include_full:
+        full_path = output_dir / f"{base_name}[full].mp3"
+        full_future = pool.submit(in_job(save_full_mix), full_path, separated["full"], samplerate)
+
+    # Writing needs the BPM for the tags. Tasks never wait on each other,
+    # so a busy pool can't deadlock.
+    try:
+        bpm = bpm_future.result()
+        writes = [
+            pool.submit(in_job(save_stem), output_dir / f"{base_name}[{tag}].{stem_format}", cleaned[tag].result(), samplerate, bpm)
+            for tag in stems_dict
+        ]
+        output_paths = [future.result() for future in writes]
+        if full_future:
+            output_paths.append(full_future.result())
+        key = key_future.result()
+    finally:
+        for future in [bpm_future, key_future, full_future, *cleaned.values()]:
+            if future:
+                future.cancel()
+        analysis.release()
 
-    for path in output_paths:
-        if str(path).endswith(".wav"):
-            embed_bpm_in_wav(str(path), bpm)
-    
     print(f"\nAll stems saved to: {output_dir}")
     print("Drag into Ableton → INSTANT SYNC")
-    
+
     return output_paths, bpm, key
 
 
+def split_mp3_to_stems(
+    input_path: str,
+    output_dir: str,
+    model_name: str = "mdx_extra_q",  
+    device: str = None,
+    progress: bool = True,
+    include_full: bool = True,
+    status_file = None,
+) -> Tuple[List[str], float, str]:
+    separated = separate_stems(input_path, model_name=model_name, device=device, progress=progress)
+
+    # Update status to "splitting" (if not already set)
+    if status_file:
+        if isinstance(status_file, str):
+            status_file = Path(status_file)
+        try:
+            current_status = status_file.read_text().strip() if status_file.exists() else ""
+            if current_status != "splitting":
+                status_file.write_text("splitting")
+        except:
+            pass
+
+    return postprocess_stems(separated, output_dir, Path(input_path).stem, include_full=include_full)
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True)
     parser.add_argument("--output", default="stems")
+    parser.add_argument("--stream", action="store_true", help="Separate in windows with flat memory use (for long tracks)")
     args = parser.parse_args()
-    stems, bpm, key = split_mp3_to_stems(args.input, args.output)
+    if args.stream:
+        from streaming import split_stream_to_stems
+        stems, bpm, key = split_stream_to_stems(args.input, args.output)
+    else:
+        stems, bpm, key = split_mp3_to_stems(args.input, args.output)
     print(f"BPM: {bpm:.1f}, Key: {key}")
\ No newline at end of file
@@ -0,0 +1,278 @@
+# streaming.py
+# Splits long tracks window by window so memory stays flat with track length
+import os
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+import numpy as np
+import soundfile as sf
+import torch
+import librosa
+from scipy.signal import butter, lfilter
+import inference
+
+from audio_io import FFmpegReader, FFmpegWriter
+from peaks import write_peaks_from_file
+from analysis import key_from_chroma
+from metrics import timed
+from scheduler import JobCancelled
+from settings import STEM_FORMAT
+from splitter import SEGMENT, OVERLAP, BASS_CUTOFF, GATE_THRESHOLD, STEM_TAGS, tag_stem, load_model
+
+WINDOW_SECONDS = 60
+CROSSFADE_SECONDS = 4
+N_FFT = 2048
+HOP_LENGTH = 512
+BLOCK_SAMPLES = 1 << 18  # STFT post-processing block, a multiple of HOP_LENGTH
+
+
+class StreamingLowpass:
+    """Butterworth low-pass whose filter state carries across blocks.
+
+    Starting from a zero state, the concatenated output is identical to
+    filtering the whole signal at once with lowpass_filter.
+    """
+
+    def __init__(self, cutoff: float, fs: int, order: int = 5):
+        nyq = 0.5 * fs
+        self.b, self.a = butter(order, cutoff / nyq, btype='low', analog=False)
+        self.zi = np.zeros(max(len(self.a), len(self.b)) - 1)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        out, self.zi = lfilter(self.b, self.a, block, zi=self.zi)
+        return out
+
+
+class StreamingSpectral:
+    """Melody gating, onset strength and chroma over a stream of stem blocks.
+
+    Rows pushed in are (melody, vocals, drums, bass). Each block is analysed
+    with N_FFT samples of context on both sides, aligned to the global hop
+    grid, so the gated melody matches what spectral_gate produces on the
+    whole track. Output lags the input by up to one block plus the context.
+    """
+
+    def __init__(self, sr: int, threshold: float = GATE_THRESHOLD):
+        self.sr = sr
+        self.threshold = threshold
+        self.pad = N_FFT
+        self.left = np.zeros((4, 0), dtype=np.float32)
+        self.pending = np.zeros((4, 0), dtype=np.float32)
+        self.mel_basis = librosa.filters.mel(sr=sr, n_fft=N_FFT)
+        self.last_mel_db = None
+        # onset_strength pads lag + n_fft // (2 * hop) frames at the start
+        self.onset = [np.zeros(1 + N_FFT // (2 * HOP_LENGTH), dtype=np.float32)]
+        self.chroma_sum = np.zeros(12)
+        self.chroma_frames = 0
+
+    def push(self, rows: np.ndarray):
+        """Add samples; yields (gated melody, raw rows) for each finished block."""
+        self.pending = np.concatenate([self.pending, rows.astype(np.float32)], axis=1)
+        while self.pending.shape[1] >= BLOCK_SAMPLES + self.pad:
+            yield self._process(BLOCK_SAMPLES)
+
+    def flush(self):
+        if self.pending.shape[1]:
+            yield self._process(self.pending.shape[1])
+
+    def _process(self, length: int):
+        # The first and last blocks have no context on that side, exactly
+        # like the edges of a whole-track STFT
+        left = self.left.shape[1]
+        final = self.pending.shape[1] == length
+        segment = np.concatenate([self.left, self.pending[:, :length + self.pad]], axis=1)
+
+        spectra = librosa.stft(segment[:3], n_fft=N_FFT, hop_length=HOP_LENGTH)
+        melody_mag = np.abs(spectra[0])
+        ref_mag = np.abs(spectra[1] + spectra[2])  # STFT is linear: |STFT(vocals + drums)|
+        gated = librosa.istft(
+            melody_mag * (melody_mag > self.threshold * ref_mag),
+            n_fft=N_FFT, hop_length=HOP_LENGTH, length=None if final else segment.shape[1],
+        )[left:left + length]
+        if len(gated) < length:
+            gated = np.pad(gated, (0, length - len(gated)))
+
+        # Frames centred inside this block belong to it
+        first = left // HOP_LENGTH
+        owned = slice(first, first + -(-length // HOP_LENGTH))
+        self._onset(np.abs(spectra[2][:, owned]) ** 2)
+        chroma = librosa.feature.chroma_stft(S=melody_mag[:, owned] ** 2, sr=self.sr)
+        self.chroma_sum += chroma.sum(axis=1)
+        self.chroma_frames += chroma.shape[1]
+
+        rows = self.pending[:, :length]
+        self.left = segment[:, left + length - self.pad:left + length]
+        self.pending = self.pending[:, length:]
+        return gated, rows
+
+    def _onset(self, drums_power: np.ndarray):
+        mel_db = librosa.power_to_db(self.mel_basis @ drums_power)
+        if self.last_mel_db is not None:
+            mel_db_prev = np.concatenate([self.last_mel_db[:, None], mel_db], axis=1)
+        else:
+            mel_db_prev = mel_db
+        diff = np.maximum(0.0, mel_db_prev[:, 1:] - mel_db_prev[:, :-1])
+        self.onset.append(diff.mean(axis=0).astype(np.float32))
+        self.last_mel_db = mel_db[:, -1]
+
+    def bpm(self) -> float:
+        try:
+            tempo, _ = librosa.beat.beat_track(onset_envelope=np.concatenate(self.onset), sr=self.sr)
+            return float(np.atleast_1d(tempo)[0])
+        except Exception as e:
+            print(f"BPM detection failed: {e}")
+            return 128.0
+
+    def key(self) -> str:
+        if not self.chroma_frames:
+            return "Unknown"
+        try:
+            return key_from_chroma(self.chroma_sum / self.chroma_frames)
+        except Exception as e:
+            print(f"Key detection failed: {e}")
+            return "Unknown"
+
+
+def split_stream_to_stems(
+    input_path: str,
+    output_dir: str,
+    base_name: str = None,
+    model_name: str = "mdx_extra_q",
+    device: str = None,
+    include_full: bool = True,
+    total_seconds: float = None,
+    progress_callback: Callable[[float], None] = None,
+    should_stop: Callable[[], bool] = None,
+) -> Tuple[List[str], float, str]:
+    """Streaming version of split_mp3_to_stems for long tracks.
+
+    The input is decoded and separated in WINDOW_SECONDS windows that overlap
+    by CROSSFADE_SECONDS and are crossfaded together. Filtering, gating and
+    BPM/key analysis run block by block and every output file is appended to
+    as it goes, so peak memory depends on the window size, not the track.
+    `total_seconds` is only used to report progress. When `should_stop()`
+    turns true, JobCancelled is raised at the next Demucs segment.
+    """
+    input_path = Path(input_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True)
+    if not input_path.exists():
+        raise FileNotFoundError(f"Input not found: {input_path}")
+    base_name = base_name or input_path.stem
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    with timed("model_load"):
+        model = load_model(model_name, device)
+    samplerate = model.samplerate
+    window = int(WINDOW_SECONDS * samplerate)
+    crossfade = int(CROSSFADE_SECONDS * samplerate)
+    fade_in = np.linspace(0.0, 1.0, crossfade, dtype=np.float32)
+    fade_out = 1.0 - fade_in
+    total_samples = int(total_seconds * samplerate) if total_seconds else None
+
+    tags = list(STEM_TAGS.values())
+    paths = {tag: output_dir / f"{base_name}[{tag}].{STEM_FORMAT}" for tag in tags}
+    blend_path = output_dir / f".{base_name}[melody].blend.{STEM_FORMAT}"
+    # libsndfile encodes FLAC block by block too, so either format streams
+    sound_format, subtype = STEM_FORMAT.upper(), "PCM_16"
+    writers = {tag: sf.SoundFile(str(path), "w", samplerate, 1, format=sound_format, subtype=subtype) for tag, path in paths.items()}
+    writers["blend"] = sf.SoundFile(str(blend_path), "w", samplerate, 1, format=sound_format, subtype=subtype)
+    full_path = output_dir / f"{base_name}[full].mp3"
+    full_writer = FFmpegWriter(full_path, samplerate) if include_full else None
+
+    bass_filter = StreamingLowpass(BASS_CUTOFF, samplerate, order=6)
+    spectral = StreamingSpectral(samplerate)
+    melody_peak = 0.0
+    written = 0
+
+    def write_spectral(results):
+        nonlocal melody_peak
+        for gated, rows in results:
+            melody_peak = max(melody_peak, float(np.max(np.abs(gated))) if len(gated) else 0.0)
+            writers["melody"].write(gated)
+            # Written alongside in case the gated melody turns out too quiet
+            writers["blend"].write(gated + 0.25 * rows[1] + 0.25 * rows[2] + 0.25 * rows[3])
+
+    def emit(stems: np.ndarray, mix: np.ndarray):
+        nonlocal written
+        by_tag = dict(zip(tags, stems))
+        writers["drums"].write(by_tag["drums"])
+        writers["vocals"].write(by_tag["vocals"])
+        writers["bass"].write(bass_filter.process(by_tag["bass"]))
+        rows = np.stack([by_tag["melody"], by_tag["vocals"], by_tag["drums"], by_tag["bass"]])
+        write_spectral(spectral.push(rows))
+        if full_writer:
+            full_writer.write(mix)
+        written += stems.shape[1]
+        if progress_callback and total_samples:
+            progress_callback(min(1.0, written / total_samples))
+
+    def check_stop(info: dict = None):
+        if should_stop and should_stop():
+            raise JobCancelled("Cancelled during separation")
+
+    def separate(chunk: np.ndarray) -> np.ndarray:
+        wav = torch.from_numpy(chunk).to(device)
+        if device == "cuda":
+            wav = wav.to(next(model.parameters()).dtype)
+        with torch.no_grad(), timed("separation"):
+            sources = inference.separate(model, wav[None], device, segment=SEGMENT, overlap=OVERLAP, callback=check_stop if should_stop else None)[0]
+        return sources.mean(1).float().cpu().numpy()
+
+    print(f"Streaming {input_path.name} in {WINDOW_SECONDS}s windows...")
+    try:
+        with FFmpegReader(input_path, samplerate, model.audio_channels) as reader:
+            carry = None
+            prev_tail = None
+            while True:
+                fresh = reader.read(window if carry is None else window - crossfade)
+                if carry is None and fresh.shape[1] == 0:
+                    raise RuntimeError(f"No audio decoded from {input_path.name}")
+                if carry is not None and fresh.shape[1] == 0:
+                    # The last window ended exactly on the input's end
+                    emit(prev_tail, carry.mean(0))
+                    break
+                chunk = fresh if carry is None else np.concatenate([carry, fresh], axis=1)
+                stems = separate(chunk)
+                if prev_tail is not None:
+                    stems[:, :crossfade] = prev_tail * fade_out + stems[:, :crossfade] * fade_in
+                if chunk.shape[1] < window:
+                    emit(stems, chunk.mean(0))
+                    break
+                emit(stems[:, :-crossfade], chunk[:, :-crossfade].mean(0))
+                prev_tail = stems[:, -crossfade:]
+                carry = chunk[:, -crossfade:]
+        write_spectral(spectral.flush())
+    finally:
+        for writer in writers.values():
+            writer.close()
+        if full_writer:
+            full_writer.close()
+
+    if melody_peak < 0.05:
+        print("Melody too quiet after cleaning, blending in other stems for fullness...")
+        os.replace(blend_path, paths["melody"])
+    else:
+        os.remove(blend_path)
+
+    output_paths = [str(paths[tag]) for tag in tags]
+    if include_full:
+        output_paths.append(str(full_path))
+    with timed("peaks"):
+        for path in output_paths:
+            write_peaks_from_file(path)
+            print(f"Saved: {Path(path).name}")
+
+    with timed("analysis"):
+        bpm = spectral.bpm()
+        key = spectral.key()
+    print(f"Detected BPM: {bpm:.1f}")
+    print(f"Detected Key: {key}")
+    with timed("tagging"):
+        for path in output_paths:
+            if not path.endswith(".mp3"):
+                tag_stem(path, bpm)
+
+    print(f"\nAll stems saved to: {output_dir}")
+    return output_paths, bpm, key
@@ -0,0 +1,104 @@
+# conftest.py
+# Shared fixtures: yt-dlp served by the offline stand-in, and the FastAPI app in a scratch folder
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from fake_youtube import FakeYoutubeDL, offline_youtube
+
+
+@pytest.fixture
+def youtube():
+    """converter.py's yt-dlp calls served by FakeYoutubeDL, starting with no videos and an empty metadata cache."""
+    from converter import metadata_cache
+    for registry in (FakeYoutubeDL.videos, FakeYoutubeDL.playlists, FakeYoutubeDL.live):
+        registry.clear()
+    FakeYoutubeDL.extracted.clear()
+    metadata_cache.entries.clear()
+    with offline_youtube() as fake:
+        yield fake
+
+
+@pytest.fixture(scope="session")
+def client(tmp_path_factory):
+    """A TestClient for main.app, whose job folders and database live in a scratch folder."""
+    from fastapi.testclient import TestClient
+
+    # main.py resolves its folders relative to the working directory
+    workdir = tmp_path_factory.mktemp("app")
+    (workdir / "static").mkdir()
+    (workdir / "templates").mkdir()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    # Worker processes start without a model; no job here needs one
+    os.environ["PRELOAD_MODEL"] = ""
+    os.environ["PREVIEW_SECONDS"] = "0"
+    try:
+        import main
+        yield TestClient(main.app)
+    finally:
+        os.chdir(cwd)
+
+
+class StandInStages:
+    """In-process stand-ins for the separation and post-processing workers, needing no model.
+
+    Each separation records its job ID, sets `started` and waits until
+    `release` is set; post-processing writes one small stem file.
+    """
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.separated = []
+
+    def separate(self, job: dict):
+        self.separated.append(job["job_id"])
+        self.started.set()
+        self.release.wait(10)
+        job.pop("audio", None)
+
+    def postprocess(self, job: dict):
+        stem = Path(job["output_root"]) / job["name"] / f"{job['name']} [drums].wav"
+        stem.write_bytes(b"full")
+        job.update(stems=[str(stem)], bpm=121.0, key="A minor")
+
+
+@pytest.fixture
+def stages(client, monkeypatch):
+    import main
+    stand_ins = StandInStages()
+    monkeypatch.setattr(main.scheduler.stages["separate"], "func", stand_ins.separate)
+    monkeypatch.setattr(main.scheduler.stages["postprocess"], "func", stand_ins.postprocess)
+    yield stand_ins
+    stand_ins.release.set()
+
+
+def wait_for(client, job_id: str, timeout: float = 60) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f"/status/{job_id}").json()
+        if status["status"] in ("done", "error"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"{job_id} still {status['status']} after {timeout}s")
+
+
+def wait_for_batch(client, batch_id: str, timeout: float = 60) -> dict:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        batch = client.get(f"/batch/{batch_id}").json()
+        if batch["complete"]:
+            return batch
+        time.sleep(0.05)
+    raise AssertionError(f"Batch {batch_id} not complete after {timeout}s: {batch['counts']}")
+
+
+def wait_until(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
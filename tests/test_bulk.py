@@ -0,0 +1,107 @@
+# test_bulk.py
+# Playlist expansion, track names and /bulk batches
+import pytest
+
+from converter import expand_playlist, is_playlist, track_name
+from tests.conftest import wait_for, wait_for_batch
+
+
+def test_is_playlist():
+    assert is_playlist("https://www.youtube.com/playlist?list=PLabc123")
+    # A video watched from a playlist is still one video
+    assert not is_playlist("https://www.youtube.com/watch?v=shortVideo1&list=PLabc123")
+    assert not is_playlist("https://youtu.be/shortVideo1")
+
+
+@pytest.mark.parametrize("title, name", [
+    ("Artist - Song (Official Video)", "Artist - Song (Official Video)"),
+    ('AC/DC: "Back in Black"?', "AC DC Back in Black"),
+    ("  Trailing dots...  ", "Trailing dots"),
+    ("a\tb\nc", "a b c"),
+    ("", "track"),
+    (None, "track"),
+    ("x" * 200, "x" * 120),
+])
+def test_track_name(title, name):
+    assert track_name(title) == name
+
+
+def test_track_name_fallback():
+    assert track_name("///", fallback="shortVideo1") == "shortVideo1"
+
+
+def test_expand_playlist_flat(youtube):
+    youtube.videos.update(playlistA01=30, playlistA02=40)
+    youtube.playlists["PLflat"] = ["playlistA01", "playlistA02", "deleted0001", None]
+    title, entries = expand_playlist(youtube.playlist_url("PLflat"))
+    assert title == "Playlist PLflat"
+    # Unreadable entries are dropped; deleted videos are only found by their pre-flight
+    assert [entry["id"] for entry in entries] == ["playlistA01", "playlistA02", "deleted0001"]
+    assert entries[0]["url"] == youtube.video_url("playlistA01")
+    assert [entry["duration"] for entry in entries] == [30, 40, None]
+    # Flat: the playlist page only, no video resolved
+    assert youtube.extracted == [youtube.playlist_url("PLflat")]
+
+
+def test_expand_playlist_limit(youtube):
+    youtube.playlists["PLlong"] = [f"longList{i:03d}" for i in range(10)]
+    _, entries = expand_playlist(youtube.playlist_url("PLlong"), limit=3)
+    assert [entry["id"] for entry in entries] == ["longList000", "longList001", "longList002"]
+
+
+def test_expand_playlist_unavailable(youtube):
+    with pytest.raises(ValueError, match="Couldn't resolve playlist"):
+        expand_playlist(youtube.playlist_url("PLmissing"))
+
+
+def test_start_rejects_playlist(youtube, client):
+    youtube.videos["playlistB01"] = 5
+    youtube.playlists["PLsingle"] = ["playlistB01"]
+    response = client.post("/start", data={"url": youtube.playlist_url("PLsingle"), "name": "list", "mode": "youtube"})
+    assert response.status_code == 400
+    assert "Playlists aren't supported" in response.json()["error"]
+
+
+def test_bulk_batch(youtube, client):
+    youtube.videos.update(bulkTrack01=5, bulkTrack02=5)
+    youtube.playlists["PLbulk"] = ["bulkTrack01", "bulkTrack02", "deleted0002"]
+    urls = "\n".join([
+        youtube.playlist_url("PLbulk"),
+        # Both repeat a playlist track, in two URL forms
+        youtube.video_url("bulkTrack01"),
+        "https://youtu.be/bulkTrack02",
+    ])
+    batch = client.post("/bulk", data={"urls": urls, "mode": "youtube"}).json()
+    assert batch["title"] == "Playlist PLbulk"
+    assert batch["total"] == 2
+    assert sorted(track["name"] for track in batch["tracks"]) == ["Synthetic bulkTrack01", "Synthetic bulkTrack02"]
+    assert [rejected["url"] for rejected in batch["rejected"]] == [youtube.video_url("deleted0002")]
+    assert batch["skipped"] == []
+
+    batch = wait_for_batch(client, batch["batch_id"])
+    assert batch["counts"] == {"done": 2}
+    assert batch["progress"] == 1.0
+    assert all(track["stems"] for track in batch["tracks"])
+
+    # Resubmitted, every track already has its result
+    again = client.post("/bulk", data={"urls": youtube.playlist_url("PLbulk"), "mode": "youtube"}).json()
+    assert again["total"] == 0
+    assert again["complete"]
+    assert sorted(skipped["video_id"] for skipped in again["skipped"]) == ["bulkTrack01", "bulkTrack02"]
+
+
+def test_bulk_single_video_counts(youtube, client):
+    youtube.videos["bulkTrack03"] = 5
+    batch = client.post("/bulk", data={"urls": youtube.video_url("bulkTrack03"), "mode": "youtube"}).json()
+    assert batch["title"] is None
+    assert batch["total"] == 1
+    wait_for(client, batch["tracks"][0]["job_id"])
+    batch = client.get(f"/batch/{batch['batch_id']}").json()
+    assert batch["counts"] == {"done": 1}
+    assert batch["complete"]
+
+
+def test_bulk_errors(client):
+    assert client.post("/bulk", data={"urls": "  "}).status_code in (400, 422)
+    assert client.post("/bulk", data={"urls": "https://youtu.be/shortVideo1", "priority": "urgent"}).status_code == 400
+    assert client.get("/batch/nosuchid").status_code == 404
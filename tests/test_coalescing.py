@@ -0,0 +1,90 @@
+# test_coalescing.py
+# Identical requests sharing one computation, and removing either side of it
+from tests.conftest import wait_for, wait_until
+
+
+def start(client, url: str, name: str) -> dict:
+    response = client.post("/start", data={"url": url, "name": name})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_duplicate_follows_leader_and_completes_from_cache(youtube, client, stages):
+    youtube.videos["coalesce001"] = 5
+    url = youtube.video_url("coalesce001")
+    leader = start(client, url, "leader")["job_id"]
+    assert stages.started.wait(10)
+    follower = start(client, url, "follower")
+    assert follower["coalesced_with"] == leader
+    assert client.get("/queue").json()["queue"][-1]["coalesced_with"] == leader
+
+    stages.release.set()
+    assert wait_for(client, leader)["status"] == "done"
+    assert wait_for(client, follower["job_id"])["status"] == "done"
+    assert stages.separated == [leader]
+    # The follower's copy is named after its own song
+    files = client.get(f"/files/{follower['job_id']}/follower").json()["files"]
+    assert [f["name"] for f in files] == ["follower [drums].wav"]
+    # A later request is a plain cache hit
+    assert start(client, url, "later")["cached"]
+
+
+def test_removing_leader_with_followers_detaches_it(youtube, client, stages):
+    import main
+    youtube.videos["coalesce002"] = 5
+    url = youtube.video_url("coalesce002")
+    leader = start(client, url, "leader")["job_id"]
+    assert stages.started.wait(10)
+    follower = start(client, url, "follower")["job_id"]
+
+    assert client.post(f"/remove_job/{leader}").json() == {"removed": True}
+    assert client.get(f"/status/{leader}").json()["status"] == "cancelled"
+    # Still running, for the follower
+    running = next(job for job in main.scheduler.snapshot()[1] if job["job_id"] == leader)
+    assert running["detached"] and not running["cancel"].is_set()
+
+    stages.release.set()
+    assert wait_for(client, follower)["status"] == "done"
+    assert client.get(f"/status/{leader}").json()["status"] == "cancelled"
+    assert not (main.OUTPUT_ROOT / leader).exists()
+    assert stages.separated == [leader]
+
+
+def test_removing_follower_leaves_leader_alone(youtube, client, stages):
+    import main
+    youtube.videos["coalesce003"] = 5
+    url = youtube.video_url("coalesce003")
+    leader = start(client, url, "leader")["job_id"]
+    assert stages.started.wait(10)
+    follower = start(client, url, "follower")["job_id"]
+
+    assert client.post(f"/remove_job/{follower}").json() == {"removed": True}
+    assert client.get(f"/status/{follower}").json()["status"] == "removed"
+    assert main.followers_of({"job_id": leader}) == []
+    running = next(job for job in main.scheduler.snapshot()[1] if job["job_id"] == leader)
+    assert not running.get("detached") and not running["cancel"].is_set()
+
+    stages.release.set()
+    assert wait_for(client, leader)["status"] == "done"
+    assert client.get(f"/status/{follower}").json()["status"] == "removed"
+
+
+def test_removing_last_follower_of_detached_leader_cancels_it(youtube, client, stages):
+    import main
+    youtube.videos["coalesce004"] = 5
+    url = youtube.video_url("coalesce004")
+    leader = start(client, url, "leader")["job_id"]
+    assert stages.started.wait(10)
+    follower = start(client, url, "follower")["job_id"]
+    client.post(f"/remove_job/{leader}")
+    client.post(f"/remove_job/{follower}")
+
+    # Nobody wants the result now: the leader is cancelled and cleaned up
+    stages.release.set()
+    wait_until(lambda: all(job["job_id"] != leader for job in main.scheduler.snapshot()[1]))
+    assert not (main.OUTPUT_ROOT / leader).exists()
+    assert all(job["job_id"] != leader for job in main.inflight.values())
+    # So the next request computes the video itself instead of following it
+    again = start(client, url, "again")
+    assert "coalesced_with" not in again
+    assert wait_for(client, again["job_id"])["status"] == "done"
@@ -0,0 +1,76 @@
+# test_completed.py
+# Paging and polling through finished jobs with /completed cursors
+import uuid
+
+from jobstore import JobStore
+
+
+def finish(store: JobStore, completed_at: float) -> str:
+    job_id = str(uuid.uuid4())[:8]
+    store.create({"job_id": job_id, "url": "https://youtu.be/shortVideo1", "name": job_id, "output_root": "."})
+    store.complete(job_id, [])
+    store._update(job_id, completed_at=completed_at)
+    return job_id
+
+
+def test_pages_keep_jobs_with_the_same_timestamp(tmp_path):
+    store = JobStore(tmp_path / "jobs.db")
+    # Cache hits complete several jobs in the same instant
+    job_ids = [finish(store, 100.0) for _ in range(5)] + [finish(store, 50.0)]
+    seen, cursor = [], None
+    while True:
+        rows = store.completed(2, before=cursor)
+        seen += [row["job_id"] for row in rows]
+        if len(rows) < 2:
+            break
+        cursor = (rows[-1]["completed_at"], rows[-1]["job_id"])
+    assert sorted(seen) == sorted(job_ids)
+    assert seen[-1] == job_ids[-1]
+
+
+def test_since_returns_oldest_first(tmp_path):
+    store = JobStore(tmp_path / "jobs.db")
+    old = finish(store, 10.0)
+    new = [finish(store, float(t)) for t in range(20, 25)]
+    rows = store.completed(2, since=(10.0, old))
+    assert [row["job_id"] for row in rows] == new[:2]
+    # A bare timestamp compares by time alone
+    assert [row["job_id"] for row in store.completed(10, since=(22.0, None))] == new[3:]
+
+
+def test_completed_endpoint_cursors(client):
+    import main
+    job_ids = {finish(main.store, 1000.0) for _ in range(3)}
+
+    # Paging back from the newest never skips or repeats a job
+    seen, params = [], {"limit": 2}
+    while True:
+        page = client.get("/completed", params=params).json()
+        assert len(page["completed"]) <= 2
+        seen += [entry["job_id"] for entry in page["completed"]]
+        if page["next_before"] is None:
+            break
+        params = {"limit": 2, "before": page["next_before"]}
+    assert len(seen) == len(set(seen))
+    assert job_ids <= set(seen)
+
+    # Polling from before those jobs finds all of them, a page at a time
+    polled, cursor = [], "999.0"
+    while True:
+        page = client.get("/completed", params={"limit": 2, "since": cursor}).json()
+        polled += [entry["job_id"] for entry in page["completed"]]
+        cursor = page["next_since"]
+        if len(page["completed"]) < 2:
+            break
+    assert job_ids <= set(polled)
+    assert client.get("/completed", params={"since": cursor}).json()["completed"] == []
+
+
+def test_completed_limit_is_clamped(client):
+    import main
+    for _ in range(2):
+        finish(main.store, 2000.0)
+    page = client.get("/completed", params={"limit": 0}).json()
+    assert len(page["completed"]) == 1
+    assert page["next_before"] is not None
+    assert client.get("/completed", params={"before": "yesterday"}).status_code == 400
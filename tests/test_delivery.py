@@ -0,0 +1,73 @@
+# test_delivery.py
+# Stem downloads: Range and conditional requests, ZIP bundles and WAVs decoded from re-encoded FLAC
+import io
+import uuid
+import zipfile
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+SAMPLERATE = 44100
+
+
+@pytest.fixture
+def finished_job(client):
+    """A done job whose song folder holds a WAV stem and a stem re-encoded to FLAC."""
+    import main
+    job_id, name = str(uuid.uuid4())[:8], "delivered song"
+    folder = main.OUTPUT_ROOT / job_id / name
+    folder.mkdir(parents=True)
+    t = np.arange(SAMPLERATE) / SAMPLERATE
+    audio = (0.5 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    sf.write(folder / f"{name} [drums].wav", audio, SAMPLERATE, subtype="PCM_16")
+    sf.write(folder / f"{name} [bass].flac", audio, SAMPLERATE, subtype="PCM_16")
+    main.store.create({"job_id": job_id, "url": "https://youtu.be/shortVideo1", "name": name, "output_root": str(folder.parent)})
+    main.store.complete(job_id, [])
+    return job_id, name, folder, audio
+
+
+def test_range_request(client, finished_job):
+    job_id, name, folder, _ = finished_job
+    url = f"/download/{job_id}/{name}/{name} [drums].wav"
+    data = (folder / f"{name} [drums].wav").read_bytes()
+    response = client.get(url, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(data)}"
+    assert response.content == data[100:200]
+    full = client.get(url)
+    assert full.status_code == 200
+    assert full.content == data
+
+
+def test_conditional_request(client, finished_job):
+    job_id, name, _, _ = finished_job
+    url = f"/download/{job_id}/{name}/{name} [drums].wav"
+    etag = client.get(url).headers["etag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_download_all_zip(client, finished_job):
+    job_id, name, folder, _ = finished_job
+    response = client.get(f"/download_all/{job_id}")
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.testzip() is None
+    assert sorted(archive.namelist()) == [f"{name}/{name} [bass].flac", f"{name}/{name} [drums].wav"]
+    assert archive.read(f"{name}/{name} [drums].wav") == (folder / f"{name} [drums].wav").read_bytes()
+    etag = response.headers["etag"]
+    assert client.get(f"/download_all/{job_id}", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_wav_decoded_from_flac(client, finished_job):
+    job_id, name, _, audio = finished_job
+    url = f"/download/{job_id}/{name}/{name} [bass].wav"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "audio/wav"
+    assert int(response.headers["content-length"]) == len(response.content)
+    decoded, samplerate = sf.read(io.BytesIO(response.content), dtype="float32")
+    assert samplerate == SAMPLERATE
+    np.testing.assert_allclose(decoded, audio, atol=1 / 32768)
+    assert client.get(url, headers={"If-None-Match": response.headers["etag"]}).status_code == 304
@@ -0,0 +1,11 @@
+# test_events.py
+# The event broker is bound to the server's loop when the app starts
+from fastapi.testclient import TestClient
+
+
+def test_lifespan_binds_broker(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main.broker, "loop", None)
+    with TestClient(main.app):
+        assert main.broker.loop is not None
+        assert main.broker.loop.is_running()
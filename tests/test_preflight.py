@@ -0,0 +1,78 @@
+# test_preflight.py
+# URL pre-flight, the metadata cache and their use by /start
+import pytest
+
+import converter
+from converter import MetadataCache, preflight
+from pipeline import MAX_DURATION
+from tests.conftest import wait_for
+
+
+@pytest.mark.parametrize("case, message", [
+    ("invalid", "Invalid URL"),
+    ("unavailable", "Couldn't resolve video"),
+    ("live", "Live streams aren't supported"),
+    ("too_long", "Video too long"),
+])
+def test_start_rejects_bad_urls(youtube, client, case, message):
+    youtube.videos["liveStream1"] = 60
+    youtube.live.add("liveStream1")
+    youtube.videos["longVideo01"] = MAX_DURATION + 60
+    url = {
+        "invalid": "not a url",
+        "unavailable": youtube.video_url("missing0001"),
+        "live": youtube.video_url("liveStream1"),
+        "too_long": youtube.video_url("longVideo01"),
+    }[case]
+    response = client.post("/start", data={"url": url, "name": case, "mode": "youtube"})
+    assert response.status_code == 400
+    assert message in response.json()["error"]
+
+
+def test_preflight_returns_info(youtube):
+    youtube.videos["shortVideo1"] = 30
+    info = preflight(youtube.video_url("shortVideo1"))
+    assert info["id"] == "shortVideo1"
+    assert info["duration"] == 30
+
+
+def test_preflight_caches_metadata(youtube):
+    youtube.videos["shortVideo1"] = 30
+    url = youtube.video_url("shortVideo1")
+    preflight(url)
+    # A different URL form of the same video hits the cache too
+    preflight("https://youtu.be/shortVideo1")
+    assert youtube.extracted == [url]
+
+
+def test_metadata_cache_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(converter.time, "monotonic", lambda: now[0])
+    cache = MetadataCache(ttl=60)
+    cache.put("shortVideo1", {"id": "shortVideo1"})
+    now[0] += 59
+    assert cache.get("shortVideo1") == {"id": "shortVideo1"}
+    now[0] += 2
+    assert cache.get("shortVideo1") is None
+    assert "shortVideo1" not in cache.entries
+
+
+def test_metadata_cache_keeps_most_recent():
+    cache = MetadataCache(max_entries=2)
+    cache.put("a", {"id": "a"})
+    cache.put("b", {"id": "b"})
+    cache.get("a")
+    cache.put("c", {"id": "c"})
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+
+
+def test_start_downloads_with_cached_info(youtube, client):
+    youtube.videos["shortVideo1"] = 5
+    url = youtube.video_url("shortVideo1")
+    response = client.post("/start", data={"url": url, "name": "cached info", "mode": "youtube"})
+    assert response.status_code == 200
+    status = wait_for(client, response.json()["job_id"])
+    assert status["status"] == "done"
+    # Resolved once by the pre-flight; the download reused that info
+    assert youtube.extracted == [url]
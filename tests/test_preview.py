@@ -0,0 +1,73 @@
+# test_preview.py
+# Previews run beside the full separation and are only published if they finish first
+import threading
+from pathlib import Path
+
+import pytest
+
+import preview
+from preview import PREVIEW_DIR
+from tests.conftest import wait_for, wait_until
+
+
+@pytest.fixture
+def previews(youtube, stages, monkeypatch):
+    """A preview stand-in, held until the test releases it, beside the stand-in separation."""
+    import main
+    monkeypatch.setattr(preview, "PREVIEW_SECONDS", 1)
+    gates = {"preview": threading.Event(), "separate": stages.release}
+    started = {"preview": threading.Event(), "separate": stages.started}
+    published = threading.Event()
+
+    def run_preview(task):
+        started["preview"].set()
+        gates["preview"].wait(10)
+        folder = Path(task["output_root"]) / task["name"] / PREVIEW_DIR
+        folder.mkdir(parents=True, exist_ok=True)
+        stem = folder / f"{task['name']} [drums].mp3"
+        stem.write_bytes(b"preview")
+        task["preview_callback"]({"stems": [str(stem)], "bpm": 120.0, "key": "A minor", "start": task["start"], "seconds": 1.0})
+        published.set()
+
+    monkeypatch.setattr(main.previews, "run", run_preview)
+    yield gates, started, published
+    gates["preview"].set()
+
+
+def test_preview_runs_beside_separation(youtube, client, previews):
+    gates, started, published = previews
+    youtube.videos["previewFst1"] = 5
+    job_id = client.post("/start", data={"url": youtube.video_url("previewFst1"), "name": "fast preview"}).json()["job_id"]
+    # Both start without waiting for each other
+    assert started["preview"].wait(10)
+    assert started["separate"].wait(10)
+
+    gates["preview"].set()
+    wait_until(lambda: client.get(f"/status/{job_id}").json()["tier"] == "preview")
+    assert client.get(f"/status/{job_id}").json()["status"] == "separating"
+
+    gates["separate"].set()
+    status = wait_for(client, job_id)
+    assert status["tier"] == "full"
+    assert status["preview"] is None
+    files = client.get(f"/files/{job_id}/fast preview").json()
+    assert [f["name"] for f in files["files"]] == ["fast preview [drums].wav"]
+    assert files["preview"] == []
+
+
+def test_late_preview_is_not_published(youtube, client, previews):
+    import main
+    gates, started, published = previews
+    youtube.videos["previewSlw1"] = 5
+    job_id = client.post("/start", data={"url": youtube.video_url("previewSlw1"), "name": "slow preview"}).json()["job_id"]
+    assert started["preview"].wait(10)
+    gates["separate"].set()
+    assert wait_for(client, job_id)["status"] == "done"
+
+    # The preview finishing after the full stems changes nothing
+    gates["preview"].set()
+    assert published.wait(10)
+    assert not (main.OUTPUT_ROOT / job_id / "slow preview" / PREVIEW_DIR).exists()
+    status = client.get(f"/status/{job_id}").json()
+    assert status["tier"] == "full"
+    assert status["preview"] is None
@@ -0,0 +1,41 @@
+# test_recovery.py
+# Jobs left unfinished by a restart are requeued through the result cache and coalescing
+from cache import cache_key
+from settings import separation_params
+from tests.conftest import wait_for
+
+
+def test_recovered_jobs_reuse_results(youtube, client, stages, monkeypatch, tmp_path):
+    import main
+    youtube.videos.update(recoverVid1=5, recoverVid2=5)
+    url, cached_url = youtube.video_url("recoverVid1"), youtube.video_url("recoverVid2")
+    stem = tmp_path / "cached [drums].wav"
+    stem.write_bytes(b"cached")
+    main.result_cache.store(cache_key("recoverVid2", separation_params()), [str(stem)], "cached", 100.0, "C major", video_id="recoverVid2")
+
+    # Rows as a restart finds them: two requests for one video, mid-way
+    # through, and one whose result was cached in the meantime
+    batch_id = "recbatch"
+    main.store.create_batch(batch_id, None, url, [], [])
+    jobs = [main.new_job(url, "first", batch_id=batch_id), main.new_job(url, "second"), main.new_job(cached_url, "cached")]
+    for job, video_id in zip(jobs, ("recoverVid1", "recoverVid1", "recoverVid2")):
+        main.store.create({**job, "video_id": video_id, "title": f"Synthetic {video_id}", "duration": 5})
+        main.store.set_status(job["job_id"], "separating", "separate")
+    first, second, cached = (job["job_id"] for job in jobs)
+    monkeypatch.setattr(main.store, "unfinished", lambda: [main.store.get(job_id) for job_id in (first, second, cached)])
+    main.recover_jobs()
+
+    assert client.get(f"/status/{cached}").json()["tier"] == "full"
+    leader = next(job for job in sum(main.scheduler.snapshot(), []) if job["job_id"] == first)
+    assert leader["duration"] == 5
+    assert leader["batch_id"] == batch_id
+    assert leader["estimated_seconds"] is not None
+    follower = main.find_follower(second)
+    assert main.public_job(follower)["coalesced_with"] == first
+
+    stages.release.set()
+    assert wait_for(client, first)["status"] == "done"
+    assert wait_for(client, second)["status"] == "done"
+    # The video was separated once, for both jobs
+    assert stages.separated.count(first) == 1
+    assert second not in stages.separated
@@ -0,0 +1,289 @@
+# workers.py
+# Supervised worker processes that run the heavy pipeline stages outside the API process
+import multiprocessing
+import queue
+import shutil
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from metrics import collector
+from scheduler import JobCancelled
+
+# Workers are spawned rather than forked: the API process has threads (and
+# an event loop) that a fork would copy in whatever state they were in
+CONTEXT = multiprocessing.get_context("spawn")
+# A job whose worker dies is retried on a fresh worker, up to this many tries
+MAX_ATTEMPTS = 2
+RESTART_DELAY = 1
+SUPERVISE_INTERVAL = 1
+CANCEL_POLL_INTERVAL = 0.2
+
+# Arrays passed between stages (decoded audio, separated stems) go through
+# .npy files in this folder of the job, instead of being pickled through a pipe
+WORK_DIR = ".work"
+SPILLED = "__npy__"
+# Job keys that stay in the API process. Workers get their own should_stop,
+# backed by an event the supervisor sets when the job is cancelled.
+LOCAL_KEYS = ("metrics", "cancel", "should_stop")
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+def spill(value, folder: Path, name: str):
+    """Replace the numpy arrays in value (possibly nested in dicts) with references to .npy files."""
+    if isinstance(value, np.ndarray):
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / f"{name}.npy"
+        np.save(path, value)
+        return {SPILLED: str(path)}
+    if isinstance(value, dict) and SPILLED not in value:
+        return {key: spill(item, folder, f"{name}.{key}") for key, item in value.items()}
+    return value
+
+
+def unspill(value):
+    """Map spilled arrays back into memory (copy-on-write, so stages may modify them)."""
+    if isinstance(value, dict):
+        if SPILLED in value:
+            return np.load(value[SPILLED], mmap_mode="c")
+        return {key: unspill(item) for key, item in value.items()}
+    return value
+
+
+def spilled_paths(value) -> List[str]:
+    if isinstance(value, dict):
+        if SPILLED in value:
+            return [value[SPILLED]]
+        return [path for item in value.values() for path in spilled_paths(item)]
+    return []
+
+
+def discard_work(job: dict):
+    """Delete a finished job's spilled arrays."""
+    shutil.rmtree(Path(job["output_root"]) / WORK_DIR, ignore_errors=True)
+
+
+def worker_main(conn, cancel_event, preload: Optional[str], torch_workers: int):
+    """Entry point of a worker process: preload the model, then run stages as they arrive."""
+    lock = threading.Lock()
+
+    def send(*message):
+        with lock:
+            conn.send(message)
+
+    import pipeline
+    from metrics import JobMetrics, job_context, timed
+    from model_registry import registry
+    from splitter import set_torch_threads, load_model
+
+    set_torch_threads(torch_workers)
+    if preload:
+        try:
+            load_model(preload)
+        except Exception as e:
+            print(f"Preloading {preload} failed (will load on first job): {e}")
+    send("stats", registry.stats())
+
+    while True:
+        try:
+            func_name, payload, callbacks = conn.recv()
+        except EOFError:
+            return  # The API process is gone
+        job = {key: unspill(value) for key, value in payload.items()}
+        for key in callbacks:
+            job[key] = lambda *args, key=key: send("callback", key, args)
+        job["should_stop"] = cancel_event.is_set
+        injected = set(callbacks) | {"should_stop"}
+        before = dict(job)
+        job_metrics = JobMetrics()
+        try:
+            # One record per task with this process's RSS before and at its
+            # peak, which admission control learns job memory use from
+            with job_context(job_metrics), timed(func_name, kind="worker") as record:
+                record["start_rss_mb"] = round(record["peak_rss_bytes"] / (1024 * 1024), 1)
+                getattr(pipeline, func_name)(job)
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                send("error", e, job_metrics.records)
+            except Exception:
+                # Not picklable; keep the message
+                send("error", RuntimeError(str(e)), job_metrics.records)
+            continue
+
+        work_dir = Path(job["output_root"]) / WORK_DIR
+        removed = [key for key in before if key not in job]
+        changed = {
+            key: spill(value, work_dir, key)
+            for key, value in job.items()
+            if key not in injected and (key not in before or value is not before[key])
+        }
+        job = before = None
+        # Arrays this stage consumed aren't needed by later ones
+        for key in removed:
+            for path in spilled_paths(payload[key]):
+                try:
+                    Path(path).unlink()
+                except OSError:
+                    pass
+        send("done", changed, removed, job_metrics.records)
+        send("stats", registry.stats())
+
+
+class WorkerPool:
+    """Runs pipeline stage functions in `size` supervised worker processes.
+
+    Workers are separate interpreters, so torch, demucs and librosa are
+    only ever imported there, and a crash in one can't take the API down.
+    Each preloads `preload` and runs one stage at a time; a supervisor
+    thread per worker hands it jobs and relays progress callbacks and step
+    timings back to the job in this process. A worker that dies is
+    restarted, and the job it was running is requeued on the new one, up
+    to MAX_ATTEMPTS tries.
+    """
+
+    def __init__(self, name: str, size: int, preload: str = None, torch_workers: int = 1):
+        self.name = name
+        self.size = max(1, size)
+        self.preload = preload
+        self.torch_workers = torch_workers
+        self.tasks = queue.Queue()
+        self.workers = []
+
+    def start(self):
+        for slot in range(self.size):
+            status = {"pid": None, "alive": False, "restarts": 0, "tasks": 0, "job_id": None, "models": None}
+            self.workers.append(status)
+            threading.Thread(target=self._supervise, args=(status,), name=f"{self.name}-supervisor-{slot}", daemon=True).start()
+
+    def stage(self, func_name: str) -> Callable[[dict], None]:
+        """A scheduler stage function running pipeline.<func_name> in this pool."""
+        def run(job: dict):
+            self.run(func_name, job)
+        run.__name__ = func_name
+        return run
+
+    def run(self, func_name: str, job: dict):
+        """Run pipeline.<func_name>(job) in a worker and apply its changes to job."""
+        task = {"func": func_name, "job": job, "done": threading.Event(), "error": None, "attempts": 0}
+        self.tasks.put(task)
+        task["done"].wait()
+        if task["error"] is not None:
+            raise task["error"]
+
+    def stats(self) -> list:
+        return [dict(status) for status in self.workers]
+
+    def restarts(self) -> int:
+        return sum(status["restarts"] for status in self.workers)
+
+    def _spawn(self, status: dict):
+        conn, child_conn = CONTEXT.Pipe()
+        cancel_event = CONTEXT.Event()
+        process = CONTEXT.Process(
+            target=worker_main, args=(child_conn, cancel_event, self.preload, self.torch_workers),
+            name=f"{self.name}-worker", daemon=True,
+        )
+        process.start()
+        # Only the worker holds its end now, so recv() sees EOF if it dies
+        child_conn.close()
+        status.update(pid=process.pid, alive=True, job_id=None)
+        return process, conn, cancel_event
+
+    def _supervise(self, status: dict):
+        process, conn, cancel_event = self._spawn(status)
+        while True:
+            try:
+                task = self.tasks.get(timeout=SUPERVISE_INTERVAL)
+            except queue.Empty:
+                task = None
+            try:
+                if task is None:
+                    # Idle: collect stats and notice workers that died
+                    while conn.poll():
+                        self._handle(conn.recv(), status)
+                    if not process.is_alive():
+                        raise EOFError
+                else:
+                    self._execute(task, conn, cancel_event, status)
+            except (EOFError, OSError):
+                process.join(timeout=5)
+                print(f"{self.name} worker {status['pid']} died (exit code {process.exitcode}), restarting")
+                status.update(alive=False, restarts=status["restarts"] + 1)
+                conn.close()
+                time.sleep(RESTART_DELAY)
+                process, conn, cancel_event = self._spawn(status)
+                if task is not None:
+                    self._retry(task)
+
+    def _retry(self, task: dict):
+        task["attempts"] += 1
+        if task["attempts"] >= MAX_ATTEMPTS:
+            task["error"] = WorkerCrashed(f"Worker process died {task['attempts']} times during {task['func']}")
+            task["done"].set()
+        else:
+            print(f"Requeueing job {task['job']['job_id']} on a new {self.name} worker")
+            self.tasks.put(task)
+
+    def _execute(self, task: dict, conn, cancel_event, status: dict):
+        job = task["job"]
+        if job.get("cancel") is not None and job["cancel"].is_set():
+            task["error"] = JobCancelled(f"Job {job['job_id']} was cancelled")
+            task["done"].set()
+            return
+        work_dir = Path(job["output_root"]) / WORK_DIR
+        payload, callbacks = {}, []
+        for key, value in list(job.items()):
+            if key in LOCAL_KEYS:
+                continue
+            if callable(value):
+                callbacks.append(key)
+                continue
+            # Spilled once; later stages reuse the file
+            job[key] = payload[key] = spill(value, work_dir, key)
+        status["job_id"] = job["job_id"]
+        cancel_event.clear()
+        conn.send((task["func"], payload, callbacks))
+        while True:
+            while not conn.poll(CANCEL_POLL_INTERVAL):
+                if job.get("cancel") is not None and job["cancel"].is_set():
+                    cancel_event.set()
+            if self._handle(conn.recv(), status, task):
+                break
+        status["job_id"] = None
+        status["tasks"] += 1
+        task["done"].set()
+
+    def _handle(self, message: tuple, status: dict, task: dict = None) -> bool:
+        """Act on one message from a worker; True once the task has finished."""
+        kind = message[0]
+        if kind == "stats":
+            status["models"] = message[1]
+            return False
+        job = task["job"]
+        if kind == "callback":
+            _, key, args = message
+            try:
+                job[key](*args)
+            except Exception:
+                traceback.print_exc()
+            return False
+        if kind == "done":
+            _, changed, removed, records = message
+            for key in removed:
+                job.pop(key, None)
+            job.update(changed)
+        else:
+            _, task["error"], records = message
+        for record in records:
+            collector.observe(record)
+            if "metrics" in job:
+                job["metrics"].add(record)
+        return True